@@ -0,0 +1,207 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import matplotlib
+matplotlib.use('Agg')
+import netCDF4 as nc
+
+from synthetic import generate
+from pt02_reader import LAT_VAR, LON_VAR, list_product_files, read_inputs, read_points, read_cube
+from pt02_store import consolidate
+from pt02_timeindex import TimeIndex
+from pt02_climatology import annual_totals, climatology
+import ipma_pt2_plot
+
+
+# Benchmarks of the ingestion, aggregation and rendering hot paths on a
+# synthetic archive of configurable size. Every stage is timed over a few
+# repeats, then run once more under tracemalloc for its peak traced memory
+# (NumPy buffers are traced; netCDF4/HDF5 internal buffers are not). The
+# results are written as JSON and can be compared with an earlier run.
+#
+#   python run_benchmarks.py --product mensal --n-lat 28 --n-lon 18 --years 54 --points 100 --output bench.json
+#   python run_benchmarks.py ... --compare bench_previous.json
+
+DEFAULT_REPEATS = 3
+# A stage slower than the reference by more than this ratio is flagged
+REGRESSION_RATIO = 1.2
+
+
+def query_points(lat_values, lon_values, n_points, seed=0):
+    # Random points inside the grid (some fall on sea cells, like real queries)
+    rng = np.random.default_rng(seed)
+    return (rng.uniform(lat_values.min(), lat_values.max(), n_points),
+            rng.uniform(lon_values.min(), lon_values.max(), n_points))
+
+
+class StageInputs:
+    # Inputs of the aggregation and rendering stages: the full cube and the
+    # series of one point, read on first use and kept for the later stages.
+    # They are never read before a read stage runs, so untimed reads do not
+    # warm the page cache for it (or at all when only read stages run).
+
+    def __init__(self, directory, product):
+        self.directory = directory
+        self.product = product
+        # Only the coordinate variables of one file, for the query points
+        with nc.Dataset(list_product_files(directory, product)[0]) as dataset:
+            self.lat_values = np.asarray(dataset.variables[LAT_VAR][:], dtype=np.float64)
+            self.lon_values = np.asarray(dataset.variables[LON_VAR][:], dtype=np.float64)
+        self.lat, self.lon = float(np.median(self.lat_values)), float(np.median(self.lon_values))
+        self._cube = None
+        self._series = None
+
+    def cube(self):
+        if self._cube is None:
+            self._cube = read_cube(self.directory, self.product)
+        return self._cube
+
+    def series(self):
+        if self._series is None:
+            self._series = read_inputs(self.directory, self.lat, self.lon, self.product)
+        return self._series
+
+
+def build_stages(directory, product, n_points, workers, render_directory):
+    # name -> (input loader or None, callable taking the loaded input) of
+    # every stage, in running order. The loader runs untimed, just before the
+    # first stage that needs it.
+    inputs = StageInputs(directory, product)
+    target_lats, target_lons = query_points(inputs.lat_values, inputs.lon_values, n_points)
+    lat, lon = inputs.lat, inputs.lon
+    store_directory = os.path.join(render_directory, 'store')
+
+    def render(name, draw):
+        return inputs.series, lambda series: draw(series, os.path.join(render_directory, f'{name}.png'))
+
+    stages = {
+        'read_inputs': (None, lambda _: read_inputs(directory, lat, lon, product, workers)),
+        'read_points': (None, lambda _: read_points(directory, target_lats, target_lons, product, workers)),
+        'read_cube': (None, lambda _: read_cube(directory, product, workers)),
+        'consolidate': (None, lambda _: consolidate(directory, product, store_directory, force=True)),
+        'time_index': (inputs.series, lambda series: TimeIndex(series['time'])),
+        'yearly_point': (inputs.series, lambda series: TimeIndex(series['time']).yearly_sum(series['precip'])),
+        'yearly_grid': (inputs.cube, lambda grid: climatology(annual_totals(grid[0], grid[3].astype(np.float64))[1])),
+        'hydrological_year_grid': (inputs.cube, lambda grid: TimeIndex(grid[0]).period_sum(grid[3], 'hydrological_year')),
+    }
+    if product == 'mensal':
+        # The figures are drawn for the monthly product only, like the scripts
+        stages.update({
+            'render_monthly_histogram': render('monthly_histogram', lambda series, output: ipma_pt2_plot.plot_monthly_precip_histogram(
+                series['time'], series['precip'], lat, lon, output=output, show=False)),
+            'render_monthly_contribution': render('monthly_contribution', lambda series, output: ipma_pt2_plot.plot_monthly_precip(
+                series, lat, lon, output=output, show=False)),
+            'render_yearly': render('yearly', lambda series, output: ipma_pt2_plot.plot_yearly_precip(
+                series['time'], series['precip'], lat, lon, output=output, show=False)),
+        })
+    return stages
+
+
+def time_stage(function, repeats):
+    import matplotlib.pyplot as plt
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+        plt.close('all')
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    plt.close('all')
+    return {'seconds': times, 'min': min(times), 'median': float(np.median(times)), 'peak_traced_bytes': peak}
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'netCDF4': nc.__version__,
+            'matplotlib': matplotlib.__version__, 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'git_commit': commit}
+
+
+def compare(results, reference):
+    # Ratio of the median time of every stage to the reference run
+    if reference.get('config') != results['config']:
+        print(f"Note: the reference was run with a different configuration: {reference.get('config')}")
+    print(f"{'stage':32s} {'median':>10s} {'reference':>10s} {'ratio':>7s}")
+    for name, stage in results['stages'].items():
+        if name not in reference.get('stages', {}):
+            continue
+        ratio = stage['median'] / reference['stages'][name]['median']
+        flag = '  REGRESSION' if ratio > REGRESSION_RATIO else ''
+        print(f"{name:32s} {stage['median']:10.4f} {reference['stages'][name]['median']:10.4f} {ratio:7.2f}{flag}")
+
+
+def run(product='mensal', n_lat=28, n_lon=18, years=54, n_points=100, repeats=DEFAULT_REPEATS, workers=1,
+        stages=None, seed=0):
+    work_directory = tempfile.mkdtemp(prefix='pt02_bench_')
+    try:
+        data_directory = os.path.join(work_directory, 'data')
+        start = time.perf_counter()
+        file_paths = generate(data_directory, product, n_lat, n_lon, years, seed=seed)
+        generate_seconds = time.perf_counter() - start
+
+        results = {
+            'config': {'product': product, 'n_lat': n_lat, 'n_lon': n_lon, 'years': years, 'points': n_points,
+                       'repeats': repeats, 'workers': workers, 'seed': seed, 'files': len(file_paths),
+                       'bytes': sum(os.path.getsize(path) for path in file_paths)},
+            'environment': environment(),
+            'generate_seconds': generate_seconds,
+            'stages': {},
+        }
+        for name, (load, function) in build_stages(data_directory, product, n_points, workers, work_directory).items():
+            if stages and name not in stages:
+                continue
+            data = load() if load is not None else None
+            results['stages'][name] = time_stage(lambda: function(data), repeats)
+            print(f"{name:32s} median {results['stages'][name]['median']:.4f} s, "
+                  f"peak {results['stages'][name]['peak_traced_bytes'] / 2 ** 20:.1f} MiB")
+        # Process wide high water mark (kilobytes on Linux)
+        results['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return results
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the PT02 ingestion, aggregation and rendering paths.")
+    parser.add_argument("--product", type=str, default='mensal', choices=['mensal', 'diario'], help="PT02 product")
+    parser.add_argument("--n-lat", type=int, default=28, help="Number of latitudes")
+    parser.add_argument("--n-lon", type=int, default=18, help="Number of longitudes")
+    parser.add_argument("--years", type=int, default=54, help="Number of years")
+    parser.add_argument("--points", type=int, default=100, help="Number of query points for read_points")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS, help="Timed repeats of every stage")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used to read the NetCDF files")
+    parser.add_argument("--stages", type=str, nargs='+', help="Only run these stages")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic data")
+    parser.add_argument("--output", type=str, default='benchmark_results.json', help="Output JSON file")
+    parser.add_argument("--compare", type=str, help="Earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    results = run(args.product, args.n_lat, args.n_lon, args.years, args.points, args.repeats, args.workers,
+                  args.stages, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f"Saved results to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,92 @@
+import argparse
+import os
+import sys
+import netCDF4 as nc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from pt02_reader import TIME_VAR, LAT_VAR, LON_VAR, PRECIP_VAR, PRODUCTS, encode_time
+
+
+# Synthetic PT02-shaped NetCDF files for the benchmarks. Same layout as the
+# IPMA files: lon, lat (descending) and an unlimited time axis in the
+# YYYYMMDD.5 convention, var228 float32 with the -9e33 fill value and the
+# sea cells masked. The monthly product is written as one file per calendar
+# month (PRECIP_PT_mensal01..12.nc) and the daily one as one file per year.
+
+GRID_STEP = 0.2
+NORTH_LAT = 42.2
+WEST_LON = -9.6
+FILL_VALUE = np.float32(-9e33)
+
+
+def synthetic_grid(n_lat, n_lon):
+    lat_values = NORTH_LAT - GRID_STEP * np.arange(n_lat)
+    lon_values = WEST_LON + GRID_STEP * np.arange(n_lon)
+    # Diagonal coastline: the western cells of the southern rows are sea
+    sea = np.arange(n_lon)[np.newaxis, :] < (np.arange(n_lat)[:, np.newaxis] * n_lon) // (4 * n_lat)
+    return lat_values, lon_values, sea
+
+
+def synthetic_values(rng, dates, sea, daily):
+    # Gamma distributed precipitation with a winter maximum; dry days for the daily product
+    month = dates.astype('datetime64[M]').astype(np.int64) % 12
+    seasonal = 1.0 + 0.8 * np.cos(2 * np.pi * month / 12)
+    scale = (3.0 if daily else 60.0) * seasonal[:, np.newaxis, np.newaxis]
+    values = rng.gamma(0.8 if daily else 2.0, 1.0, size=(len(dates),) + sea.shape) * scale
+    if daily:
+        values[rng.random(values.shape) < 0.6] = 0.0
+    return np.ma.masked_array(values.astype(np.float32), np.broadcast_to(sea, values.shape))
+
+
+def write_file(file_path, lat_values, lon_values, dates, values):
+    with nc.Dataset(file_path, 'w', format='NETCDF3_CLASSIC') as dataset:
+        dataset.createDimension(LON_VAR, len(lon_values))
+        dataset.createDimension(LAT_VAR, len(lat_values))
+        dataset.createDimension(TIME_VAR, None)
+        dataset.createVariable(LON_VAR, 'f8', (LON_VAR,))[:] = lon_values
+        dataset.createVariable(LAT_VAR, 'f8', (LAT_VAR,))[:] = lat_values
+        time_var = dataset.createVariable(TIME_VAR, 'f8', (TIME_VAR,))
+        time_var.units = 'day as %Y%m%d.%f'
+        time_var[:] = encode_time(dates)
+        dataset.createVariable(PRECIP_VAR, 'f4', (TIME_VAR, LAT_VAR, LON_VAR), fill_value=FILL_VALUE)[:] = values
+
+
+def generate(directory, product='mensal', n_lat=28, n_lon=18, years=54, start_year=1950, seed=0):
+    # Write a synthetic archive and return the list of files
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    lat_values, lon_values, sea = synthetic_grid(n_lat, n_lon)
+    prefix = PRODUCTS[product]['prefix']
+    file_paths = []
+
+    if product == 'mensal':
+        months = np.arange(f'{start_year}-01', f'{start_year + years}-01', dtype='datetime64[M]')
+        values = synthetic_values(rng, months, sea, daily=False)
+        for month in range(12):
+            file_path = os.path.join(directory, f"{prefix}{month + 1:02d}.nc")
+            write_file(file_path, lat_values, lon_values, months[month::12], values[month::12])
+            file_paths.append(file_path)
+    else:
+        for year in range(start_year, start_year + years):
+            days = np.arange(f'{year}-01-01', f'{year + 1}-01-01', dtype='datetime64[D]')
+            file_path = os.path.join(directory, f"{prefix}{year}.nc")
+            write_file(file_path, lat_values, lon_values, days, synthetic_values(rng, days, sea, daily=True))
+            file_paths.append(file_path)
+    return file_paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic PT02-shaped NetCDF files.")
+    parser.add_argument("--output-directory", type=str, required=True, help="Directory for the NetCDF files")
+    parser.add_argument("--product", type=str, default='mensal', choices=['mensal', 'diario'], help="PT02 product")
+    parser.add_argument("--n-lat", type=int, default=28, help="Number of latitudes")
+    parser.add_argument("--n-lon", type=int, default=18, help="Number of longitudes")
+    parser.add_argument("--years", type=int, default=54, help="Number of years")
+    parser.add_argument("--start-year", type=int, default=1950, help="First year")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    file_paths = generate(args.output_directory, args.product, args.n_lat, args.n_lon, args.years,
+                          args.start_year, args.seed)
+    print(f"Wrote {len(file_paths)} {args.product} files to {args.output_directory}")
@@ -1,79 +1,42 @@
 import argparse
-import netCDF4 as nc
-import matplotlib.pyplot as plt
-import matplotlib.lines as mlines
 import numpy as np
-import pandas as pd
-from datetime import datetime
-import matplotlib.dates as mdates
-import seaborn as sns
-from scipy.stats import norm
 
 import os
 
-def read_inputs(directory,target_lat,target_lon):
-    # Latitude and longitude of Herdade da Bravura
-    #target_lat = 37.24    # location index [25,5] - Monchique Area
-    #target_lon = -8.70
-    
-    # Initialize empty lists to store data
-    all_time_data = []
-    all_precip_data = []
-    
-    
-    # Loop through all the NetCDF files in the directory
-    for filename in sorted(os.listdir(directory)):
-        if filename.startswith("PRECIP_PT_mensal") and filename.endswith(".nc"):
-            file_path = os.path.join(directory, filename)
-            try:
-                # Open the NetCDF file
-                dataset = nc.Dataset(file_path)
-    
-                # Access the variables
-                time_var = dataset.variables['time']
-                lat_var = dataset.variables['lat']
-                lon_var = dataset.variables['lon']
-                precip_var = dataset.variables['var228']
-    
-                # Read data from the variables
-                time_data = time_var[:]
-                precip_data = precip_var[:]
-    
-    
-                # Calculate the index based on the closest value to the target latitude and longitude
-                lat_idx =  np.abs(lat_var[:] - target_lat).argmin()
-                lon_idx =  np.abs(lon_var[:] - target_lon).argmin()
-        
-                # Close the NetCDF file
-                dataset.close()  
-                
-                # Convert the time data to a more readable format ('YYYY-MM-DD')
-                time_strings = [datetime.strptime(str(int(date)), '%Y%m%d').strftime('%Y-%m') for date in time_data]
-    
-                # Append data to the lists
-                all_time_data.extend(time_strings)
-                all_precip_data.extend(precip_data[:, lat_idx, lon_idx])
-    
-            except Exception as e:
-                print(f"An error occurred while processing {filename}: {e}")
-    
-    
-    # Sort the time data
-    sorted_data = sorted(zip(all_time_data, all_precip_data), key=lambda x: x[0])
-    
-    all_time_data, all_precip_data = zip(*sorted_data) 
-    return sorted_data,all_time_data, all_precip_data
+# matplotlib, pandas, seaborn and scipy are imported inside the plot functions,
+# so the extract/stats commands (see pt02_commands.py) start without them
+
+from pt02_figures import figure_axes, finish_figure
+from pt02_profile import DEFAULT_REPORT, profiled, profile_run
+from pt02_timeindex import TimeIndex
+from pt02_interp import INTERP_METHODS
+from pt02_cache import cached_read_inputs
+from pt02_commands import parse_command_line, run_data_command
+from pt02_reader import read_inputs
 
 
-def plot_monthly_precip_histogram(all_time_data,all_precip_data,target_lat,target_lon):
+# Reservoir water levels of the dam (see data_water_level/), same file as
+# the default of pt02_lagcorr.py
+DEFAULT_WATER_LEVEL_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_water_level',
+                                       'watershed_yearly.csv')
+
+
+@profiled()
+def plot_monthly_precip_histogram(all_time_data,all_precip_data,target_lat,target_lon, output='bravura_monthly_precipitation_with_histogram_1950_2003.png', show=True, fig=None, time_index=None):
+    import matplotlib.pyplot as plt
+    import matplotlib.lines as mlines
+
+    # 'YYYY-MM' labels of the datetime64 time axis
+    time_labels = np.datetime_as_string(all_time_data).tolist()
+
     # Calculate the histogram of monthly precipitation values
     hist, bin_edges = np.histogram(all_precip_data, bins=30)
     
     # Create a figure with two subplots
-    fig, (ax0, ax1) = plt.subplots(nrows=1, ncols=2, figsize=(16, 9), gridspec_kw={'width_ratios': [3, 1]}, sharey=True)
+    fig, (ax0, ax1) = figure_axes(fig, nrows=1, ncols=2, figsize=(16, 9), gridspec_kw={'width_ratios': [3, 1]}, sharey=True)
     
     # Plot monthly precipitation data on the left subplot
-    ax0.plot(all_time_data, all_precip_data, marker='o', linestyle='-', color='tab:blue', label='Accumulated Monthly Precipitation')
+    ax0.plot(np.arange(len(all_time_data)), all_precip_data, marker='o', linestyle='-', color='tab:blue', label='Accumulated Monthly Precipitation')
     ax0.set_xlabel('Date', fontsize=16)
     ax0.set_ylabel('Precipitation (mm)', fontsize=16)
     ax0.set_title(f'Monthly Precipitation at Latitude {target_lat}, Longitude {target_lon}', fontsize=18)
@@ -85,17 +48,18 @@ def plot_monthly_precip_histogram(all_time_data,all_precip_data,target_lat,targe
     # Set custom ticks (show every nth tick)
     n = 12  # Adjust n to control the number of ticks shown
     ax0.set_xticks(np.arange(0, len(all_time_data), n))
-    ax0.set_xticklabels(all_time_data[::n], rotation=80)
+    ax0.set_xticklabels(time_labels[::n], rotation=80)
     
     # Create custom legend entries for the blue points and orange vertical lines
     blue_line = mlines.Line2D([], [], color='tab:blue', marker='o', linestyle='-', markersize=8, label='Precipitation Points', linewidth=2)
     orange_line = mlines.Line2D([], [], color='tab:orange', linestyle='--', label='Yearly Marker', linewidth=2)
     ax0.legend(handles=[blue_line, orange_line], fontsize=14)
     
-    # Highlight the yearly cycle with vertical lines on the left subplot
-    years = set(date.split('-')[0] for date in all_time_data)
-    for year in years:
-        year_start = all_time_data.index(f"{year}-01")
+    # Highlight the yearly cycle with vertical lines on the left subplot,
+    # at the first timestep of every year
+    if time_index is None:
+        time_index = TimeIndex(all_time_data)
+    for year_start in time_index.year_starts:
         ax0.axvline(x=year_start, color='tab:orange', linestyle='--', alpha=0.5, linewidth=2)
     
     # Plot the histogram on the right subplot
@@ -114,14 +78,15 @@ def plot_monthly_precip_histogram(all_time_data,all_precip_data,target_lat,targe
     # Adjust the layout
     plt.tight_layout()
     
-    # Save the figure
-    plt.savefig('bravura_monthly_precipitation_with_histogram_1950_2003.png', format='png')
+    # Save the figure (and show it in interactive runs)
+    finish_figure(fig, output, show)
+    return fig
     
-    # Show the plot
-    plt.show()
     
-    
-def plot_monthly_precip(sorted_data, all_time_data, target_lat,target_lon):
+@profiled()
+def plot_monthly_precip(series, target_lat,target_lon, output='bravura_yearly_precipitation_per_month_1950_2003.png', show=True, fig=None, time_index=None):
+    import matplotlib.pyplot as plt
+
     # Create a dictionary to map months to their respective season colors
     month_colors = {
         1: ('January', '#0000FF'),    # January - Winter (Dark Blue)
@@ -139,24 +104,21 @@ def plot_monthly_precip(sorted_data, all_time_data, target_lat,target_lon):
     }
     
     # Create a figure for the line plot
-    plt.figure(figsize=(12, 6))
+    fig, ax = figure_axes(fig, figsize=(12, 6))
        
-    # Extract years from time data
-    years = list(set([int(date.split('-')[0]) for date in all_time_data]))
-    
-    # Split the data into batches of 12 months each
-    batch_size = 12
-    year_batches = [sorted_data[i:i+batch_size] for i in range(0, len(sorted_data), batch_size)]
-    
-    for y in range(0,len(year_batches)):
-        # Plot each month's accumulated precipitation
-        bottom=0
-        for m in range(0, 12):
-            precip_value = year_batches[y][m][1]
-            year=int(year_batches[y][m][0].split('-')[0])
-            month_name,color=month_colors[m+1]
-            plt.bar(year, precip_value, color=color,bottom=bottom)
-            bottom += precip_value
+    # Build the year x month matrix once. Months missing from the series
+    # (partial years, gaps) stay at zero instead of shifting the stack.
+    if time_index is None:
+        time_index = TimeIndex(series['time'])
+    years, year_month = time_index.year_month_matrix(series['precip'])
+    
+    # Bottom of every month's bar is the sum of the previous months of that year
+    bottoms = np.cumsum(year_month, axis=1) - year_month
+    
+    # Plot each month's accumulated precipitation as one layer of stacked bars
+    for m in range(0, 12):
+        month_name,color=month_colors[m+1]
+        plt.bar(years, year_month[:, m], color=color, bottom=bottoms[:, m])
         
     
     plt.xlabel('Year', fontsize=14)
@@ -174,20 +136,23 @@ def plot_monthly_precip(sorted_data, all_time_data, target_lat,target_lon):
     
     plt.tight_layout()
     
-    # Save the figure
-    plt.savefig('bravura_yearly_precipitation_per_month_1950_2003.png', format='png')
-    
-    plt.show()    
+    # Save the figure (and show it in interactive runs)
+    finish_figure(fig, output, show)
+    return fig
 
 
     
-def plot_yearly_precip(sorted_data, target_lat, target_lon):
-    df_precip = pd.DataFrame(sorted_data, columns=['Date', 'Precipitation'])
-    # Convert the 'Date' column to datetime format (only the year part will be significant)
-    df_precip['Year'] = pd.to_datetime(df_precip['Date'], format='%Y-%m')
-    
-    df_precip['Year'] = df_precip['Year'].dt.year
-    accumulated_rain_year = df_precip.groupby('Year')['Precipitation'].sum().reset_index()
+@profiled()
+def plot_yearly_precip(series, target_lat, target_lon, output='bravura_yearly_precipitation_with_histogram_1950_2003.png', show=True, fig=None, time_index=None):
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    import seaborn as sns
+    from scipy.stats import norm
+
+    # Accumulated precipitation per year from the shared time index
+    if time_index is None:
+        time_index = TimeIndex(series['time'])
+    accumulated_rain_year = pd.DataFrame({'Year': time_index.years, 'Precipitation': time_index.yearly_sum(series['precip'])})
 
     # Find the year(s) with maximum and minimum accumulated precipitation
     max_rainfall_year = accumulated_rain_year.loc[accumulated_rain_year['Precipitation'].idxmax(),'Year']
@@ -199,7 +164,7 @@ def plot_yearly_precip(sorted_data, target_lat, target_lon):
     sns.set_palette(palette)   
     
     # Create a figure with two subplots
-    fig, (ax0, ax1) = plt.subplots(nrows=1, ncols=2, figsize=(16, 9), gridspec_kw={'width_ratios': [3, 1]}, sharey=True)
+    fig, (ax0, ax1) = figure_axes(fig, nrows=1, ncols=2, figsize=(16, 9), gridspec_kw={'width_ratios': [3, 1]}, sharey=True)
     
     # Plot yearly accumulated precipitation data on the left subplot
     ax0.bar(accumulated_rain_year['Year'], accumulated_rain_year['Precipitation'], color=palette[5], alpha=0.7, label='Yearly Accumulated Precipitation')
@@ -280,19 +245,20 @@ def plot_yearly_precip(sorted_data, target_lat, target_lon):
     # Adjust the layout
     plt.tight_layout()
     
-    # Save the figure
-    plt.savefig('bravura_yearly_precipitation_with_histogram_1950_2003.png', format='png')
-    
-    # Show the plot
-    plt.show()
+    # Save the figure (and show it in interactive runs)
+    finish_figure(fig, output, show)
+    return fig
 
 
-def plot_waterlevel_yearly(all_time_data, all_precip_data, target_lat,target_lon):
+@profiled()
+def plot_waterlevel_yearly(all_time_data, all_precip_data, target_lat,target_lon, output='water_level_plot.png', show=True, fig=None, time_index=None, csv_file=DEFAULT_WATER_LEVEL_CSV):
+    import matplotlib.pyplot as plt
+    import matplotlib.lines as mlines
+    import pandas as pd
+    import seaborn as sns
 
     
-    # Define the CSV file path
-    csv_file = '/home/rosario/AdBravura/environment/water/combined/data_water_level/watershed_yearly.csv'
-    # Read the CSV file into a pandas DataFrame
+    # Read the water level CSV file into a pandas DataFrame
     df = pd.read_csv(csv_file)
     # Convert the 'date' column to datetime format (if it's not already)
     df['date'] = pd.to_datetime(df['date'], format='%Y-%m')
@@ -307,7 +273,7 @@ def plot_waterlevel_yearly(all_time_data, all_precip_data, target_lat,target_lon
     colors = [palette[6],palette[3]]
     
     # Create a line plot
-    plt.figure(figsize=(13, 5))
+    fig, ax = figure_axes(fig, figsize=(13, 5))
     
     # Create a line plot going through the points
     plt.plot(
@@ -342,7 +308,7 @@ def plot_waterlevel_yearly(all_time_data, all_precip_data, target_lat,target_lon
     plt.yticks(y_values, y_labels)
     
     # Set x-axis ticks every 2 years (adjust as needed)
-    x_ticks = pd.date_range(start=df['date'].min(), end=df['date'].max(), freq='2Y')
+    x_ticks = pd.date_range(start=df['date'].min(), end=df['date'].max(), freq=pd.offsets.YearEnd(2))
     plt.xticks(x_ticks, [x.strftime('%Y') for x in x_ticks])
     
     # Add vertical grid lines
@@ -357,23 +323,25 @@ def plot_waterlevel_yearly(all_time_data, all_precip_data, target_lat,target_lon
     # Show the legend in the top-right corner
     plt.legend(handles=legend_handles, loc='upper right', title="Legend")
     
-    # Save the plot to an image file (e.g., PNG)
-    plt.savefig('water_level_plot.png')
-    
-    # Show the plot or save it to a file
+    # Save the plot to an image file (and show it in interactive runs)
     plt.tight_layout()
-    plt.show()
+    finish_figure(fig, output, show)
+    return fig
+
 
 
+@profiled()
+def plot_combined_waterlevel_and_precip(series, target_lat, target_lon, output='bravura_waterlevel_precip.png', show=True, fig=None, time_index=None, csv_file=DEFAULT_WATER_LEVEL_CSV):
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+    import pandas as pd
+    import seaborn as sns
 
-def plot_combined_waterlevel_and_precip(sorted_data, target_lat, target_lon):
     
-    # read input to dataframe
-    df_precip = pd.DataFrame(sorted_data, columns=['Date', 'Precipitation'])
-    # Convert the 'Date' column to datetime format (only the year part will be significant)
-    df_precip['Year'] = pd.to_datetime(df_precip['Date'], format='%Y-%m')    
-    df_precip['Year'] = df_precip['Year'].dt.year
-    accumulated_rain_year = df_precip.groupby('Year')['Precipitation'].sum().reset_index()
+    # Accumulated precipitation per year from the shared time index
+    if time_index is None:
+        time_index = TimeIndex(series['time'])
+    accumulated_rain_year = pd.DataFrame({'Year': time_index.years, 'Precipitation': time_index.yearly_sum(series['precip'])})
     # Convert the 'Year' column back to a datetime format, setting all dates to the half of the year
     accumulated_rain_year['Year'] = pd.to_datetime(accumulated_rain_year['Year'].astype(str)) #+ pd.DateOffset(months=6)
     
@@ -382,9 +350,7 @@ def plot_combined_waterlevel_and_precip(sorted_data, target_lat, target_lon):
     min_rainfall_year = accumulated_rain_year.loc[accumulated_rain_year['Precipitation'].idxmin(),'Year']
     
 
-    # Define the CSV file path for water level
-    csv_file = '/home/rosario/AdBravura/environment/water/combined/data_water_level/watershed_yearly.csv'
-    # Read the CSV file into a pandas DataFrame
+    # Read the water level CSV file into a pandas DataFrame
     df_waterlevel = pd.read_csv(csv_file)
     df_waterlevel['date'] = pd.to_datetime(df_waterlevel['date'], format='%Y-%m')
     # Sort the DataFrame by date
@@ -392,9 +358,12 @@ def plot_combined_waterlevel_and_precip(sorted_data, target_lat, target_lon):
 
        
     # create figure
-    fig, ax_precip = plt.subplots(figsize=(18, 8))
-    # Duplicate x-axis
-    ax_water = ax_precip.twinx()     
+    fig, ax_precip = figure_axes(fig, figsize=(18, 8))
+    # Duplicate x-axis (a reused figure already has its twin axes)
+    ax_water = fig.axes[1] if len(fig.axes) > 1 else ax_precip.twinx()
+    # Clearing a reused twin axis moves its ticks and label back to the left
+    ax_water.yaxis.tick_right()
+    ax_water.yaxis.set_label_position('right')
    
     # Set title
     ax_water.set_title('Accumulated Yearly Precipitation vs Qualitative Water Level', fontsize=16) 
@@ -415,7 +384,7 @@ def plot_combined_waterlevel_and_precip(sorted_data, target_lat, target_lon):
     # Customize the vertical axis labels
     y_values = [1, 2, 3, 4]
     y_labels = ["Ext.Low", "Low", "OK", "Full"]    
-    plt.yticks(y_values, y_labels)    
+    ax_water.set_yticks(y_values, y_labels)    
     ax_water.tick_params(axis='y')
     ax_water.set_ylabel('Relative Water Level', fontsize=14)
 
@@ -459,7 +428,7 @@ def plot_combined_waterlevel_and_precip(sorted_data, target_lat, target_lon):
     # Create the range of dates with '5YS' frequency
     #date_ticks = pd.date_range(start=f'{start_year}-01-01', end=f'{end_year}-12-31', freq='5YS')
     
-    date_ticks = pd.date_range(start=min_year, periods=((end_year-start_year)//5)+1, freq='5Y')
+    date_ticks = pd.date_range(start=min_year, periods=((end_year-start_year)//5)+1, freq=pd.offsets.YearEnd(5))
 
     print (date_ticks)
     
@@ -483,36 +452,61 @@ def plot_combined_waterlevel_and_precip(sorted_data, target_lat, target_lon):
     # Adjust the plot to make room for the x-axis labels.
     fig.autofmt_xdate()    
     
-    # Save the figure
-    plt.savefig('bravura_waterlevel_precip.png', format='png')
-    
-    plt.show()
+    # Save the figure (and show it in interactive runs)
+    finish_figure(fig, output, show)
+    return fig
     
 
 
 
     
-def main(target_lat, target_lon, data_directory):
+def main(target_lat, target_lon, data_directory, workers=1, interp='nearest', cache=True):
     # Get the absolute path to the data directory
     directory = os.path.join(os.path.dirname(__file__), data_directory)
 
-    sorted_data, all_time_data, all_precip_data = read_inputs(directory,target_lat,target_lon)
+    # Repeated queries of the same grid cell come from the series cache (see pt02_cache.py)
+    if cache:
+        series = cached_read_inputs(directory,target_lat,target_lon,workers=workers,interp=interp)
+    else:
+        series = read_inputs(directory,target_lat,target_lon,workers=workers,interp=interp)
+    all_time_data, all_precip_data = series['time'], series['precip']
+    # Year/month offsets shared by all the aggregations and plots
+    time_index = TimeIndex(all_time_data)
 
 
-    #plot_monthly_precip_histogram(all_time_data, all_precip_data,target_lat,target_lon)
-    #plot_monthly_precip(sorted_data, all_time_data, target_lat,target_lon)
-    plot_yearly_precip(sorted_data, target_lat, target_lon)
+    #plot_monthly_precip_histogram(all_time_data, all_precip_data,target_lat,target_lon, time_index=time_index)
+    #plot_monthly_precip(series, target_lat,target_lon, time_index=time_index)
+    plot_yearly_precip(series, target_lat, target_lon, time_index=time_index)
     plot_waterlevel_yearly(all_time_data, all_precip_data, target_lat,target_lon)
-    plot_combined_waterlevel_and_precip(sorted_data, target_lat, target_lon)
+    plot_combined_waterlevel_and_precip(series, target_lat, target_lon, time_index=time_index)
 
 if __name__ == "__main__":
+    # Subcommands: extract, stats and plot (see pt02_commands.py)
+    command_args = parse_command_line("Process precipitation data.")
+    if command_args is not None:
+        directory = os.path.join(os.path.dirname(__file__), command_args.data_directory)
+        # --profile: per-stage timing report of the run (see pt02_profile.py)
+        with profile_run(command_args.profile, run=dict(vars(command_args), script=os.path.basename(__file__))):
+            if not run_data_command(directory, command_args):
+                main(command_args.lat, command_args.lon, command_args.data_directory, command_args.workers,
+                     command_args.interp, not command_args.no_cache)
+        raise SystemExit
+
+    # Original flags, without a subcommand
     parser = argparse.ArgumentParser(description="Process precipitation data.")
     parser.add_argument("--lat", type=float, required=True, help="Latitude")
     parser.add_argument("--lon", type=float, required=True, help="Longitude")
     parser.add_argument("--data-directory", type=str, required=True, help="Relative path to data directory")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used to read the NetCDF files")
+    parser.add_argument("--interp", type=str, default='nearest', choices=INTERP_METHODS,
+                        help="Nearest grid cell or interpolation between the surrounding cells")
+    parser.add_argument("--no-cache", action='store_true', help="Always read the NetCDF files instead of the series cache")
+    parser.add_argument("--profile", type=str, nargs='?', const=DEFAULT_REPORT,
+                        help="Save a per-stage timing/memory report to this JSON file (default %(const)s)")
     args = parser.parse_args()
 
-    main(args.lat, args.lon, args.data_directory)
+    with profile_run(args.profile, run=dict(vars(args), script=os.path.basename(__file__))):
+        main(args.lat, args.lon, args.data_directory, args.workers, args.interp, not args.no_cache)
     
     
     
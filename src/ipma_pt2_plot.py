@@ -1,75 +1,36 @@
 import argparse
-import netCDF4 as nc
-import matplotlib.pyplot as plt
-import matplotlib.lines as mlines
 import numpy as np
-from datetime import datetime
 
 import os
 
-def read_inputs(directory,target_lat,target_lon):
-    # Latitude and longitude of Herdade da Bravura
-    #target_lat = 37.24    # location index [25,5] - Monchique Area
-    #target_lon = -8.70
-    
-    # Initialize empty lists to store data
-    all_time_data = []
-    all_precip_data = []
-    
-    
-    # Loop through all the NetCDF files in the directory
-    for filename in sorted(os.listdir(directory)):
-        if filename.startswith("PRECIP_PT_mensal") and filename.endswith(".nc"):
-            file_path = os.path.join(directory, filename)
-            try:
-                # Open the NetCDF file
-                dataset = nc.Dataset(file_path)
-    
-                # Access the variables
-                time_var = dataset.variables['time']
-                lat_var = dataset.variables['lat']
-                lon_var = dataset.variables['lon']
-                precip_var = dataset.variables['var228']
-    
-                # Read data from the variables
-                time_data = time_var[:]
-                precip_data = precip_var[:]
-    
-    
-                # Calculate the index based on the closest value to the target latitude and longitude
-                lat_idx =  np.abs(lat_var[:] - target_lat).argmin()
-                lon_idx =  np.abs(lon_var[:] - target_lon).argmin()
-        
-                # Close the NetCDF file
-                dataset.close()  
-                
-                # Convert the time data to a more readable format ('YYYY-MM-DD')
-                time_strings = [datetime.strptime(str(int(date)), '%Y%m%d').strftime('%Y-%m') for date in time_data]
-    
-                # Append data to the lists
-                all_time_data.extend(time_strings)
-                all_precip_data.extend(precip_data[:, lat_idx, lon_idx])
-    
-            except Exception as e:
-                print(f"An error occurred while processing {filename}: {e}")
-    
-    
-    # Sort the time data
-    sorted_data = sorted(zip(all_time_data, all_precip_data), key=lambda x: x[0])
-    all_time_data, all_precip_data = zip(*sorted_data) 
-    return sorted_data,all_time_data, all_precip_data
+# matplotlib, pandas, seaborn and scipy are imported inside the plot functions,
+# so the extract/stats commands (see pt02_commands.py) start without them
+
+from pt02_figures import figure_axes, finish_figure
+from pt02_profile import DEFAULT_REPORT, profiled, profile_run
+from pt02_timeindex import TimeIndex
+from pt02_interp import INTERP_METHODS
+from pt02_cache import cached_read_inputs
+from pt02_commands import parse_command_line, run_data_command
+from pt02_reader import read_inputs, read_points, load_points_file, write_points_csv
 
 
+@profiled()
+def plot_monthly_precip_histogram(all_time_data,all_precip_data,target_lat,target_lon, output='bravura_monthly_precipitation_with_histogram_1950_2003.png', show=True, fig=None, time_index=None):
+    import matplotlib.pyplot as plt
+    import matplotlib.lines as mlines
+
+    # 'YYYY-MM' labels of the datetime64 time axis
+    time_labels = np.datetime_as_string(all_time_data).tolist()
 
-def plot_monthly_precip_histogram(all_time_data,all_precip_data,target_lat,target_lon):
     # Calculate the histogram of monthly precipitation values
     hist, bin_edges = np.histogram(all_precip_data, bins=30)
     
     # Create a figure with two subplots
-    fig, (ax0, ax1) = plt.subplots(nrows=1, ncols=2, figsize=(16, 9), gridspec_kw={'width_ratios': [3, 1]}, sharey=True)
+    fig, (ax0, ax1) = figure_axes(fig, nrows=1, ncols=2, figsize=(16, 9), gridspec_kw={'width_ratios': [3, 1]}, sharey=True)
     
     # Plot monthly precipitation data on the left subplot
-    ax0.plot(all_time_data, all_precip_data, marker='o', linestyle='-', color='tab:blue', label='Accumulated Monthly Precipitation')
+    ax0.plot(np.arange(len(all_time_data)), all_precip_data, marker='o', linestyle='-', color='tab:blue', label='Accumulated Monthly Precipitation')
     ax0.set_xlabel('Date', fontsize=16)
     ax0.set_ylabel('Precipitation (mm)', fontsize=16)
     ax0.set_title(f'Monthly Precipitation at Latitude {target_lat}, Longitude {target_lon}', fontsize=18)
@@ -81,17 +42,18 @@ def plot_monthly_precip_histogram(all_time_data,all_precip_data,target_lat,targe
     # Set custom ticks (show every nth tick)
     n = 12  # Adjust n to control the number of ticks shown
     ax0.set_xticks(np.arange(0, len(all_time_data), n))
-    ax0.set_xticklabels(all_time_data[::n], rotation=80)
+    ax0.set_xticklabels(time_labels[::n], rotation=80)
     
     # Create custom legend entries for the blue points and orange vertical lines
     blue_line = mlines.Line2D([], [], color='tab:blue', marker='o', linestyle='-', markersize=8, label='Precipitation Points', linewidth=2)
     orange_line = mlines.Line2D([], [], color='tab:orange', linestyle='--', label='Yearly Marker', linewidth=2)
     ax0.legend(handles=[blue_line, orange_line], fontsize=14)
     
-    # Highlight the yearly cycle with vertical lines on the left subplot
-    years = set(date.split('-')[0] for date in all_time_data)
-    for year in years:
-        year_start = all_time_data.index(f"{year}-01")
+    # Highlight the yearly cycle with vertical lines on the left subplot,
+    # at the first timestep of every year
+    if time_index is None:
+        time_index = TimeIndex(all_time_data)
+    for year_start in time_index.year_starts:
         ax0.axvline(x=year_start, color='tab:orange', linestyle='--', alpha=0.5, linewidth=2)
     
     # Plot the histogram on the right subplot
@@ -110,14 +72,15 @@ def plot_monthly_precip_histogram(all_time_data,all_precip_data,target_lat,targe
     # Adjust the layout
     plt.tight_layout()
     
-    # Save the figure
-    plt.savefig('bravura_monthly_precipitation_with_histogram_1950_2003.png', format='png')
-    
-    # Show the plot
-    plt.show()
+    # Save the figure (and show it in interactive runs)
+    finish_figure(fig, output, show)
+    return fig
     
     
-def plot_monthly_precip(sorted_data, all_time_data, target_lat,target_lon):
+@profiled()
+def plot_monthly_precip(series, target_lat,target_lon, output='bravura_yearly_precipitation_per_month_1950_2003.png', show=True, fig=None, time_index=None):
+    import matplotlib.pyplot as plt
+
     # Create a dictionary to map months to their respective season colors
     month_colors = {
         1: ('January', '#0000FF'),    # January - Winter (Dark Blue)
@@ -135,24 +98,21 @@ def plot_monthly_precip(sorted_data, all_time_data, target_lat,target_lon):
     }
     
     # Create a figure for the line plot
-    plt.figure(figsize=(12, 6))
+    fig, ax = figure_axes(fig, figsize=(12, 6))
        
-    # Extract years from time data
-    years = list(set([int(date.split('-')[0]) for date in all_time_data]))
-    
-    # Split the data into batches of 12 months each
-    batch_size = 12
-    year_batches = [sorted_data[i:i+batch_size] for i in range(0, len(sorted_data), batch_size)]
-    
-    for y in range(0,len(year_batches)):
-        # Plot each month's accumulated precipitation
-        bottom=0
-        for m in range(0, 12):
-            precip_value = year_batches[y][m][1]
-            year=int(year_batches[y][m][0].split('-')[0])
-            month_name,color=month_colors[m+1]
-            plt.bar(year, precip_value, color=color,bottom=bottom)
-            bottom += precip_value
+    # Build the year x month matrix once. Months missing from the series
+    # (partial years, gaps) stay at zero instead of shifting the stack.
+    if time_index is None:
+        time_index = TimeIndex(series['time'])
+    years, year_month = time_index.year_month_matrix(series['precip'])
+    
+    # Bottom of every month's bar is the sum of the previous months of that year
+    bottoms = np.cumsum(year_month, axis=1) - year_month
+    
+    # Plot each month's accumulated precipitation as one layer of stacked bars
+    for m in range(0, 12):
+        month_name,color=month_colors[m+1]
+        plt.bar(years, year_month[:, m], color=color, bottom=bottoms[:, m])
         
     
     plt.xlabel('Year', fontsize=14)
@@ -170,31 +130,26 @@ def plot_monthly_precip(sorted_data, all_time_data, target_lat,target_lon):
     
     plt.tight_layout()
     
-    # Save the figure
-    plt.savefig('bravura_yearly_precipitation_per_month_1950_2003.png', format='png')
+    # Save the figure (and show it in interactive runs)
+    finish_figure(fig, output, show)
+    return fig
     
-    plt.show()    
-    
-def plot_yearly_precip(all_time_data, all_precip_data, target_lat,target_lon):
-    # Calculate accumulated rainfall per year
-    years = set(date.split('-')[0] for date in all_time_data)
-    accumulated_rain_per_year = {}
-    for year in years:
-        year_indices = [i for i, date in enumerate(all_time_data) if date.startswith(year)]
-        year_rainfall = sum(all_precip_data[i] for i in year_indices)
-        accumulated_rain_per_year[year] = year_rainfall
-    
-    # Create a list of (year, accumulated precipitation) tuples and sort it by year
-    yearly_data = sorted(list(accumulated_rain_per_year.items()), key=lambda x: int(x[0]))
-    # Extract the sorted years and accumulated rainfall values
-    years_list, rainfall_list = zip(*yearly_data)
+@profiled()
+def plot_yearly_precip(all_time_data, all_precip_data, target_lat,target_lon, output='bravura_yearly_precipitation_with_histogram_1950_2003.png', show=True, fig=None, time_index=None):
+    import matplotlib.pyplot as plt
+
+    # Calculate accumulated rainfall per year (years in order, as labels)
+    if time_index is None:
+        time_index = TimeIndex(all_time_data)
+    years_list = [str(year) for year in time_index.years]
+    rainfall_list = time_index.yearly_sum(all_precip_data)
     
     # Find the year(s) with maximum and minimum accumulated precipitation
     max_rainfall_year = years_list[np.argmax(rainfall_list)]
     min_rainfall_year = years_list[np.argmin(rainfall_list)]
     
     # Create a figure with two subplots
-    fig, (ax0, ax1) = plt.subplots(nrows=1, ncols=2, figsize=(16, 9), gridspec_kw={'width_ratios': [3, 1]}, sharey=True)
+    fig, (ax0, ax1) = figure_axes(fig, nrows=1, ncols=2, figsize=(16, 9), gridspec_kw={'width_ratios': [3, 1]}, sharey=True)
     
     # Plot yearly accumulated precipitation data on the left subplot
     ax0.bar(years_list, rainfall_list, color='tab:blue', alpha=0.7, label='Yearly Accumulated Precipitation')
@@ -232,36 +187,72 @@ def plot_yearly_precip(all_time_data, all_precip_data, target_lat,target_lon):
     # Adjust the layout
     plt.tight_layout()
     
-    # Save the figure
-    plt.savefig('bravura_yearly_precipitation_with_histogram_1950_2003.png', format='png')
-    
-    # Show the plot
-    plt.show()
+    # Save the figure (and show it in interactive runs)
+    finish_figure(fig, output, show)
+    return fig
 
 
-def main(target_lat, target_lon, data_directory):
+def main(target_lat, target_lon, data_directory, workers=1, interp='nearest', cache=True):
     # Get the absolute path to the data directory
     directory = os.path.join(os.path.dirname(__file__), data_directory)
 
-    sorted_data, all_time_data, all_precip_data = read_inputs(directory,target_lat,target_lon)
+    # Repeated queries of the same grid cell come from the series cache (see pt02_cache.py)
+    if cache:
+        series = cached_read_inputs(directory,target_lat,target_lon,workers=workers,interp=interp)
+    else:
+        series = read_inputs(directory,target_lat,target_lon,workers=workers,interp=interp)
+    all_time_data, all_precip_data = series['time'], series['precip']
+    # Year/month offsets shared by all the aggregations and plots
+    time_index = TimeIndex(all_time_data)
 
 
-    plot_monthly_precip_histogram(all_time_data, all_precip_data,target_lat,target_lon)
-    plot_monthly_precip(sorted_data, all_time_data, target_lat,target_lon)
-    plot_yearly_precip(all_time_data, all_precip_data, target_lat,target_lon)
-    
+    plot_monthly_precip_histogram(all_time_data, all_precip_data,target_lat,target_lon, time_index=time_index)
+    plot_monthly_precip(series, target_lat,target_lon, time_index=time_index)
+    plot_yearly_precip(all_time_data, all_precip_data, target_lat,target_lon, time_index=time_index)
+
+
+def main_points(points_file, data_directory, output, workers=1, interp='nearest'):
+    # Extract the series of every point in the file in a single pass over the
+    # NetCDF files and save them as a points x time CSV table
+    directory = os.path.join(os.path.dirname(__file__), data_directory)
+
+    target_lats, target_lons = load_points_file(points_file)
+    all_time_data, precip_matrix, grid_points = read_points(directory, target_lats, target_lons, workers=workers, interp=interp)
+    write_points_csv(output, target_lats, target_lons, all_time_data, precip_matrix, grid_points)
+    print(f"Saved {len(target_lats)} series of {len(all_time_data)} timesteps to {output}")
 
 
 if __name__ == "__main__":
+    # Subcommands: extract, stats and plot (see pt02_commands.py)
+    command_args = parse_command_line("Process precipitation data.")
+    if command_args is not None:
+        directory = os.path.join(os.path.dirname(__file__), command_args.data_directory)
+        # --profile: per-stage timing report of the run (see pt02_profile.py)
+        with profile_run(command_args.profile, run=dict(vars(command_args), script=os.path.basename(__file__))):
+            if not run_data_command(directory, command_args):
+                main(command_args.lat, command_args.lon, command_args.data_directory, command_args.workers,
+                     command_args.interp, not command_args.no_cache)
+        raise SystemExit
+
+    # Original flags, without a subcommand
     parser = argparse.ArgumentParser(description="Process precipitation data.")
-    parser.add_argument("--lat", type=float, required=True, help="Latitude")
-    parser.add_argument("--lon", type=float, required=True, help="Longitude")
+    parser.add_argument("--lat", type=float, help="Latitude")
+    parser.add_argument("--lon", type=float, help="Longitude")
+    parser.add_argument("--points-file", type=str, help="CSV file with lat,lon pairs to extract in one pass (instead of --lat/--lon)")
+    parser.add_argument("--output", type=str, default="precip_points.csv", help="Output CSV for --points-file")
     parser.add_argument("--data-directory", type=str, required=True, help="Relative path to data directory")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used to read the NetCDF files")
+    parser.add_argument("--interp", type=str, default='nearest', choices=INTERP_METHODS,
+                        help="Nearest grid cell or interpolation between the surrounding cells")
+    parser.add_argument("--no-cache", action='store_true', help="Always read the NetCDF files instead of the series cache")
+    parser.add_argument("--profile", type=str, nargs='?', const=DEFAULT_REPORT,
+                        help="Save a per-stage timing/memory report to this JSON file (default %(const)s)")
     args = parser.parse_args()
 
-    main(args.lat, args.lon, args.data_directory)
-    
-    
-    
-    
-
+    if not args.points_file and (args.lat is None or args.lon is None):
+        parser.error("either --lat and --lon or --points-file is required")
+    with profile_run(args.profile, run=dict(vars(args), script=os.path.basename(__file__))):
+        if args.points_file:
+            main_points(args.points_file, args.data_directory, args.output, args.workers, args.interp)
+        else:
+            main(args.lat, args.lon, args.data_directory, args.workers, args.interp, not args.no_cache)
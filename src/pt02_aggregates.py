@@ -0,0 +1,209 @@
+import argparse
+import os
+import numpy as np
+
+from pt02_reader import decode_time
+from pt02_store import consolidate, ConsolidatedStore
+from pt02_timeindex import TimeIndex
+from pt02_rasters import save_rasters
+
+
+# Running per-cell aggregates of a consolidated store, updated incrementally.
+# The state (saved next to the store) records how many timesteps it has
+# seen; an update reads only the timesteps appended to the store since then
+# (see pt02_store.append_timesteps) and folds them in:
+#  - annual totals and the number of timesteps of every year (the last year
+#    can be partial and is completed by later updates)
+#  - count, mean and M2 of all values and of every calendar month, merged
+#    with the parallel form of Welford's algorithm
+#  - min, max and a fixed-bin histogram of the values per cell, from which
+#    the percentiles are estimated
+# A full rebuild of the store (new build_id) recomputes the state from scratch.
+
+STATE_NAME = 'aggregates.npz'
+DEFAULT_BIN_WIDTH = 2.0
+DEFAULT_MAX_VALUE = 1000.0
+PERCENTILES = [25, 50, 75]
+
+
+def batch_moments(values, axis=0):
+    # Count, mean and M2 (sum of squared deviations) ignoring NaN
+    count = np.sum(~np.isnan(values), axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(values, axis=axis) / count
+        m2 = np.nansum((values - np.expand_dims(mean, axis)) ** 2, axis=axis)
+    return count, np.where(count > 0, mean, 0.0), m2
+
+
+def merge_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    # Combine the moments of two disjoint sets of values (Chan et al.)
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    with np.errstate(invalid='ignore', divide='ignore'):
+        share = np.where(count > 0, count_b / count, 0.0)
+        mean = mean_a + delta * share
+        m2 = m2_a + m2_b + delta ** 2 * count_a * share
+    return count, mean, m2
+
+
+class RunningAggregates:
+
+    def __init__(self, grid_shape, build_id=None, bin_width=DEFAULT_BIN_WIDTH, max_value=DEFAULT_MAX_VALUE):
+        self.build_id = build_id
+        self.n_time = 0
+        self.years = np.zeros(0, dtype=np.int64)
+        self.year_steps = np.zeros(0, dtype=np.int64)
+        self.annual = np.zeros((0,) + grid_shape)
+        self.count = np.zeros(grid_shape, dtype=np.int64)
+        self.mean = np.zeros(grid_shape)
+        self.m2 = np.zeros(grid_shape)
+        self.month_count = np.zeros((12,) + grid_shape, dtype=np.int64)
+        self.month_mean = np.zeros((12,) + grid_shape)
+        self.month_m2 = np.zeros((12,) + grid_shape)
+        self.min = np.full(grid_shape, np.inf)
+        self.max = np.full(grid_shape, -np.inf)
+        # Bins of width bin_width from 0; the last one holds everything above max_value
+        self.bin_edges = np.arange(0, max_value + bin_width, bin_width)
+        self.hist = np.zeros(grid_shape + (len(self.bin_edges),), dtype=np.int32)
+
+    FIELDS = ['n_time', 'years', 'year_steps', 'annual', 'count', 'mean', 'm2', 'month_count',
+              'month_mean', 'month_m2', 'min', 'max', 'bin_edges', 'hist']
+
+    def save(self, path):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, build_id=np.array(self.build_id or ''), **{name: getattr(self, name) for name in self.FIELDS})
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as state:
+            aggregates = cls(state['mean'].shape, str(state['build_id']) or None)
+            for name in cls.FIELDS:
+                setattr(aggregates, name, state[name])
+        aggregates.n_time = int(aggregates.n_time)
+        return aggregates
+
+    def update(self, all_time_data, values):
+        # Fold in a (time, lat, lon) block of values that follows everything seen so far
+        if len(all_time_data) == 0:
+            return
+        time_index = TimeIndex(all_time_data)
+
+        # Annual totals: the first new year may continue the last known one
+        new_annual = time_index.yearly_sum(np.nan_to_num(values, nan=0.0).astype(np.float64))
+        new_steps = np.diff(np.r_[time_index.year_starts, len(all_time_data)])
+        if len(self.years) and self.years[-1] == time_index.years[0]:
+            self.annual[-1] += new_annual[0]
+            self.year_steps[-1] += new_steps[0]
+            new_annual, new_steps, new_years = new_annual[1:], new_steps[1:], time_index.years[1:]
+        else:
+            new_years = time_index.years
+        self.years = np.r_[self.years, new_years]
+        self.year_steps = np.r_[self.year_steps, new_steps]
+        self.annual = np.concatenate([self.annual, new_annual])
+
+        # Moments of all values and of every calendar month
+        self.count, self.mean, self.m2 = merge_moments(self.count, self.mean, self.m2,
+                                                       *batch_moments(values.astype(np.float64)))
+        for month in np.unique(time_index.month_of_step):
+            month_values = values[time_index.month_of_step == month].astype(np.float64)
+            (self.month_count[month], self.month_mean[month],
+             self.month_m2[month]) = merge_moments(self.month_count[month], self.month_mean[month],
+                                                   self.month_m2[month], *batch_moments(month_values))
+
+        # Extremes and histogram sketch
+        with np.errstate(invalid='ignore'):
+            self.min = np.fmin(self.min, np.nanmin(values, axis=0, initial=np.inf))
+            self.max = np.fmax(self.max, np.nanmax(values, axis=0, initial=-np.inf))
+        valid = ~np.isnan(values)
+        bins = np.clip(np.searchsorted(self.bin_edges, values[valid], side='right') - 1, 0, len(self.bin_edges) - 1)
+        cells = np.nonzero(valid)
+        flat_cells = np.ravel_multi_index(cells[1:], self.mean.shape)
+        self.hist += np.bincount(flat_cells * len(self.bin_edges) + bins,
+                                 minlength=self.hist.size).reshape(self.hist.shape).astype(np.int32)
+        self.n_time += len(all_time_data)
+
+    def percentiles(self, percentiles=PERCENTILES):
+        # Percentile estimates per cell from the histogram sketch, interpolated
+        # linearly inside the bin and clipped to the exact min and max
+        cumulative = np.cumsum(self.hist, axis=-1)
+        total = cumulative[..., -1]
+        widths = np.diff(np.r_[self.bin_edges, self.bin_edges[-1]])
+        results = []
+        for q in percentiles:
+            target = q / 100 * total
+            k = np.minimum((cumulative < target[..., np.newaxis]).sum(axis=-1), len(self.bin_edges) - 1)
+            before = np.where(k > 0, np.take_along_axis(cumulative, np.maximum(k - 1, 0)[..., np.newaxis], -1)[..., 0], 0)
+            in_bin = np.take_along_axis(self.hist, k[..., np.newaxis], -1)[..., 0]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                value = self.bin_edges[k] + np.where(in_bin > 0, (target - before) / in_bin, 0.0) * widths[k]
+            results.append(np.where(total > 0, np.clip(value, self.min, self.max), np.nan))
+        return results
+
+    def rasters(self):
+        # Summary rasters and stacks for save_rasters
+        missing = self.count == 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = np.where(self.count > 1, self.m2 / (self.count - 1), np.nan)
+            month_variance = np.where(self.month_count > 1, self.month_m2 / (self.month_count - 1), np.nan)
+        rasters = {
+            'count': self.count.astype(np.float64),
+            'mean': np.where(missing, np.nan, self.mean),
+            'variance': variance,
+            'std': np.sqrt(variance),
+            'min': np.where(missing, np.nan, self.min),
+            'max': np.where(missing, np.nan, self.max),
+        }
+        for q, values in zip(PERCENTILES, self.percentiles()):
+            rasters[f'p{q}'] = values
+        annual = np.where(missing, np.nan, self.annual)
+        stacks = {
+            'annual_total': ('year', self.years.astype(np.int32), annual),
+            'month_mean': ('month', np.arange(1, 13, dtype=np.int32), np.where(self.month_count > 0, self.month_mean, np.nan)),
+            'month_std': ('month', np.arange(1, 13, dtype=np.int32), np.sqrt(month_variance)),
+        }
+        return rasters, stacks
+
+
+def update_aggregates(directory, product='mensal', rebuild=False):
+    # Bring the store and the running aggregates up to date. Only the
+    # timesteps added since the last update are read, unless the store was
+    # rebuilt from scratch or rebuild is set. Returns the store and aggregates.
+    store = ConsolidatedStore(consolidate(directory, product))
+    state_path = os.path.join(store.store_dir, STATE_NAME)
+    build_id = store.manifest['build_id']
+
+    aggregates = None
+    if not rebuild and os.path.exists(state_path):
+        aggregates = RunningAggregates.load(state_path)
+        if aggregates.build_id != build_id or aggregates.n_time > len(store.time):
+            aggregates = None
+    if aggregates is None:
+        aggregates = RunningAggregates((len(store.lat), len(store.lon)), build_id)
+
+    # Walk the blocks and read only the part after the timesteps already seen
+    offset = 0
+    for block in store.blocks:
+        start = max(aggregates.n_time - offset, 0)
+        if start < block.shape[-1]:
+            new_time = decode_time(store.time[offset + start:offset + block.shape[-1]], product)
+            aggregates.update(new_time, np.moveaxis(np.asarray(block[:, :, start:]), -1, 0))
+        offset += block.shape[-1]
+
+    aggregates.save(state_path)
+    return store, aggregates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update the store and the running per-cell aggregates with new timesteps.")
+    parser.add_argument("--data-directory", type=str, required=True, help="Path to the NetCDF data directory")
+    parser.add_argument("--product", type=str, default='mensal', choices=['mensal', 'diario'], help="PT02 product")
+    parser.add_argument("--rebuild", action='store_true', help="Recompute the aggregates from the whole store")
+    parser.add_argument("--output", type=str, default='aggregates.nc', help="Output NetCDF file (.nc) or NPY directory")
+    args = parser.parse_args()
+
+    store, aggregates = update_aggregates(args.data_directory, args.product, args.rebuild)
+    rasters, stacks = aggregates.rasters()
+    save_rasters(args.output, store.lat, store.lon, rasters, stacks,
+                 attributes={'source': args.data_directory, 'n_time': aggregates.n_time})
+    print(f"Aggregates of {aggregates.n_time} timesteps ({len(aggregates.years)} years) saved to {args.output}")
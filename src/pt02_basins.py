@@ -0,0 +1,247 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import numpy as np
+from scipy import sparse
+
+from pt02_reader import read_cube
+from pt02_store import STORE_DIRNAME
+from pt02_export import EXPORT_FORMATS, export_series, source_hashes
+from pt02_ndvi import open_ndvi
+
+
+# Basin (polygon) averaged precipitation series.
+# Every basin is turned once into a sparse row of cell weights: the area of
+# the overlap between the basin and each grid cell, scaled by cos(lat) so the
+# weights are proportional to true area. The rows are cached on disk per
+# basin and grid, and the series of all basins then come from a single
+# sparse matrix - cube product. Sea cells (NaN) and missing values are left
+# out and the remaining weights renormalised at every timestep.
+
+WEIGHTS_DIRNAME = 'weights'
+
+
+def polygon_area(vertices):
+    # Shoelace area of a closed or open (x, y) ring
+    x, y = vertices[:, 0], vertices[:, 1]
+    return 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+
+def clip_polygon(vertices, x_min, x_max, y_min, y_max):
+    # Sutherland-Hodgman clipping of a ring to an axis aligned rectangle
+    edges = [(0, x_min, 1), (0, x_max, -1), (1, y_min, 1), (1, y_max, -1)]
+    output = [tuple(vertex) for vertex in vertices]
+    for axis, bound, side in edges:
+        if not output:
+            break
+        points, output = output, []
+        for k, current in enumerate(points):
+            previous = points[k - 1]
+            current_in = (current[axis] - bound) * side >= 0
+            previous_in = (previous[axis] - bound) * side >= 0
+            if current_in != previous_in:
+                t = (bound - previous[axis]) / (current[axis] - previous[axis])
+                output.append(tuple(p + t * (c - p) for p, c in zip(previous, current)))
+            if current_in:
+                output.append(current)
+    return np.array(output, dtype=np.float64).reshape(-1, 2)
+
+
+def cell_edges(coords):
+    # Cell boundaries of a regular or irregular 1D axis (ascending or descending)
+    coords = np.asarray(coords, dtype=np.float64)
+    middles = (coords[1:] + coords[:-1]) / 2
+    return np.r_[2 * coords[0] - middles[0], middles, 2 * coords[-1] - middles[-1]]
+
+
+def polygon_weights(rings, lat_values, lon_values):
+    # Flat cell indexes and area weights of one polygon. rings is a list of
+    # (x=lon, y=lat) vertex arrays: the exterior ring first, then any holes.
+    lat_edges = cell_edges(lat_values)
+    lon_edges = cell_edges(lon_values)
+    exterior = rings[0]
+
+    # Only the cells touching the bounding box of the exterior ring are clipped
+    lat_lo, lat_hi = np.minimum(lat_edges[:-1], lat_edges[1:]), np.maximum(lat_edges[:-1], lat_edges[1:])
+    lon_lo, lon_hi = np.minimum(lon_edges[:-1], lon_edges[1:]), np.maximum(lon_edges[:-1], lon_edges[1:])
+    rows = np.flatnonzero((lat_hi > exterior[:, 1].min()) & (lat_lo < exterior[:, 1].max()))
+    cols = np.flatnonzero((lon_hi > exterior[:, 0].min()) & (lon_lo < exterior[:, 0].max()))
+
+    indices = []
+    weights = []
+    for i in rows:
+        for j in cols:
+            overlap = 0.0
+            for k, ring in enumerate(rings):
+                area = polygon_area(clip_polygon(ring, lon_lo[j], lon_hi[j], lat_lo[i], lat_hi[i]))
+                overlap += area if k == 0 else -area
+            if overlap > 0:
+                indices.append(i * len(lon_values) + j)
+                weights.append(overlap * np.cos(np.radians(lat_values[i])))
+    return np.array(indices, dtype=np.int64), np.array(weights, dtype=np.float64)
+
+
+def weights_key(rings, lat_values, lon_values):
+    # Cache key of a basin on a grid: hash of its vertices and of the grid axes
+    sha = hashlib.sha256()
+    for array in list(rings) + [lat_values, lon_values]:
+        sha.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+        sha.update(b'|')
+    return sha.hexdigest()
+
+
+def cached_polygon_weights(rings, lat_values, lon_values, cache_dir=None):
+    # polygon_weights, read from / saved to cache_dir when one is given
+    if cache_dir is None:
+        return polygon_weights(rings, lat_values, lon_values)
+
+    cache_path = os.path.join(cache_dir, weights_key(rings, lat_values, lon_values) + '.npz')
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            return cached['indices'], cached['weights']
+
+    indices, weights = polygon_weights(rings, lat_values, lon_values)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = cache_path + '.tmp.npz'
+    np.savez(tmp_path, indices=indices, weights=weights)
+    os.replace(tmp_path, cache_path)
+    return indices, weights
+
+
+def weight_matrix(basins, lat_values, lon_values, cache_dir=None):
+    # Sparse (basin, cell) weight matrix of a {name: rings or (lat, lon) mask} dict.
+    # A mask is used as given: boolean cells or per-cell weights on the grid.
+    n_cells = len(lat_values) * len(lon_values)
+    rows, cols, data = [], [], []
+    for row, basin in enumerate(basins.values()):
+        if isinstance(basin, np.ndarray):
+            if basin.shape != (len(lat_values), len(lon_values)):
+                raise ValueError(f"Basin mask shape {basin.shape} does not match the "
+                                 f"{len(lat_values)}x{len(lon_values)} grid")
+            indices = np.flatnonzero(basin)
+            weights = basin.ravel()[indices].astype(np.float64)
+        else:
+            indices, weights = cached_polygon_weights(basin, lat_values, lon_values, cache_dir)
+        rows.append(np.full(len(indices), row))
+        cols.append(indices)
+        data.append(weights)
+    return sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(len(basins), n_cells))
+
+
+def weighted_series(weights, cube):
+    # Basin series (basin, time) of a (time, lat, lon) cube: one sparse product
+    # for the weighted totals and one for the weight of the valid cells
+    flat = cube.reshape(len(cube), -1).T.astype(np.float64)
+    valid = ~np.isnan(flat)
+    totals = weights @ np.where(valid, flat, 0.0)
+    covered = weights @ valid.astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(covered > 0, totals / covered, np.nan)
+
+
+def _geojson_rings(geometry):
+    # Exterior ring and holes of every polygon in a GeoJSON geometry
+    if geometry['type'] == 'Polygon':
+        return [[np.asarray(ring, dtype=np.float64)[:, :2] for ring in geometry['coordinates']]]
+    if geometry['type'] == 'MultiPolygon':
+        return [[np.asarray(ring, dtype=np.float64)[:, :2] for ring in polygon]
+                for polygon in geometry['coordinates']]
+    raise ValueError(f"Unsupported geometry type {geometry['type']}")
+
+
+def load_basins(path):
+    # Read basins into an ordered {name: rings or mask} dict from
+    #  - GeoJSON (.geojson/.json): Polygon/MultiPolygon features, named by their
+    #    'name'/'BasinID'/'id' property (MultiPolygon parts get a '_k' suffix)
+    #  - CSV with name, lon, lat columns: one row per vertex, in ring order
+    #  - NPY: a (lat, lon) or (basin, lat, lon) mask/weight array on the grid
+    #  - the NDVI statistics pickles (data_ndvi/*.pkl) or their columnar stores
+    #    (see pt02_ndvi.py): those only keep the area and centroid of every
+    #    basin, so each one is approximated by a square of the same area around
+    #    its centroid in the first scene
+    basins = {}
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension in ('.geojson', '.json'):
+        with open(path) as f:
+            features = json.load(f)['features']
+        for i, feature in enumerate(features):
+            properties = feature.get('properties') or {}
+            name = next((str(properties[key]) for key in ('name', 'BasinID', 'id') if key in properties), str(i))
+            polygons = _geojson_rings(feature['geometry'])
+            for k, rings in enumerate(polygons):
+                basins[name if len(polygons) == 1 else f"{name}_{k}"] = rings
+
+    elif extension == '.csv':
+        vertices = {}
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                row = {key.strip().lower(): value for key, value in row.items()}
+                name = (row.get('name') or row.get('basin') or row.get('id')).strip()
+                vertices.setdefault(name, []).append((float(row.get('lon', row.get('longitude'))),
+                                                     float(row.get('lat', row.get('latitude')))))
+        basins = {name: [np.array(ring)] for name, ring in vertices.items()}
+
+    elif extension == '.npy':
+        masks = np.load(path)
+        masks = masks[np.newaxis] if masks.ndim == 2 else masks
+        basins = {str(i): mask for i, mask in enumerate(masks)}
+
+    elif extension == '.pkl' or os.path.isdir(path):
+        store = open_ndvi(path)
+        area, centroid_x, centroid_y = (store.columns[name] for name in ('Area', 'CentroidX', 'CentroidY'))
+        for i, basin in enumerate(store.basin_ids):
+            first = np.argmax(~np.isnan(area[i]))
+            half = np.sqrt(area[i, first]) / 2
+            x, y = centroid_x[i, first], centroid_y[i, first]
+            basins[str(basin)] = [np.array([(x - half, y - half), (x + half, y - half),
+                                            (x + half, y + half), (x - half, y + half)])]
+
+    else:
+        raise ValueError(f"Unsupported basin file {path}")
+    return basins
+
+
+def basin_series(directory, basins, product='mensal', workers=1):
+    # Area weighted series of every basin. Returns the datetime64 time axis,
+    # the (basin, time) matrix and the number of cells each basin touches.
+    all_time_data, lat_values, lon_values, cube = read_cube(directory, product, workers)
+    weights = weight_matrix(basins, lat_values, lon_values,
+                            cache_dir=os.path.join(directory, STORE_DIRNAME, WEIGHTS_DIRNAME))
+    return all_time_data, weighted_series(weights, cube), np.diff(weights.indptr)
+
+
+def write_basins_csv(path, names, all_time_data, series, n_cells):
+    # One row per basin: name and number of cells followed by the series
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['basin', 'n_cells'] + list(np.datetime_as_string(all_time_data)))
+        for name, cells, values in zip(names, n_cells, series):
+            writer.writerow([name, cells] + [f"{value:.6g}" for value in values])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract basin averaged precipitation series.")
+    parser.add_argument("--basins-file", type=str, required=True,
+                        help="GeoJSON, CSV (name,lon,lat vertices), NPY mask, NDVI statistics .pkl or NDVI store")
+    parser.add_argument("--data-directory", type=str, required=True, help="Path to the NetCDF data directory")
+    parser.add_argument("--product", type=str, default='mensal', choices=['mensal', 'diario'], help="PT02 product")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used to read the NetCDF files")
+    parser.add_argument("--format", type=str, default='csv', choices=['csv'] + EXPORT_FORMATS,
+                        help="Output format (npy/arrow/parquet write an export directory, see pt02_export.py)")
+    parser.add_argument("--output", type=str, default='basins.csv', help="Output CSV file or export directory")
+    args = parser.parse_args()
+
+    basins = load_basins(args.basins_file)
+    all_time_data, series, n_cells = basin_series(args.data_directory, basins, args.product, args.workers)
+    if args.format == 'csv':
+        write_basins_csv(args.output, list(basins), all_time_data, series, n_cells)
+    else:
+        export_series(args.output, all_time_data, series, list(basins),
+                      [{'name': name, 'n_cells': int(cells)} for name, cells in zip(basins, n_cells)], args.format,
+                      {'product': args.product, 'basins_file': os.path.abspath(args.basins_file),
+                       'sources': source_hashes(args.data_directory, args.product)})
+    print(f"Saved {len(basins)} basin series to {args.output}")
@@ -0,0 +1,152 @@
+import hashlib
+import os
+from collections import OrderedDict
+import numpy as np
+
+from pt02_reader import PRECIP_VAR, list_product_files, nearest_index, read_inputs
+from pt02_store import STORE_DIRNAME
+from pt02_interp import read_grid
+from pt02_profile import profiled
+
+
+# Memoized site series for repeated interactive queries.
+# A series is cached under (dataset fingerprint, product, snapped grid index,
+# variable): coordinates snapping to the same cell share one entry, and any
+# change to the NetCDF files changes the fingerprint so old entries are
+# never returned. Entries live in an in-process LRU bounded by a count and a
+# byte limit, backed by NPY files under the data directory's store folder.
+
+SERIES_DIRNAME = 'series'
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_DISK_BYTES = 256 * 1024 * 1024
+
+
+def dataset_fingerprint(directory, product='mensal'):
+    # Hash of the name, size and modification time of every product file
+    sha = hashlib.sha256(product.encode())
+    for file_path in list_product_files(directory, product):
+        stat = os.stat(file_path)
+        sha.update(f"{os.path.basename(file_path)}:{stat.st_size}:{stat.st_mtime_ns}|".encode())
+    return sha.hexdigest()
+
+
+class SeriesCache:
+    # LRU of series arrays with hit/miss counters and an optional disk level
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES,
+                 cache_dir=None, max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha256(repr(key).encode()).hexdigest() + '.npy')
+
+    def get(self, key):
+        # Cached value of key or None, refreshing its position in the LRU
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+        if self.cache_dir is not None:
+            path = self._disk_path(key)
+            try:
+                value = np.load(path, allow_pickle=False)
+            except (OSError, ValueError):
+                value = None
+            if value is not None:
+                os.utime(path)
+                self.disk_hits += 1
+                self._remember(key, value)
+                return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._disk_path(key)
+            tmp_path = path + '.tmp.npy'
+            np.save(tmp_path, value, allow_pickle=False)
+            os.replace(tmp_path, path)
+            self._prune_disk()
+
+    def _remember(self, key, value):
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key).nbytes
+        # Shared by every caller of the key, so it must not be changed in place
+        value.flags.writeable = False
+        self.entries[key] = value
+        self.nbytes += value.nbytes
+        while self.entries and (len(self.entries) > self.max_entries or self.nbytes > self.max_bytes):
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+
+    def _prune_disk(self):
+        # Remove the least recently used files once the folder is over its limit
+        files = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.npy')]
+        stats = sorted(((os.stat(path), path) for path in files), key=lambda entry: entry[0].st_mtime_ns)
+        total = sum(stat.st_size for stat, _ in stats)
+        for stat, path in stats:
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            total -= stat.st_size
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.nbytes, 'hits': self.hits,
+                'disk_hits': self.disk_hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+# Process wide cache of every data directory, created on first use
+_caches = {}
+# Grid coordinates per dataset fingerprint, to snap queries without opening a file
+_grids = {}
+
+
+def get_cache(directory, **limits):
+    # The series cache of a data directory (limits apply when it is created)
+    cache_dir = os.path.join(directory, STORE_DIRNAME, SERIES_DIRNAME)
+    if cache_dir not in _caches:
+        _caches[cache_dir] = SeriesCache(cache_dir=cache_dir, **limits)
+    return _caches[cache_dir]
+
+
+@profiled()
+def cached_read_inputs(directory, target_lat, target_lon, product='mensal', workers=1, interp='nearest', cache=None):
+    # read_inputs through the series cache. Interpolated series depend on the
+    # exact coordinates rather than on one cell, so those are not cached.
+    if interp != 'nearest':
+        return read_inputs(directory, target_lat, target_lon, product, workers, interp)
+
+    cache = cache if cache is not None else get_cache(directory)
+    fingerprint = dataset_fingerprint(directory, product)
+    if fingerprint not in _grids:
+        _grids[fingerprint] = read_grid(directory, product)
+    lat_values, lon_values = _grids[fingerprint]
+
+    lat_idx = nearest_index(lat_values, target_lat)
+    lon_idx = nearest_index(lon_values, target_lon)
+    key = (fingerprint, product, lat_idx, lon_idx, PRECIP_VAR)
+    series = cache.get(key)
+    if series is None:
+        # Read at the cell centre, so the cell is the one the key refers to
+        series = read_inputs(directory, lat_values[lat_idx], lon_values[lon_idx], product, workers)
+        cache.put(key, series)
+    return series
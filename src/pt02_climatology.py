@@ -0,0 +1,63 @@
+import argparse
+import numpy as np
+
+from pt02_reader import read_cube
+from pt02_timeindex import TimeIndex
+from pt02_rasters import save_rasters
+from pt02_profile import profiled
+
+
+# Per-cell climatology of the whole PT02 grid. The statistics are the ones
+# plot_yearly_precip prints for a single point, computed for every cell at
+# once with axis-wise NumPy reductions over the (year, lat, lon) cube.
+
+PERCENTILES = [25, 50, 75]
+
+
+@profiled()
+def annual_totals(all_time_data, cube):
+    # Reduce a (time, lat, lon) cube into (year, lat, lon) totals in one pass
+    time_index = TimeIndex(all_time_data)
+    return time_index.years, time_index.yearly_sum(cube)
+
+
+@profiled()
+def climatology(annual):
+    # Summary rasters over the year axis of the annual totals. Variance and
+    # standard deviation use ddof=1 like pandas; norm_mu/norm_std are the
+    # maximum likelihood normal fit (scipy.stats.norm.fit, ddof=0).
+    p25, p50, p75 = np.percentile(annual, PERCENTILES, axis=0)
+    return {
+        'mean': annual.mean(axis=0),
+        'median': p50,
+        'min': annual.min(axis=0),
+        'max': annual.max(axis=0),
+        'variance': annual.var(axis=0, ddof=1),
+        'std': annual.std(axis=0, ddof=1),
+        'p25': p25,
+        'p50': p50,
+        'p75': p75,
+        'norm_mu': annual.mean(axis=0),
+        'norm_std': annual.std(axis=0, ddof=0),
+    }
+
+
+def grid_climatology(directory, product='mensal', workers=1):
+    # Read the cube once and return the grid, the annual totals and the summary rasters
+    all_time_data, lat_values, lon_values, cube = read_cube(directory, product, workers)
+    years, annual = annual_totals(all_time_data, cube.astype(np.float64))
+    return lat_values, lon_values, years, annual, climatology(annual)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute annual totals and climatology rasters for every grid cell.")
+    parser.add_argument("--data-directory", type=str, required=True, help="Path to the NetCDF data directory")
+    parser.add_argument("--product", type=str, default='mensal', choices=['mensal', 'diario'], help="PT02 product")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used to read the NetCDF files")
+    parser.add_argument("--output", type=str, default='climatology.nc', help="Output NetCDF file (.nc) or NPY directory")
+    args = parser.parse_args()
+
+    lat_values, lon_values, years, annual, stats = grid_climatology(args.data_directory, args.product, args.workers)
+    save_rasters(args.output, lat_values, lon_values, stats, stacks={'annual_total': ('year', years, annual)},
+                 attributes={'source': args.data_directory, 'first_year': int(years[0]), 'last_year': int(years[-1])})
+    print(f"Saved climatology of {len(years)} years for {len(lat_values)}x{len(lon_values)} cells to {args.output}")
@@ -0,0 +1,150 @@
+import argparse
+import csv
+import json
+import sys
+import numpy as np
+
+from pt02_reader import read_points, load_points_file, write_points_csv
+from pt02_timeindex import PERIODS, TimeIndex
+from pt02_climatology import climatology
+from pt02_interp import INTERP_METHODS
+from pt02_export import EXPORT_FORMATS, export_series, point_metadata, source_hashes
+from pt02_profile import DEFAULT_REPORT
+
+
+# Subcommand CLI shared by both scripts. 'extract' and 'stats' only need
+# NumPy and the readers; the plotting and statistics libraries are imported
+# by the plot functions themselves, so they load only for 'plot'.
+#
+#   extract  --lat/--lon or --points-file   series as CSV, JSON or an NPY/Arrow/Parquet export
+#   stats    --lat/--lon or --points-file   annual totals or climatology per point
+#   plot     --lat/--lon                    the figures of the script
+
+COMMANDS = ['extract', 'stats', 'plot']
+
+
+def add_point_arguments(parser):
+    parser.add_argument("--lat", type=float, help="Latitude")
+    parser.add_argument("--lon", type=float, help="Longitude")
+    parser.add_argument("--points-file", type=str, help="CSV file with lat,lon pairs (instead of --lat/--lon)")
+    parser.add_argument("--data-directory", type=str, required=True, help="Relative path to data directory")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used to read the NetCDF files")
+    parser.add_argument("--interp", type=str, default='nearest', choices=INTERP_METHODS,
+                        help="Nearest grid cell or interpolation between the surrounding cells")
+    parser.add_argument("--profile", type=str, nargs='?', const=DEFAULT_REPORT,
+                        help="Save a per-stage timing/memory report to this JSON file (default %(const)s)")
+
+
+def build_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    extract = subparsers.add_parser('extract', help="Save the precipitation series of the points")
+    add_point_arguments(extract)
+    extract.add_argument("--format", type=str, default='csv', choices=['csv', 'json'] + EXPORT_FORMATS,
+                         help="Output format (npy/arrow/parquet write an export directory, see pt02_export.py)")
+    extract.add_argument("--output", type=str, default='precip_points.csv', help="Output file or export directory")
+
+    stats = subparsers.add_parser('stats', help="Save the climatology (or annual totals) of the points")
+    add_point_arguments(stats)
+    stats.add_argument("--annual", action='store_true', help="Save the annual totals instead of the statistics")
+    stats.add_argument("--period", type=str,
+                       help=f"Aggregate by this period instead of the calendar year: one of {', '.join(PERIODS)} "
+                            "or a custom 'MM-MM' month window (incomplete periods are left out)")
+    stats.add_argument("--output", type=str, default='precip_stats.csv', help="Output CSV file")
+
+    plot = subparsers.add_parser('plot', help="Draw the figures of one point")
+    add_point_arguments(plot)
+    plot.add_argument("--no-cache", action='store_true', help="Always read the NetCDF files instead of the series cache")
+    return parser
+
+
+def parse_command_line(description, argv=None):
+    # Parsed subcommand arguments, or None when the command line uses the
+    # original flags without a subcommand
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in COMMANDS:
+        return None
+    parser = build_parser(description)
+    args = parser.parse_args(argv)
+    if args.points_file is None and (args.lat is None or args.lon is None):
+        parser.error("either --lat and --lon or --points-file is required")
+    if args.command == 'plot' and args.points_file:
+        parser.error("plot takes --lat and --lon (use pt02_render.py for many sites)")
+    return args
+
+
+def command_points(args, with_names=False):
+    if args.points_file:
+        return load_points_file(args.points_file, with_names)
+    points = (np.array([args.lat]), np.array([args.lon]))
+    return points + ([f"{args.lat}_{args.lon}"],) if with_names else points
+
+
+def _json_values(values):
+    return [None if value != value else value for value in np.asarray(values, dtype=np.float64).tolist()]
+
+
+def extract_command(directory, args):
+    target_lats, target_lons, names = command_points(args, with_names=True)
+    all_time_data, precip_matrix, grid_points = read_points(directory, target_lats, target_lons,
+                                                            workers=args.workers, interp=args.interp)
+    if args.format in EXPORT_FORMATS:
+        export_series(args.output, all_time_data, precip_matrix, names,
+                      point_metadata(names, target_lats, target_lons, grid_points), args.format,
+                      {'product': 'mensal', 'interp': args.interp, 'sources': source_hashes(directory)})
+    elif args.format == 'csv':
+        write_points_csv(args.output, target_lats, target_lons, all_time_data, precip_matrix, grid_points)
+    else:
+        with open(args.output, 'w') as f:
+            json.dump({'time': np.datetime_as_string(all_time_data).tolist(),
+                       'points': [{'lat': float(target_lats[i]), 'lon': float(target_lons[i]),
+                                   'grid_lat': float(grid_points['grid_lat'][i]),
+                                   'grid_lon': float(grid_points['grid_lon'][i]),
+                                   'precip': _json_values(precip_matrix[i])} for i in range(len(target_lats))]}, f)
+    print(f"Saved {len(target_lats)} series of {len(all_time_data)} timesteps to {args.output}")
+
+
+def stats_command(directory, args):
+    # One row per point: the annual (or --period) totals, or the statistics
+    # that plot_yearly_precip prints, computed for all points at once
+    target_lats, target_lons = command_points(args)
+    all_time_data, precip_matrix, grid_points = read_points(directory, target_lats, target_lons,
+                                                            workers=args.workers, interp=args.interp)
+    time_index = TimeIndex(all_time_data)
+    if args.period:
+        # Hydrological years, seasons... compiled once into segments (see pt02_timeindex.py)
+        segments, annual = time_index.period_sum(precip_matrix.astype(np.float64), args.period, axis=1,
+                                                 complete_only=True)
+        labels = segments.labels
+        if not args.annual:
+            annual = annual[:, segments.complete]
+    else:
+        annual = time_index.yearly_sum(precip_matrix.astype(np.float64), axis=1)
+        labels = [str(year) for year in time_index.years]
+    if args.annual:
+        columns = labels
+        values = annual
+    else:
+        stats = climatology(annual.T)
+        columns = list(stats)
+        values = np.stack([stats[name] for name in columns], axis=1)
+
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['lat', 'lon', 'grid_lat', 'grid_lon'] + columns)
+        for i in range(len(target_lats)):
+            writer.writerow([target_lats[i], target_lons[i], grid_points['grid_lat'][i], grid_points['grid_lon'][i]]
+                            + [f"{value:.6g}" for value in values[i]])
+    print(f"Saved {'annual totals' if args.annual else 'statistics'} of {len(target_lats)} points to {args.output}")
+
+
+def run_data_command(directory, args):
+    # Run extract or stats; returns False for plot, which the script handles
+    if args.command == 'extract':
+        extract_command(directory, args)
+    elif args.command == 'stats':
+        stats_command(directory, args)
+    else:
+        return False
+    return True
@@ -0,0 +1,184 @@
+import argparse
+import numpy as np
+from scipy import special
+
+from pt02_reader import read_cube, encode_time
+from pt02_timeindex import TimeIndex
+from pt02_rasters import save_rasters
+
+
+# Drought and extreme precipitation indices for every PT02 cell.
+#  - SPI (standardized precipitation index) at several time scales: rolling
+#    sums from a cumulative sum, then for every calendar month a gamma
+#    distribution fitted to all cells at once (Thom's maximum likelihood
+#    approximation, with the share of zero totals as a point mass) and the
+#    fitted probabilities mapped to standard normal quantiles
+#  - return levels of the annual maximum monthly precipitation and of the
+#    annual totals, from Gumbel fits (method of moments)
+#  - drought events: runs of SPI at or below a threshold, found for all
+#    cells at once from the edges of the run mask
+# Everything works on (time, cells) arrays with NumPy and scipy.special, so
+# there is no per-cell distribution fitting.
+
+DEFAULT_SCALES = [1, 3, 6, 12]
+DEFAULT_RETURN_PERIODS = [2, 5, 10, 25, 50, 100]
+DEFAULT_THRESHOLD = -1.0
+DEFAULT_MIN_DURATION = 1
+# Fewer non-zero totals than this for a calendar month leaves the SPI undefined
+MIN_SAMPLES = 10
+# Euler-Mascheroni constant, for the Gumbel location
+EULER_GAMMA = 0.5772156649015329
+
+
+def rolling_sums(values, scale):
+    # Sums over the last 'scale' timesteps along axis 0; the first scale - 1
+    # steps and any window with a missing value are NaN
+    missing = np.isnan(values)
+    totals = np.cumsum(np.where(missing, 0.0, values), axis=0, dtype=np.float64)
+    counts = np.cumsum(missing, axis=0)
+    sums = np.full(values.shape, np.nan)
+    # No complete window in a series shorter than the scale
+    if scale > len(values):
+        return sums
+    sums[scale - 1] = totals[scale - 1]
+    sums[scale:] = totals[scale:] - totals[:-scale]
+    window_missing = counts.copy()
+    window_missing[scale:] -= counts[:-scale]
+    sums[window_missing > 0] = np.nan
+    return sums
+
+
+def fit_gamma(samples, min_samples=MIN_SAMPLES):
+    # Gamma shape and scale of the positive samples along axis 0, and the
+    # probability of a zero total. NaN samples are ignored.
+    valid = ~np.isnan(samples)
+    positive = valid & (samples > 0)
+    n_valid = valid.sum(axis=0)
+    n_positive = positive.sum(axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(positive, samples, 0.0).sum(axis=0) / n_positive
+        mean_log = np.where(positive, np.log(np.where(positive, samples, 1.0)), 0.0).sum(axis=0) / n_positive
+        a = np.log(mean) - mean_log
+        alpha = (1 + np.sqrt(1 + 4 * a / 3)) / (4 * a)
+        beta = mean / alpha
+        zero_probability = (n_valid - n_positive) / n_valid
+
+    undefined = (n_positive < min_samples) | ~(a > 0)
+    alpha[undefined] = np.nan
+    beta[undefined] = np.nan
+    return alpha, beta, zero_probability
+
+
+def gamma_spi(samples, alpha, beta, zero_probability):
+    # Standard normal quantiles of the samples under the fitted mixed distribution
+    with np.errstate(invalid='ignore', divide='ignore'):
+        probability = zero_probability + (1 - zero_probability) * special.gammainc(alpha, np.maximum(samples, 0) / beta)
+        return special.ndtri(np.clip(probability, 1e-6, 1 - 1e-6))
+
+
+def spi(time_index, values, scale, min_samples=MIN_SAMPLES):
+    # SPI of monthly values (time, ...) at one time scale. Every calendar
+    # month has its own fit, since a 3-month total ending in January and one
+    # ending in July have very different distributions.
+    sums = rolling_sums(values, scale)
+    index = np.full(sums.shape, np.nan)
+    for month in range(12):
+        steps = time_index.month_of_step == month
+        if not steps.any():
+            continue
+        alpha, beta, zero_probability = fit_gamma(sums[steps], min_samples)
+        month_spi = gamma_spi(sums[steps], alpha, beta, zero_probability)
+        month_spi[np.isnan(sums[steps])] = np.nan
+        index[steps] = month_spi
+    return index
+
+
+def gumbel_return_levels(maxima, return_periods):
+    # Return levels (periods, ...) of a Gumbel distribution fitted to annual
+    # maxima along axis 0 by the method of moments (NaN for cells with gaps)
+    scale = np.sqrt(6) * maxima.std(axis=0, ddof=1) / np.pi
+    location = maxima.mean(axis=0) - EULER_GAMMA * scale
+    reduced = -np.log(-np.log(1 - 1 / np.asarray(return_periods, dtype=np.float64)))
+    return location + reduced.reshape((-1,) + (1,) * np.ndim(location)) * scale
+
+
+def drought_runs(index, threshold=DEFAULT_THRESHOLD, min_duration=DEFAULT_MIN_DURATION):
+    # Drought events of an index (time, cells): runs of at least min_duration
+    # steps at or below the threshold. Returns per cell the number of events,
+    # the months in drought, the longest duration and the largest severity
+    # (sum of threshold - index over an event).
+    n_time, n_cells = index.shape
+    in_drought = index <= threshold
+
+    # Run starts and ends of every cell, from the edges of the padded mask
+    edges = np.diff(np.pad(in_drought.T.astype(np.int8), ((0, 0), (1, 1))), axis=1)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    cells, start_steps = np.divmod(starts, n_time + 1)
+    end_steps = ends % (n_time + 1)
+    durations = end_steps - start_steps
+
+    deficit = np.cumsum(np.pad(np.where(in_drought, threshold - index, 0.0).T, ((0, 0), (1, 0))), axis=1)
+    severities = deficit[cells, end_steps] - deficit[cells, start_steps]
+
+    keep = durations >= min_duration
+    cells, durations, severities = cells[keep], durations[keep], severities[keep]
+    max_duration = np.zeros(n_cells)
+    max_severity = np.zeros(n_cells)
+    np.maximum.at(max_duration, cells, durations)
+    np.maximum.at(max_severity, cells, severities)
+    return {
+        'events': np.bincount(cells, minlength=n_cells).astype(np.float64),
+        'months': np.bincount(cells, weights=durations, minlength=n_cells),
+        'max_duration': max_duration,
+        'max_severity': max_severity,
+    }
+
+
+def grid_drought(directory, scales=DEFAULT_SCALES, threshold=DEFAULT_THRESHOLD, min_duration=DEFAULT_MIN_DURATION,
+                 return_periods=DEFAULT_RETURN_PERIODS, workers=1):
+    # Read the monthly cube once and compute all the indices. Returns the grid,
+    # the time axis, the rasters and the stacks for save_rasters.
+    all_time_data, lat_values, lon_values, cube = read_cube(directory, 'mensal', workers)
+    time_index = TimeIndex(all_time_data)
+    grid_shape = cube.shape[1:]
+    values = cube.reshape(len(cube), -1).astype(np.float64)
+    sea = np.all(np.isnan(values), axis=0)
+
+    rasters = {}
+    time_axis = encode_time(all_time_data)
+    stacks = {}
+    for scale in scales:
+        index = spi(time_index, values, scale)
+        stacks[f'spi_{scale}'] = ('time', time_axis, index.reshape((-1,) + grid_shape))
+        for name, raster in drought_runs(index, threshold, min_duration).items():
+            raster[sea] = np.nan
+            rasters[f'drought_{name}_{scale}'] = raster.reshape(grid_shape)
+
+    annual_max = np.maximum.reduceat(values, time_index.year_starts, axis=0)
+    annual_total = time_index.yearly_sum(values)
+    stacks['return_level_max_monthly'] = ('return_period', np.asarray(return_periods, dtype=np.int32),
+                                          gumbel_return_levels(annual_max, return_periods).reshape((-1,) + grid_shape))
+    stacks['return_level_annual_total'] = ('return_period', np.asarray(return_periods, dtype=np.int32),
+                                           gumbel_return_levels(annual_total, return_periods).reshape((-1,) + grid_shape))
+    return lat_values, lon_values, all_time_data, rasters, stacks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute SPI, drought events and return levels for every grid cell.")
+    parser.add_argument("--data-directory", type=str, required=True, help="Path to the monthly NetCDF data directory")
+    parser.add_argument("--scales", type=int, nargs='+', default=DEFAULT_SCALES, help="SPI time scales in months")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="SPI value at or below which a month is in drought")
+    parser.add_argument("--min-duration", type=int, default=DEFAULT_MIN_DURATION, help="Minimum drought event length in months")
+    parser.add_argument("--return-periods", type=int, nargs='+', default=DEFAULT_RETURN_PERIODS, help="Return periods in years")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used to read the NetCDF files")
+    parser.add_argument("--output", type=str, default='drought.nc', help="Output NetCDF file (.nc) or NPY directory")
+    args = parser.parse_args()
+
+    lat_values, lon_values, all_time_data, rasters, stacks = grid_drought(
+        args.data_directory, args.scales, args.threshold, args.min_duration, args.return_periods, args.workers)
+    save_rasters(args.output, lat_values, lon_values, rasters, stacks,
+                 attributes={'source': args.data_directory, 'spi_threshold': args.threshold,
+                             'min_duration': args.min_duration})
+    print(f"Saved SPI at scales {args.scales} and drought/return level rasters to {args.output}")
@@ -0,0 +1,106 @@
+import json
+import os
+import numpy as np
+
+from pt02_reader import list_product_files
+from pt02_store import default_store_dir, file_sha256, read_manifest, store_is_current
+from pt02_timeindex import TimeIndex
+
+
+# Columnar export of extracted series for downstream tools.
+# An export is a directory holding the series table (time x series), the
+# derived annual totals table (year x series) and metadata.json with the
+# series description (snapped coordinates, grid indexes, ...), the product
+# and the SHA-256 of every source file.
+#  - npy: time.npy, series.npy (series x time float32, one contiguous row per
+#    series), years.npy and annual.npy, all loadable with mmap_mode='r'
+#  - arrow: series.arrow and annual.arrow Arrow IPC files, memory-mappable
+#    with pyarrow.memory_map; one column per series
+#  - parquet: series.parquet and annual.parquet, same columns
+# Arrow and Parquet need pyarrow; the metadata is also kept in their schemas.
+
+EXPORT_FORMATS = ['npy', 'arrow', 'parquet']
+METADATA_NAME = 'metadata.json'
+
+
+def source_hashes(directory, product='mensal'):
+    # SHA-256 of every product file, taken from the store manifest when the
+    # store is current so the files are not read again
+    if store_is_current(directory, product):
+        manifest = read_manifest(default_store_dir(directory, product))
+        return {entry['name']: entry['sha256'] for entry in manifest['sources']}
+    return {os.path.basename(file_path): file_sha256(file_path)
+            for file_path in list_product_files(directory, product)}
+
+
+def point_metadata(names, target_lats, target_lons, grid_points):
+    # Description of point series: requested and snapped coordinates and grid index
+    return [{'name': name, 'lat': float(target_lats[i]), 'lon': float(target_lons[i]),
+             'grid_lat': float(grid_points['grid_lat'][i]), 'grid_lon': float(grid_points['grid_lon'][i]),
+             'lat_idx': int(grid_points['lat_idx'][i]), 'lon_idx': int(grid_points['lon_idx'][i])}
+            for i, name in enumerate(names)]
+
+
+def _arrow_tables(all_time_data, series, years, annual, names, metadata):
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError("Arrow and Parquet exports need pyarrow to be installed")
+
+    schema_metadata = {'pt02': json.dumps(metadata)}
+    # Arrow has no month unit: monthly steps are stored as their first day
+    series_table = pa.table([pa.array(all_time_data.astype('datetime64[D]'))] + [pa.array(row) for row in series],
+                            names=['time'] + list(names)).replace_schema_metadata(schema_metadata)
+    annual_table = pa.table([pa.array(years.astype(np.int32))] + [pa.array(row) for row in annual],
+                            names=['year'] + list(names)).replace_schema_metadata(schema_metadata)
+    return series_table, annual_table
+
+
+def export_series(output, all_time_data, series, names, series_metadata, export_format='npy', metadata=None):
+    # Write a (series, time) matrix, its annual totals and the metadata to the
+    # output directory in one of the EXPORT_FORMATS. Returns the output path.
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {export_format}, expected one of {EXPORT_FORMATS}")
+    series = np.ascontiguousarray(series, dtype=np.float32)
+    time_index = TimeIndex(all_time_data)
+    years = time_index.years
+    annual = time_index.yearly_sum(series.astype(np.float64), axis=1)
+
+    metadata = dict(metadata or {})
+    metadata.update({'names': list(names), 'series': series_metadata,
+                     'time': [str(all_time_data[0]), str(all_time_data[-1])] if len(all_time_data) else [],
+                     'time_unit': np.datetime_data(all_time_data.dtype)[0], 'format': export_format})
+    os.makedirs(output, exist_ok=True)
+
+    if export_format == 'npy':
+        np.save(os.path.join(output, 'time.npy'), all_time_data)
+        np.save(os.path.join(output, 'series.npy'), series)
+        np.save(os.path.join(output, 'years.npy'), years)
+        np.save(os.path.join(output, 'annual.npy'), annual)
+    else:
+        series_table, annual_table = _arrow_tables(all_time_data, series, years, annual, names, metadata)
+        if export_format == 'arrow':
+            import pyarrow as pa
+            for name, table in (('series', series_table), ('annual', annual_table)):
+                with pa.ipc.new_file(os.path.join(output, f'{name}.arrow'), table.schema) as writer:
+                    writer.write_table(table)
+        else:
+            import pyarrow.parquet as pq
+            pq.write_table(series_table, os.path.join(output, 'series.parquet'))
+            pq.write_table(annual_table, os.path.join(output, 'annual.parquet'))
+
+    with open(os.path.join(output, METADATA_NAME), 'w') as f:
+        json.dump(metadata, f, indent=1)
+    return output
+
+
+def open_export(output):
+    # Memory-map an NPY export: returns the metadata and a dict of read-only
+    # arrays (time, series, years, annual) backed by the files
+    with open(os.path.join(output, METADATA_NAME)) as f:
+        metadata = json.load(f)
+    if metadata['format'] != 'npy':
+        raise ValueError(f"{output} is a {metadata['format']} export, open it with pyarrow")
+    arrays = {name: np.load(os.path.join(output, f'{name}.npy'), mmap_mode='r')
+              for name in ('time', 'series', 'years', 'annual')}
+    return metadata, arrays
@@ -0,0 +1,34 @@
+from pt02_profile import profiled
+
+
+# Figure helpers shared by the plot_* functions of both scripts. pyplot is
+# imported on use, like in the plot functions, so that importing the scripts
+# for their data-only commands does not load matplotlib.
+
+
+def figure_axes(fig=None, **subplots_kw):
+    # Same as plt.subplots(**subplots_kw). When an existing figure is passed,
+    # its axes are cleared and returned instead, so batch rendering can reuse
+    # one figure per chart type rather than build a new one for every site.
+    import matplotlib.pyplot as plt
+
+    if fig is None:
+        return plt.subplots(**subplots_kw)
+
+    plt.figure(fig.number)
+    n_axes = subplots_kw.get('nrows', 1) * subplots_kw.get('ncols', 1)
+    for ax in fig.axes:
+        ax.cla()
+    axes = fig.axes[:n_axes]
+    plt.sca(axes[0])
+    return fig, (axes[0] if n_axes == 1 else tuple(axes))
+
+
+@profiled('savefig')
+def finish_figure(fig, output, show=True):
+    # Save the figure and, in interactive runs, show it
+    import matplotlib.pyplot as plt
+
+    fig.savefig(output, format='png')
+    if show:
+        plt.show()
@@ -0,0 +1,145 @@
+import netCDF4 as nc
+import numpy as np
+
+from pt02_reader import LAT_VAR, LON_VAR, list_product_files, nearest_indices, snap_points
+
+
+# Interpolation of the PT02 grid at off-grid points.
+# Every point gets a stencil: the (lat, lon) indexes of the K grid cells it
+# depends on and their weights, computed once from the coordinates. The
+# values of all stencil cells are then gathered for the whole time axis and
+# combined with one weighted sum, whatever the number of timesteps or files.
+# Missing cells (sea, gaps) are left out and the remaining weights rescaled.
+
+INTERP_METHODS = ['nearest', 'bilinear', 'idw']
+IDW_NEIGHBOURS = 4
+IDW_POWER = 2.0
+
+
+def _bracket(coords, targets):
+    # Indexes of the two grid coordinates around every target and the
+    # fractional position between them, clamped at the edges of the grid
+    order = np.argsort(coords, kind='stable')
+    sorted_coords = coords[order]
+    pos = np.clip(np.searchsorted(sorted_coords, targets), 1, len(coords) - 1)
+    below, above = order[pos - 1], order[pos]
+    frac = np.clip((targets - coords[below]) / (coords[above] - coords[below]), 0.0, 1.0)
+    return below, above, frac
+
+
+def _neighbourhood(coords, targets, half_width=2):
+    # Indexes of the 2 * half_width grid coordinates around every target, as a
+    # (points, 2 * half_width) array. Indexes repeated by the clamping at the
+    # edges of the grid are flagged in the returned mask.
+    order = np.argsort(coords, kind='stable')
+    pos = np.searchsorted(coords[order], targets)
+    offsets = np.arange(-half_width, half_width)
+    sorted_idx = np.clip(pos[:, np.newaxis] + offsets, 0, len(coords) - 1)
+    repeated = np.zeros(sorted_idx.shape, dtype=bool)
+    repeated[:, 1:] = sorted_idx[:, 1:] == sorted_idx[:, :-1]
+    return order[sorted_idx], repeated
+
+
+def nearest_stencils(lat_values, lon_values, target_lats, target_lons):
+    lat_idx = nearest_indices(lat_values, target_lats)[:, np.newaxis]
+    lon_idx = nearest_indices(lon_values, target_lons)[:, np.newaxis]
+    return lat_idx, lon_idx, np.ones(lat_idx.shape)
+
+
+def bilinear_stencils(lat_values, lon_values, target_lats, target_lons):
+    # The 4 cells around every point, weighted by the opposite rectangle areas
+    lat0, lat1, fy = _bracket(lat_values, target_lats)
+    lon0, lon1, fx = _bracket(lon_values, target_lons)
+    lat_idx = np.stack([lat0, lat0, lat1, lat1], axis=1)
+    lon_idx = np.stack([lon0, lon1, lon0, lon1], axis=1)
+    weights = np.stack([(1 - fy) * (1 - fx), (1 - fy) * fx, fy * (1 - fx), fy * fx], axis=1)
+    return lat_idx, lon_idx, weights
+
+
+def idw_stencils(lat_values, lon_values, target_lats, target_lons, neighbours=IDW_NEIGHBOURS, power=IDW_POWER):
+    # The nearest cells of every point weighted by 1 / distance ** power. The
+    # candidates are the 4x4 cells around the point; distances are in degrees
+    # with longitude scaled by cos(lat). A point on a grid node takes its value.
+    lat_cand, lat_repeated = _neighbourhood(lat_values, target_lats)
+    lon_cand, lon_repeated = _neighbourhood(lon_values, target_lons)
+    n_points, n_lat, n_lon = len(target_lats), lat_cand.shape[1], lon_cand.shape[1]
+
+    dy = lat_values[lat_cand] - target_lats[:, np.newaxis]
+    dx = (lon_values[lon_cand] - target_lons[:, np.newaxis]) * np.cos(np.radians(target_lats))[:, np.newaxis]
+    distance = np.hypot(dy[:, :, np.newaxis], dx[:, np.newaxis, :])
+    distance[lat_repeated[:, :, np.newaxis] | lon_repeated[:, np.newaxis, :]] = np.inf
+    distance = distance.reshape(n_points, n_lat * n_lon)
+
+    neighbours = min(neighbours, n_lat * n_lon)
+    nearest = np.argsort(distance, axis=1, kind='stable')[:, :neighbours]
+    distance = np.take_along_axis(distance, nearest, axis=1)
+    lat_idx = np.take_along_axis(lat_cand, nearest // n_lon, axis=1)
+    lon_idx = np.take_along_axis(lon_cand, nearest % n_lon, axis=1)
+
+    with np.errstate(divide='ignore'):
+        weights = 1.0 / distance ** power
+    on_node = distance[:, 0] == 0
+    weights[on_node] = 0.0
+    weights[on_node, 0] = 1.0
+    weights[np.isinf(distance)] = 0.0
+    return lat_idx, lon_idx, weights
+
+
+STENCILS = {
+    'nearest': nearest_stencils,
+    'bilinear': bilinear_stencils,
+    'idw': idw_stencils,
+}
+
+
+def make_stencils(lat_values, lon_values, target_lats, target_lons, method='bilinear'):
+    # (points, K) lat indexes, lon indexes and weights of every point
+    if method not in STENCILS:
+        raise ValueError(f"Unknown interpolation method {method}, expected one of {INTERP_METHODS}")
+    return STENCILS[method](np.asarray(lat_values, dtype=np.float64), np.asarray(lon_values, dtype=np.float64),
+                            np.atleast_1d(np.asarray(target_lats, dtype=np.float64)),
+                            np.atleast_1d(np.asarray(target_lons, dtype=np.float64)))
+
+
+def apply_stencils(values, weights):
+    # Weighted sum over the stencil axis of a (points, K, time) array of cell
+    # values, rescaling the weights of every timestep to the valid cells
+    weights = weights[:, :, np.newaxis]
+    valid = ~np.isnan(values)
+    totals = np.sum(np.where(valid, values, 0.0) * weights, axis=1)
+    covered = np.sum(valid * weights, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(covered > 0, totals / covered, np.nan).astype(np.float32)
+
+
+def read_grid(directory, product='mensal'):
+    # lat and lon coordinates of a product, from the store or the first file
+    from pt02_store import open_store
+
+    store = open_store(directory, product)
+    if store is not None:
+        return store.lat, store.lon
+    file_paths = list_product_files(directory, product)
+    if not file_paths:
+        raise FileNotFoundError(f"No {product} NetCDF files found in {directory}")
+    with nc.Dataset(file_paths[0]) as dataset:
+        return (np.asarray(dataset.variables[LAT_VAR][:], dtype=np.float64),
+                np.asarray(dataset.variables[LON_VAR][:], dtype=np.float64))
+
+
+def read_interpolated(directory, target_lats, target_lons, product='mensal', workers=1, method='bilinear'):
+    # Interpolated version of read_points: the distinct cells of all stencils
+    # are extracted in one pass (as grid points, so they snap to themselves)
+    # and combined per point. Returns the datetime64 axis, the points x time
+    # matrix and the nearest grid cell of every point.
+    from pt02_reader import read_points
+
+    lat_values, lon_values = read_grid(directory, product)
+    lat_idx, lon_idx, weights = make_stencils(lat_values, lon_values, target_lats, target_lons, method)
+
+    cells, inverse = np.unique(lat_idx * len(lon_values) + lon_idx, return_inverse=True)
+    all_time_data, cell_matrix, _ = read_points(directory, lat_values[cells // len(lon_values)],
+                                                lon_values[cells % len(lon_values)], product, workers)
+    values = cell_matrix[inverse.reshape(lat_idx.shape)]
+    grid_points = snap_points(lat_values, lon_values, np.atleast_1d(target_lats), np.atleast_1d(target_lons))
+    return all_time_data, apply_stencils(values, weights), grid_points
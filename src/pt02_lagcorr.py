@@ -0,0 +1,175 @@
+import argparse
+import csv
+import os
+import numpy as np
+from scipy import special, stats
+
+from pt02_reader import read_cube
+from pt02_drought import rolling_sums
+from pt02_rasters import save_rasters
+
+
+# Lagged cumulative-window correlation between the monthly precipitation of
+# every grid cell and a sparse reservoir series such as the April/October
+# qualitative water levels of data_water_level/watershed_yearly.csv.
+# For a window of w months and a lag of L months, the predictor of an
+# observation in month m is the precipitation total of the w months ending
+# L months before m (L = 0 includes month m itself). All the window sums come
+# from one cumulative sum per window (pt02_drought.rolling_sums), every
+# (window, lag) pair is gathered at the observation months for all cells at
+# once, and the Spearman correlations are computed as Pearson correlations
+# of the ranks, ranked in one batch along the observation axis.
+#
+# The output holds, per cell, the strongest correlation over all windows and
+# lags (largest absolute value, sign kept), the window and lag giving it, its
+# p-value and number of observations, plus the full correlation of every
+# (window, lag) pair as one 'lag' stack per window.
+
+DEFAULT_WATER_LEVEL_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_water_level',
+                                       'watershed_yearly.csv')
+DEFAULT_WINDOWS = [3, 6, 9, 12, 18, 24]
+DEFAULT_LAGS = [0, 1, 2, 3, 6]
+METHODS = ['spearman', 'pearson']
+# Fewer paired observations than this leaves the correlation undefined
+MIN_OBSERVATIONS = 8
+
+
+def load_water_levels(path, months=None):
+    # Read a 'date' (YYYY-MM) column and one or more value columns. Returns the
+    # datetime64[M] dates and a {column: float values} dict (empty cells NaN),
+    # keeping only the observations in the given calendar months (1-12).
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    columns = [name for name in rows[0] if name != 'date']
+    dates = np.array([row['date'].strip()[:7] for row in rows], dtype='datetime64[M]')
+    values = {name: np.array([float(row[name]) if row[name].strip() else np.nan for row in rows])
+              for name in columns}
+
+    keep = np.ones(len(dates), dtype=bool)
+    if months:
+        keep = np.isin(dates.astype(np.int64) % 12 + 1, months)
+    order = np.argsort(dates[keep], kind='stable')
+    return dates[keep][order], {name: column[keep][order] for name, column in values.items()}
+
+
+def window_predictors(all_time_data, values, observation_dates, windows, lags):
+    # (window, lag, observation, cell) precipitation totals; NaN where the
+    # window is not fully inside the monthly record (or has missing values)
+    steps = (observation_dates.astype('datetime64[M]') - all_time_data[0].astype('datetime64[M]')).astype(np.int64)
+    predictors = np.full((len(windows), len(lags), len(steps), values.shape[1]), np.nan)
+    for i, window in enumerate(windows):
+        sums = rolling_sums(values, window)
+        for j, lag in enumerate(lags):
+            end_steps = steps - lag
+            inside = (end_steps >= 0) & (end_steps < len(sums))
+            predictors[i, j, inside] = sums[end_steps[inside]]
+    return predictors
+
+
+def batch_correlation(predictors, target, method='spearman', min_observations=MIN_OBSERVATIONS):
+    # Correlation of target (observation,) with every predictor series along
+    # axis -2 of predictors (..., observation, cell). Observations where the
+    # target or the predictors of the time axis are missing are dropped; a
+    # cell with any other gap is left undefined. Returns r and n.
+    usable = ~np.isnan(target) & ~np.all(np.isnan(predictors), axis=-1)
+    x = np.where(usable[..., np.newaxis], predictors, np.nan)
+    n = np.sum(~np.isnan(x), axis=-2)
+    complete = n == usable.sum(axis=-1)[..., np.newaxis]
+
+    # The target, repeated for every window/lag pair with its own usable rows
+    y = np.where(usable, target, np.nan)
+    if method == 'spearman':
+        # Average ranks for ties (the qualitative levels are mostly ties); the
+        # dropped observations are ranked last and then zeroed out below
+        x = stats.rankdata(np.where(np.isnan(x), np.inf, x), axis=-2)
+        y = stats.rankdata(np.where(np.isnan(y), np.inf, y), axis=-1)
+    x = np.where(usable[..., np.newaxis], x, 0.0)
+    y = np.where(usable, y, 0.0)
+
+    count = usable.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_centered = np.where(usable[..., np.newaxis], x - x.sum(axis=-2, keepdims=True) / count[..., np.newaxis, np.newaxis], 0.0)
+        y_centered = np.where(usable, y - y.sum(axis=-1, keepdims=True) / count[..., np.newaxis], 0.0)
+        covariance = np.einsum('...oc,...o->...c', x_centered, y_centered)
+        r = covariance / np.sqrt(np.sum(x_centered ** 2, axis=-2) * np.sum(y_centered ** 2, axis=-1)[..., np.newaxis])
+    r[~complete | (n < min_observations)] = np.nan
+    return r, n
+
+
+def correlation_p_values(r, n):
+    # Two sided p-value of a correlation from the t approximation
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = r * np.sqrt((n - 2) / np.maximum(1 - r ** 2, 1e-12))
+        return 2 * special.stdtr(n - 2, -np.abs(t))
+
+
+def best_lags(r, n, windows, lags):
+    # Strongest correlation of every cell over the (window, lag) pairs
+    flat = r.reshape(-1, r.shape[-1])
+    strength = np.where(np.isnan(flat), -1.0, np.abs(flat))
+    best = np.argmax(strength, axis=0)
+    cells = np.arange(flat.shape[1])
+    undefined = np.all(np.isnan(flat), axis=0)
+    window_idx, lag_idx = np.divmod(best, len(lags))
+
+    best_r = flat[best, cells]
+    best_n = n.reshape(-1, r.shape[-1])[best, cells].astype(np.float64)
+    results = {
+        'best_correlation': best_r,
+        'best_window': np.asarray(windows, dtype=np.float64)[window_idx],
+        'best_lag': np.asarray(lags, dtype=np.float64)[lag_idx],
+        'best_p_value': correlation_p_values(best_r, best_n),
+        'best_n': best_n,
+    }
+    for values in results.values():
+        values[undefined] = np.nan
+    return results
+
+
+def grid_lag_correlation(directory, water_level_csv=DEFAULT_WATER_LEVEL_CSV, windows=DEFAULT_WINDOWS,
+                         lags=DEFAULT_LAGS, months=None, method='spearman', workers=1):
+    # Read the monthly cube once and correlate every cell with every series of
+    # the water level file. Returns the grid, the rasters and the stacks for
+    # save_rasters; names get a '<column>_' prefix when the file has several series.
+    all_time_data, lat_values, lon_values, cube = read_cube(directory, 'mensal', workers)
+    grid_shape = cube.shape[1:]
+    values = cube.reshape(len(cube), -1).astype(np.float64)
+    if np.any(np.diff(all_time_data.astype('datetime64[M]').astype(np.int64)) != 1):
+        raise ValueError("The monthly record must have one timestep per month without gaps")
+
+    observation_dates, series = load_water_levels(water_level_csv, months)
+    predictors = window_predictors(all_time_data, values, observation_dates, windows, lags)
+
+    rasters = {}
+    stacks = {}
+    for name, target in series.items():
+        prefix = f'{name}_' if len(series) > 1 else ''
+        r, n = batch_correlation(predictors, target, method)
+        for key, raster in best_lags(r, n, windows, lags).items():
+            rasters[prefix + key] = raster.reshape(grid_shape)
+        for i, window in enumerate(windows):
+            stacks[f'{prefix}correlation_w{window}'] = ('lag', np.asarray(lags, dtype=np.int32),
+                                                       r[i].reshape((len(lags),) + grid_shape))
+    return lat_values, lon_values, rasters, stacks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Correlate cumulative precipitation windows of every grid cell with reservoir water levels.")
+    parser.add_argument("--data-directory", type=str, required=True, help="Path to the monthly NetCDF data directory")
+    parser.add_argument("--water-level-csv", type=str, default=DEFAULT_WATER_LEVEL_CSV,
+                        help="CSV with a date (YYYY-MM) column and one or more water level columns")
+    parser.add_argument("--windows", type=int, nargs='+', default=DEFAULT_WINDOWS, help="Window lengths in months")
+    parser.add_argument("--lags", type=int, nargs='+', default=DEFAULT_LAGS,
+                        help="Months between the end of the window and the observation")
+    parser.add_argument("--months", type=int, nargs='+', help="Only use observations of these calendar months (e.g. 4 10)")
+    parser.add_argument("--method", type=str, default='spearman', choices=METHODS, help="Correlation coefficient")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used to read the NetCDF files")
+    parser.add_argument("--output", type=str, default='lag_correlation.nc', help="Output NetCDF file (.nc) or NPY directory")
+    args = parser.parse_args()
+
+    lat_values, lon_values, rasters, stacks = grid_lag_correlation(
+        args.data_directory, args.water_level_csv, args.windows, args.lags, args.months, args.method, args.workers)
+    save_rasters(args.output, lat_values, lon_values, rasters, stacks,
+                 attributes={'source': args.data_directory, 'water_level_csv': os.path.abspath(args.water_level_csv),
+                             'method': args.method})
+    print(f"Saved {args.method} correlations for windows {args.windows} and lags {args.lags} to {args.output}")
@@ -0,0 +1,219 @@
+import argparse
+import hashlib
+import os
+import matplotlib
+# Headless rendering: never open windows, draw straight to files
+matplotlib.use('Agg')
+import numpy as np
+
+from pt02_reader import read_cube
+from pt02_store import STORE_DIRNAME
+from pt02_timeindex import TimeIndex
+from pt02_basins import cell_edges
+from pt02_profile import profiled
+
+
+# Whole-grid maps of var228 fields: monthly precipitation, annual totals,
+# annual anomalies (difference to the mean annual total) and the Sen slope
+# of the annual totals (see pt02_trends.py).
+# A MapRenderer sets the figure up once: one pcolormesh over the cell edges,
+# the coastline, the colorbar and the title. Every frame then only replaces
+# the mesh values and the title text, so a 648-frame animation or hundreds
+# of annual maps cost a single figure setup. The coastline is the boundary
+# between land and sea (NaN) cells, derived from the grid mask and cached
+# on disk next to the store. The colour scale is fixed over all the frames
+# so that they are comparable.
+
+FIELDS = ['monthly', 'annual', 'anomaly', 'trend']
+MAPS_DIRNAME = 'maps'
+DEFAULT_TEMPLATE = os.path.join('maps', '{field}_{label}.png')
+# Percentiles of all the frame values used for the colour range
+COLOR_PERCENTILES = (1, 99)
+COLORMAPS = {'monthly': 'YlGnBu', 'annual': 'YlGnBu', 'anomaly': 'RdBu', 'trend': 'RdBu'}
+UNITS = {'monthly': 'mm', 'annual': 'mm', 'anomaly': 'mm', 'trend': 'mm/year'}
+
+
+def coastline_segments(lat_values, lon_values, land):
+    # (segment, 2 points, lon/lat) array of the cell sides between land and
+    # sea cells. Sides on the edge of the grid are left out: the grid ends at
+    # the border with Spain as much as at the coast.
+    lat_edges = cell_edges(lat_values)
+    lon_edges = cell_edges(lon_values)
+
+    # Between columns j and j + 1 of row i: a vertical side at lon_edges[j + 1]
+    rows, cols = np.nonzero(land[:, 1:] != land[:, :-1])
+    vertical = np.stack([np.stack([lon_edges[cols + 1], lat_edges[rows]], axis=-1),
+                         np.stack([lon_edges[cols + 1], lat_edges[rows + 1]], axis=-1)], axis=1)
+    # Between rows i and i + 1 of column j: a horizontal side at lat_edges[i + 1]
+    rows, cols = np.nonzero(land[1:, :] != land[:-1, :])
+    horizontal = np.stack([np.stack([lon_edges[cols], lat_edges[rows + 1]], axis=-1),
+                           np.stack([lon_edges[cols + 1], lat_edges[rows + 1]], axis=-1)], axis=1)
+    return np.concatenate([vertical, horizontal]).reshape(-1, 2, 2)
+
+
+def cached_coastline(lat_values, lon_values, land, cache_dir=None):
+    # coastline_segments, read from / saved to cache_dir when one is given
+    if cache_dir is None:
+        return coastline_segments(lat_values, lon_values, land)
+
+    sha = hashlib.sha256()
+    for array in (lat_values, lon_values):
+        sha.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    sha.update(np.packbits(land).tobytes())
+    cache_path = os.path.join(cache_dir, f"coastline_{sha.hexdigest()}.npy")
+    if os.path.exists(cache_path):
+        return np.load(cache_path)
+
+    segments = coastline_segments(lat_values, lon_values, land)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = cache_path + '.tmp.npy'
+    np.save(tmp_path, segments)
+    os.replace(tmp_path, cache_path)
+    return segments
+
+
+def color_range(frames, field):
+    # Fixed colour limits over all frames; symmetric around zero for the
+    # anomaly and trend maps
+    if not np.any(np.isfinite(frames)):
+        raise ValueError(f"No {field} values to map in the selected range")
+    low, high = np.nanpercentile(frames, COLOR_PERCENTILES)
+    if field in ('anomaly', 'trend'):
+        limit = max(abs(low), abs(high))
+        return -limit, limit
+    return 0.0, high
+
+
+class MapRenderer:
+    # One figure with a single QuadMesh, redrawn for every frame
+
+    def __init__(self, lat_values, lon_values, coastline, vmin, vmax, cmap='YlGnBu', units='mm', figsize=(6, 8),
+                 dpi=100):
+        import matplotlib.pyplot as plt
+        from matplotlib.collections import LineCollection
+
+        self.fig, self.ax = plt.subplots(figsize=figsize, dpi=dpi)
+        self.mesh = self.ax.pcolormesh(cell_edges(lon_values), cell_edges(lat_values),
+                                       np.ma.masked_all((len(lat_values), len(lon_values))),
+                                       cmap=cmap, vmin=vmin, vmax=vmax, shading='flat')
+        self.ax.add_collection(LineCollection(coastline, colors='k', linewidths=0.8))
+        # Plate carree with the x scale of the mean latitude
+        self.ax.set_aspect(1 / np.cos(np.radians(np.mean(lat_values))))
+        self.ax.set_xlabel('Longitude', fontsize=12)
+        self.ax.set_ylabel('Latitude', fontsize=12)
+        self.ax.grid(linestyle='--', alpha=0.4)
+        self.fig.colorbar(self.mesh, ax=self.ax, label=units, shrink=0.8)
+        # A placeholder title keeps room for the frame titles in the layout
+        self.title = self.ax.set_title(' ', fontsize=12)
+        self.fig.tight_layout()
+
+    @profiled('map_frame')
+    def draw(self, field, title=''):
+        # Show a (lat, lon) field: only the mesh values and the title change
+        self.mesh.set_array(np.ma.masked_invalid(field).ravel())
+        self.title.set_text(title)
+        return self.mesh, self.title
+
+    def save(self, output):
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        self.fig.savefig(output, format='png')
+
+    def save_frames(self, frames, labels, titles, template=DEFAULT_TEMPLATE, field='monthly'):
+        # One PNG per frame; template fields are field and label
+        outputs = []
+        for frame, label, title in zip(frames, labels, titles):
+            output = template.format(field=field, label=label)
+            self.draw(frame, title)
+            self.save(output)
+            outputs.append(output)
+        return outputs
+
+    def save_animation(self, frames, titles, output, fps=12):
+        # Animation of the frames (GIF with Pillow, or any format of an
+        # installed matplotlib writer such as ffmpeg for .mp4)
+        from matplotlib import animation
+
+        movie = animation.FuncAnimation(self.fig, lambda k: self.draw(frames[k], titles[k]), frames=len(frames),
+                                        interval=1000 / fps, blit=False)
+        writer = animation.PillowWriter(fps=fps) if output.endswith('.gif') else animation.FFMpegWriter(fps=fps)
+        movie.save(output, writer=writer)
+        return output
+
+    def close(self):
+        import matplotlib.pyplot as plt
+        plt.close(self.fig)
+
+
+def map_frames(all_time_data, cube, field='monthly', start=None, end=None):
+    # Frames (n, lat, lon), labels and titles of a field over the time range
+    # [start, end] (datetime64 or 'YYYY[-MM]' strings). The anomalies are
+    # relative to the mean annual total of the whole record; the trend uses
+    # the annual totals of the range.
+    keep = np.ones(len(all_time_data), dtype=bool)
+    if start is not None:
+        keep &= all_time_data >= np.datetime64(start)
+    if end is not None:
+        # Up to the end of the given month or year
+        keep &= all_time_data < np.datetime64(end) + 1
+
+    if field == 'monthly':
+        labels = np.datetime_as_string(all_time_data[keep]).tolist()
+        return cube[keep], labels, [f'Monthly Precipitation {label}' for label in labels]
+
+    time_index = TimeIndex(all_time_data)
+    annual = time_index.yearly_sum(cube.astype(np.float64))
+    baseline = annual.mean(axis=0)
+    # Years with at least one timestep in the range
+    years = np.isin(time_index.years, time_index.year_of_step[keep])
+    annual = annual[years]
+    labels = [str(year) for year in time_index.years[years]]
+    if field == 'annual':
+        return annual, labels, [f'Yearly Accumulated Precipitation {label}' for label in labels]
+    if field == 'anomaly':
+        return annual - baseline, labels, [f'Yearly Precipitation Anomaly {label}' for label in labels]
+
+    from pt02_trends import MIN_YEARS, trends
+    if len(annual) < MIN_YEARS:
+        raise ValueError(f"The trend map needs at least {MIN_YEARS} years (MIN_YEARS), the range has {len(annual)}")
+    slope = trends(time_index.years[years], annual.reshape(len(annual), -1))['sen_slope']
+    label = f'{labels[0]}_{labels[-1]}'
+    return slope.reshape(1, *cube.shape[1:]), [label], [f"Sen's Slope of the Yearly Precipitation {labels[0]}-{labels[-1]}"]
+
+
+def render_maps(directory, field='monthly', template=DEFAULT_TEMPLATE, animation=None, fps=12, start=None,
+                end=None, dpi=100, workers=1):
+    # Read the monthly cube, set one map figure up and write every frame as
+    # a PNG (template) and/or as one animation. Returns the written files.
+    all_time_data, lat_values, lon_values, cube = read_cube(directory, 'mensal', workers)
+    land = ~np.all(np.isnan(cube), axis=0)
+    coastline = cached_coastline(lat_values, lon_values, land, os.path.join(directory, STORE_DIRNAME, MAPS_DIRNAME))
+    frames, labels, titles = map_frames(all_time_data, cube, field, start, end)
+
+    vmin, vmax = color_range(frames, field)
+    renderer = MapRenderer(lat_values, lon_values, coastline, vmin, vmax, COLORMAPS[field], UNITS[field], dpi=dpi)
+    try:
+        outputs = renderer.save_frames(frames, labels, titles, template, field) if template else []
+        if animation:
+            outputs.append(renderer.save_animation(frames, titles, animation, fps))
+    finally:
+        renderer.close()
+    return outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render maps of the precipitation grid as PNG frames and/or an animation.")
+    parser.add_argument("--data-directory", type=str, required=True, help="Path to the monthly NetCDF data directory")
+    parser.add_argument("--field", type=str, default='annual', choices=FIELDS, help="Field to map")
+    parser.add_argument("--start", type=str, help="First month (YYYY-MM) or year of the frames")
+    parser.add_argument("--end", type=str, help="Last month (YYYY-MM) or year of the frames")
+    parser.add_argument("--output-template", type=str, default=DEFAULT_TEMPLATE,
+                        help="Output path template of the PNG frames with {field} and {label} fields ('' for none)")
+    parser.add_argument("--animation", type=str, help="Also save the frames as an animation (.gif, or .mp4 with ffmpeg)")
+    parser.add_argument("--fps", type=int, default=12, help="Frames per second of the animation")
+    parser.add_argument("--dpi", type=int, default=100, help="Resolution of the frames")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used to read the NetCDF files")
+    args = parser.parse_args()
+
+    outputs = render_maps(args.data_directory, args.field, args.output_template, args.animation, args.fps,
+                          args.start, args.end, args.dpi, args.workers)
+    print(f"Saved {len(outputs)} {args.field} map files")
@@ -0,0 +1,206 @@
+import argparse
+import csv
+import os
+import pickle
+import shutil
+import numpy as np
+
+from pt02_store import STORE_DIRNAME, file_sha256, read_manifest, write_manifest
+
+
+# Columnar store of the NDVI basin statistics (data_ndvi/*.pkl).
+# The pickles are a {date: [record per basin]} dict; the store keeps one NPY
+# file per statistic with shape (basin, date), sorted by basin id and date,
+# plus the basin id and date indexes and a manifest with the format version
+# and the hash of the source pickle. Every column is memory-mapped, so one
+# basin is a contiguous read and a date range a slice of it; nothing else is
+# deserialized. Basin/date pairs missing from the pickle, and the 'NULL'
+# means of cloudy scenes, are NaN.
+#
+# The default store of data_ndvi/<name>.pkl is data_ndvi/.pt02_store/ndvi/<name>.
+
+NDVI_DIRNAME = 'ndvi'
+NDVI_STORE_VERSION = 1
+COLUMNS = ['PixelCount', 'PixelSum', 'PixelMean', 'Area', 'Perimeter', 'CentroidX', 'CentroidY']
+DEFAULT_COLUMN = 'PixelMean'
+
+
+def default_ndvi_store_dir(pickle_path):
+    name = os.path.splitext(os.path.basename(pickle_path))[0]
+    return os.path.join(os.path.dirname(os.path.abspath(pickle_path)), STORE_DIRNAME, NDVI_DIRNAME, name)
+
+
+def _value(value):
+    # The statistics use the string 'NULL' for scenes with no valid pixels
+    return np.nan if value is None or value == 'NULL' else float(value)
+
+
+def convert_pickle(pickle_path, store_dir=None, force=False):
+    # Write the columnar store of an NDVI statistics pickle, unless the store
+    # already holds the same pickle. Returns the store directory.
+    store_dir = store_dir or default_ndvi_store_dir(pickle_path)
+    sha256 = file_sha256(pickle_path)
+    manifest = read_manifest(store_dir)
+    if (not force and manifest is not None and manifest.get('version') == NDVI_STORE_VERSION
+            and manifest.get('source', {}).get('sha256') == sha256):
+        return store_dir
+
+    with open(pickle_path, 'rb') as f:
+        statistics = pickle.load(f)
+
+    dates = np.array(sorted(statistics), dtype='datetime64[D]')
+    date_keys = {key: np.datetime64(key, 'D') for key in statistics}
+    basin_ids = np.array(sorted({int(record['BasinID']) for records in statistics.values() for record in records}),
+                         dtype=np.int64)
+    columns = {name: np.full((len(basin_ids), len(dates)), np.nan) for name in COLUMNS}
+    for key, records in statistics.items():
+        j = np.searchsorted(dates, date_keys[key])
+        for record in records:
+            i = np.searchsorted(basin_ids, int(record['BasinID']))
+            for name in COLUMNS:
+                columns[name][i, j] = _value(record.get(name))
+
+    # Build in a sibling directory and swap it in, like pt02_store.consolidate
+    build_dir = store_dir + '.building'
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+    np.save(os.path.join(build_dir, 'dates.npy'), dates)
+    np.save(os.path.join(build_dir, 'basin_ids.npy'), basin_ids)
+    for name, values in columns.items():
+        np.save(os.path.join(build_dir, f'{name}.npy'), values)
+    stat = os.stat(pickle_path)
+    write_manifest(build_dir, {
+        'version': NDVI_STORE_VERSION,
+        'columns': COLUMNS,
+        'n_basins': len(basin_ids),
+        'n_dates': len(dates),
+        'source': {'name': os.path.basename(pickle_path), 'size': stat.st_size, 'mtime': stat.st_mtime,
+                   'sha256': sha256},
+    })
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.makedirs(os.path.dirname(store_dir), exist_ok=True)
+    os.replace(build_dir, store_dir)
+    return store_dir
+
+
+class NDVIStore:
+    # Read-only, memory-mapped view of a columnar NDVI store
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.manifest = read_manifest(store_dir)
+        if self.manifest is None:
+            raise FileNotFoundError(f"No NDVI store in {store_dir}")
+        if self.manifest.get('version') != NDVI_STORE_VERSION:
+            raise ValueError(f"NDVI store version {self.manifest.get('version')} in {store_dir} is not "
+                             f"{NDVI_STORE_VERSION}; convert the pickle again")
+        self.dates = np.load(os.path.join(store_dir, 'dates.npy'))
+        self.basin_ids = np.load(os.path.join(store_dir, 'basin_ids.npy'))
+        self.columns = {name: np.load(os.path.join(store_dir, f'{name}.npy'), mmap_mode='r')
+                        for name in self.manifest['columns']}
+
+    def basin_index(self, basins):
+        # Row of every basin id (ValueError for unknown ids)
+        basins = np.atleast_1d(np.asarray(basins, dtype=np.int64))
+        rows = np.clip(np.searchsorted(self.basin_ids, basins), 0, len(self.basin_ids) - 1)
+        if np.any(self.basin_ids[rows] != basins):
+            raise ValueError(f"Unknown basin ids {basins[self.basin_ids[rows] != basins].tolist()}")
+        return rows
+
+    def date_slice(self, start=None, end=None):
+        # Columns of the dates in [start, end] (either bound may be None)
+        first = 0 if start is None else np.searchsorted(self.dates, np.datetime64(start, 'D'), side='left')
+        last = len(self.dates) if end is None else np.searchsorted(self.dates, np.datetime64(end, 'D'), side='right')
+        return slice(int(first), int(last))
+
+    def read(self, column=DEFAULT_COLUMN, basins=None, start=None, end=None):
+        # Dates, basin ids and (basin, date) values of one column, for the
+        # given basins (all by default) and date range. Only the requested
+        # part of the memory-mapped column is read.
+        dates = self.date_slice(start, end)
+        if basins is None:
+            return self.dates[dates], self.basin_ids, np.asarray(self.columns[column][:, dates])
+        rows = self.basin_index(basins)
+        return self.dates[dates], self.basin_ids[rows], np.asarray(self.columns[column][rows, dates])
+
+    def monthly(self, column=DEFAULT_COLUMN, basins=None, start=None, end=None):
+        # Monthly means (NaN ignored) of a column: datetime64[M] months with
+        # at least one scene, basin ids and (basin, month) values
+        dates, basin_ids, values = self.read(column, basins, start, end)
+        months, inverse = np.unique(dates.astype('datetime64[M]'), return_inverse=True)
+        valid = ~np.isnan(values)
+        totals = np.zeros((len(basin_ids), len(months)))
+        counts = np.zeros((len(basin_ids), len(months)))
+        np.add.at(totals, (slice(None), inverse), np.where(valid, values, 0.0))
+        np.add.at(counts, (slice(None), inverse), valid)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return months, basin_ids, np.where(counts > 0, totals / counts, np.nan)
+
+
+def open_ndvi(path):
+    # NDVIStore of a store directory or of a pickle (converted on first use)
+    if os.path.isdir(path):
+        return NDVIStore(path)
+    return NDVIStore(convert_pickle(path))
+
+
+def join_precipitation(ndvi_months, basin_ids, ndvi, all_time_data, series, series_names, window=1):
+    # Pair the monthly NDVI of every basin with the precipitation of the same
+    # basin: the total of the 'window' months ending in the NDVI month.
+    # series is the (basin, time) matrix of pt02_basins.basin_series with its
+    # basin names (str(BasinID) for the NDVI basins). Returns the long table
+    # (basin ids, months, NDVI, precipitation) of the pairs with both values.
+    from pt02_drought import rolling_sums
+
+    rows = {name: i for i, name in enumerate(series_names)}
+    missing = [basin for basin in basin_ids if str(basin) not in rows]
+    if missing:
+        raise ValueError(f"No precipitation series for basins {missing}")
+    precip = rolling_sums(series[[rows[str(basin)] for basin in basin_ids]].T.astype(np.float64), window).T
+
+    # Column of every NDVI month in the monthly precipitation axis
+    months = all_time_data.astype('datetime64[M]')
+    columns = np.searchsorted(months, ndvi_months)
+    inside = (columns < len(months)) & (months[np.minimum(columns, len(months) - 1)] == ndvi_months)
+    paired = np.full(ndvi.shape, np.nan)
+    paired[:, inside] = precip[:, columns[inside]]
+
+    keep = ~np.isnan(ndvi) & ~np.isnan(paired)
+    basin_rows, month_columns = np.nonzero(keep)
+    return basin_ids[basin_rows], ndvi_months[month_columns], ndvi[keep], paired[keep]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert NDVI statistics pickles to columnar stores and join them with basin precipitation.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert = subparsers.add_parser('convert', help="Convert pickles to columnar NDVI stores")
+    convert.add_argument("pickles", type=str, nargs='+', help="NDVI statistics .pkl files")
+    convert.add_argument("--force", action='store_true', help="Convert even if the store is up to date")
+
+    join = subparsers.add_parser('join', help="Pair monthly NDVI with the basin precipitation")
+    join.add_argument("--ndvi", type=str, required=True, help="NDVI store directory or statistics .pkl")
+    join.add_argument("--data-directory", type=str, required=True, help="Path to the monthly NetCDF data directory")
+    join.add_argument("--column", type=str, default=DEFAULT_COLUMN, choices=COLUMNS, help="NDVI statistic")
+    join.add_argument("--window", type=int, default=1, help="Months of precipitation summed up to the NDVI month")
+    join.add_argument("--workers", type=int, default=1, help="Number of processes used to read the NetCDF files")
+    join.add_argument("--output", type=str, default='ndvi_precip.csv', help="Output CSV file")
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        for pickle_path in args.pickles:
+            print(f"{pickle_path} -> {convert_pickle(pickle_path, force=args.force)}")
+    else:
+        from pt02_basins import load_basins, basin_series
+
+        store = open_ndvi(args.ndvi)
+        ndvi_months, basin_ids, ndvi = store.monthly(args.column)
+        basins = load_basins(store.store_dir)
+        all_time_data, series, _ = basin_series(args.data_directory, basins, 'mensal', args.workers)
+        pairs = join_precipitation(ndvi_months, basin_ids, ndvi, all_time_data, series, list(basins), args.window)
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['basin', 'month', args.column.lower(), f'precip_{args.window}m'])
+            for basin, month, ndvi_value, precip_value in zip(*pairs):
+                writer.writerow([basin, month, f"{ndvi_value:.6g}", f"{precip_value:.6g}"])
+        print(f"Saved {len(pairs[0])} basin/month pairs to {args.output}")
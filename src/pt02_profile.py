@@ -0,0 +1,264 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: the reports then have no RSS figures
+    resource = None
+
+
+# Stage level instrumentation of a run. The readers, the aggregations and the
+# plot functions are wrapped in named stages (the stage() context manager or
+# the profiled() decorator); while a Profiler is active every stage records
+# its wall and CPU time and the process RSS high water mark, the readers
+# count the bytes taken from every file and the report carries the hit rates
+# of the series caches. With no active profiler the hooks only check one
+# global and call through, so they stay in place in normal runs.
+#
+# The scripts enable it with --profile [report.json]. A batch driver uses the
+# same hooks:
+#
+#   reports = []
+#   for site in sites:
+#       with profiling(Profiler(run={'site': site}, keep_events=False)) as profiler:
+#           ...
+#       reports.append(profiler.report())
+#   totals = merge_reports(reports)
+
+DEFAULT_REPORT = 'profile.json'
+
+# Profiler receiving the stages of this process, if any
+_active = None
+
+
+def max_rss_kb():
+    # High water mark of the resident set size of this process in kB
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kB on Linux
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def _cache_stats():
+    # Counters of the series caches created so far (see pt02_cache.py). The
+    # module is only looked up, not imported, since it imports the readers.
+    cache_module = sys.modules.get('pt02_cache')
+    if cache_module is None:
+        return {}
+    return {cache_dir: cache.stats() for cache_dir, cache in cache_module._caches.items()}
+
+
+def _hit_rate(stats):
+    lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+    return (stats['hits'] + stats['disk_hits']) / lookups if lookups else None
+
+
+class Profiler:
+
+    def __init__(self, run=None, keep_events=True):
+        self.run = dict(run or {})
+        self.keep_events = keep_events
+        self.stages = {}
+        self.events = []
+        self.files = {}
+        self.workers = []
+        self.depth = 0
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.cache_start = _cache_stats()
+
+    def record(self, name, start, wall, cpu, rss_before, rss_after, depth):
+        stage = self.stages.setdefault(name, {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'max_wall': 0.0,
+                                              'rss_growth_kb': 0})
+        stage['count'] += 1
+        stage['wall'] += wall
+        stage['cpu'] += cpu
+        stage['max_wall'] = max(stage['max_wall'], wall)
+        if rss_before is not None:
+            stage['rss_growth_kb'] += rss_after - rss_before
+        if self.keep_events:
+            self.events.append({'name': name, 'start': start - self.start, 'wall': wall, 'cpu': cpu,
+                                'depth': depth, 'max_rss_kb': rss_after})
+
+    def add_bytes(self, file_path, nbytes):
+        entry = self.files.get(file_path)
+        if entry is None:
+            try:
+                size = os.path.getsize(file_path)
+            except OSError:
+                size = None
+            entry = self.files[file_path] = {'reads': 0, 'bytes': 0, 'file_size': size}
+        entry['reads'] += 1
+        entry['bytes'] += int(nbytes)
+
+    def add_report(self, report):
+        # Report of a pool worker run on behalf of this one (see pt02_render.py)
+        self.workers.append(report)
+
+    def caches(self):
+        # Cache counters accumulated since the profiler was created
+        caches = {}
+        for cache_dir, stats in _cache_stats().items():
+            before = self.cache_start.get(cache_dir, {})
+            counters = {key: stats[key] - before.get(key, 0) for key in ('hits', 'disk_hits', 'misses', 'evictions')}
+            caches[cache_dir] = dict(counters, entries=stats['entries'], bytes=stats['bytes'],
+                                     hit_rate=_hit_rate(counters))
+        return caches
+
+    def report(self):
+        report = {
+            'run': dict(self.run, pid=os.getpid(), started=self.start_time, python=platform.python_version()),
+            'wall': time.perf_counter() - self.start,
+            'cpu': time.process_time() - self.start_cpu,
+            'max_rss_kb': max_rss_kb(),
+            'stages': self.stages,
+            'files': self.files,
+            'caches': self.caches(),
+        }
+        if self.workers:
+            report['workers'] = merge_reports(self.workers)
+        if self.keep_events:
+            report['events'] = self.events
+        return report
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+
+
+def active_profiler():
+    return _active
+
+
+@contextmanager
+def stage(name):
+    # Time the enclosed block as the stage 'name' of the active profiler
+    profiler = _active
+    if profiler is None:
+        yield
+        return
+
+    rss_before = max_rss_kb()
+    start = time.perf_counter()
+    start_cpu = time.process_time()
+    profiler.depth += 1
+    try:
+        yield
+    finally:
+        profiler.depth -= 1
+        profiler.record(name, start, time.perf_counter() - start, time.process_time() - start_cpu,
+                        rss_before, max_rss_kb(), profiler.depth)
+
+
+def profiled(name=None):
+    # Decorator running every call of a function as a stage (named after the
+    # function by default)
+    def decorate(function):
+        stage_name = name or function.__name__
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return function(*args, **kwargs)
+            with stage(stage_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count_bytes(file_path, nbytes):
+    # Record nbytes of data read from file_path
+    if _active is not None:
+        _active.add_bytes(file_path, nbytes)
+
+
+@contextmanager
+def profiling(profiler):
+    # Make profiler the active one for the enclosed block; a batch driver can
+    # run every site under its own Profiler and keep the reports in memory
+    global _active
+    previous, _active = _active, profiler
+    try:
+        yield profiler
+    finally:
+        _active = previous
+
+
+@contextmanager
+def profile_run(path=None, run=None, keep_events=True):
+    # Profile the enclosed block and write the report to path. Does nothing
+    # when path is None, so scripts can pass their --profile value directly.
+    if path is None:
+        yield None
+        return
+
+    profiler = Profiler(run, keep_events)
+    try:
+        with profiling(profiler):
+            yield profiler
+    finally:
+        profiler.write(path)
+        print(f"Saved profile report to {path}")
+
+
+def merge_reports(reports):
+    # Totals of many reports, e.g. of thousands of site runs: summed stage
+    # times and counts, file bytes and cache counters, largest RSS. Events
+    # are left out.
+    merged = {'runs': 0, 'wall': 0.0, 'cpu': 0.0, 'max_rss_kb': None, 'stages': {}, 'files': {}, 'caches': {}}
+    for report in reports:
+        merged['runs'] += report.get('runs', 1)
+        merged['wall'] += report['wall']
+        merged['cpu'] += report['cpu']
+        if report.get('max_rss_kb') is not None:
+            merged['max_rss_kb'] = max(merged['max_rss_kb'] or 0, report['max_rss_kb'])
+        for name, stage_stats in report['stages'].items():
+            total = merged['stages'].setdefault(name, {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'max_wall': 0.0,
+                                                       'rss_growth_kb': 0})
+            for key in ('count', 'wall', 'cpu', 'rss_growth_kb'):
+                total[key] += stage_stats[key]
+            total['max_wall'] = max(total['max_wall'], stage_stats['max_wall'])
+        for file_path, entry in report['files'].items():
+            total = merged['files'].setdefault(file_path, {'reads': 0, 'bytes': 0, 'file_size': entry['file_size']})
+            total['reads'] += entry['reads']
+            total['bytes'] += entry['bytes']
+        for cache_dir, stats in report['caches'].items():
+            total = merged['caches'].setdefault(cache_dir, {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0})
+            for key in total:
+                total[key] += stats[key]
+    for stats in merged['caches'].values():
+        stats['hit_rate'] = _hit_rate(stats)
+    return merged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge profile reports and print the slowest stages.")
+    parser.add_argument("reports", type=str, nargs='+', help="Profile report JSON files")
+    parser.add_argument("--output", type=str, help="Save the merged report to this JSON file")
+    args = parser.parse_args()
+
+    reports = []
+    for path in args.reports:
+        with open(path) as f:
+            reports.append(json.load(f))
+    merged = merge_reports(reports)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(merged, f, indent=1)
+
+    print(f"{merged['runs']} runs, {merged['wall']:.3f} s wall, {merged['cpu']:.3f} s CPU, "
+          f"max RSS {merged['max_rss_kb']} kB")
+    print(f"{'stage':32s} {'count':>7s} {'wall':>10s} {'cpu':>10s} {'max':>10s}")
+    for name, stats in sorted(merged['stages'].items(), key=lambda item: -item[1]['wall']):
+        print(f"{name:32s} {stats['count']:7d} {stats['wall']:10.4f} {stats['cpu']:10.4f} {stats['max_wall']:10.4f}")
+    for cache_dir, stats in merged['caches'].items():
+        print(f"cache {cache_dir}: {stats['hits']} hits, {stats['disk_hits']} disk hits, {stats['misses']} misses")
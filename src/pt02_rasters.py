@@ -0,0 +1,63 @@
+import json
+import os
+import netCDF4 as nc
+import numpy as np
+
+from pt02_reader import LAT_VAR, LON_VAR
+
+
+# Writers for per-cell result rasters on the PT02 lat/lon grid.
+# 'rasters' maps a name to a (lat, lon) array; 'stacks' maps a name to
+# (axis name, axis values, (n, lat, lon) array) for results with an extra
+# leading axis such as years or months. An output path ending in '.nc' is
+# written as one NetCDF file, anything else as a directory of NPY files.
+
+FILL_VALUE = np.float32(-9e33)
+
+
+def save_rasters(output, lat_values, lon_values, rasters, stacks=None, attributes=None):
+    if output.endswith('.nc'):
+        save_rasters_nc(output, lat_values, lon_values, rasters, stacks, attributes)
+    else:
+        save_rasters_npy(output, lat_values, lon_values, rasters, stacks, attributes)
+    return output
+
+
+def save_rasters_nc(output, lat_values, lon_values, rasters, stacks=None, attributes=None):
+    with nc.Dataset(output, 'w') as dataset:
+        dataset.createDimension(LAT_VAR, len(lat_values))
+        dataset.createDimension(LON_VAR, len(lon_values))
+        dataset.createVariable(LAT_VAR, 'f8', (LAT_VAR,))[:] = lat_values
+        dataset.createVariable(LON_VAR, 'f8', (LON_VAR,))[:] = lon_values
+        dataset.variables[LAT_VAR].units = 'degrees_north'
+        dataset.variables[LON_VAR].units = 'degrees_east'
+
+        for name, (axis_name, axis_values, values) in (stacks or {}).items():
+            if axis_name not in dataset.dimensions:
+                dataset.createDimension(axis_name, len(axis_values))
+                dataset.createVariable(axis_name, np.asarray(axis_values).dtype, (axis_name,))[:] = axis_values
+            variable = dataset.createVariable(name, 'f4', (axis_name, LAT_VAR, LON_VAR), fill_value=FILL_VALUE)
+            variable[:] = np.ma.masked_invalid(values)
+
+        for name, values in rasters.items():
+            variable = dataset.createVariable(name, 'f4', (LAT_VAR, LON_VAR), fill_value=FILL_VALUE)
+            variable[:] = np.ma.masked_invalid(values)
+
+        dataset.setncatts(attributes or {})
+
+
+def save_rasters_npy(output, lat_values, lon_values, rasters, stacks=None, attributes=None):
+    os.makedirs(output, exist_ok=True)
+    np.save(os.path.join(output, f'{LAT_VAR}.npy'), np.asarray(lat_values))
+    np.save(os.path.join(output, f'{LON_VAR}.npy'), np.asarray(lon_values))
+
+    axes = {}
+    for name, (axis_name, axis_values, values) in (stacks or {}).items():
+        np.save(os.path.join(output, f'{axis_name}.npy'), np.asarray(axis_values))
+        np.save(os.path.join(output, f'{name}.npy'), np.asarray(values, dtype=np.float32))
+        axes[name] = axis_name
+    for name, values in rasters.items():
+        np.save(os.path.join(output, f'{name}.npy'), np.asarray(values, dtype=np.float32))
+
+    with open(os.path.join(output, 'index.json'), 'w') as f:
+        json.dump({'rasters': sorted(rasters), 'stacks': axes, 'attributes': attributes or {}}, f, indent=1)
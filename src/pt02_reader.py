@@ -0,0 +1,378 @@
+import csv
+import os
+import netCDF4 as nc
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+from pt02_profile import profiled, stage, count_bytes
+
+
+# Variable names used by the IPMA PT02 NetCDF files
+TIME_VAR = 'time'
+LAT_VAR = 'lat'
+LON_VAR = 'lon'
+PRECIP_VAR = 'var228'
+
+# File name prefix and datetime64 time unit of each PT02 product
+# (ipma/mensal holds the monthly files, ipma/diario the daily ones)
+PRODUCTS = {
+    'mensal': {'prefix': 'PRECIP_PT_mensal', 'time_unit': 'M'},
+    'diario': {'prefix': 'PRECIP_PT_diario', 'time_unit': 'D'},
+}
+
+# Layout of the per-point grid information returned by read_points
+GRID_POINT_DTYPE = np.dtype([('lat_idx', np.intp), ('lon_idx', np.intp),
+                             ('grid_lat', np.float64), ('grid_lon', np.float64)])
+
+# Upper bound for a single (time, lat, lon) block read by read_cells
+MAX_BLOCK_BYTES = 64 * 1024 * 1024
+
+
+def series_dtype(product='mensal'):
+    # Layout of the point series returned by read_inputs
+    return np.dtype([('time', f"datetime64[{PRODUCTS[product]['time_unit']}]"), ('precip', np.float32)])
+
+
+@profiled()
+def decode_time(time_data, product='mensal'):
+    # Decode the PT02 'day as %Y%m%d.%f' time values into datetime64 in bulk,
+    # with integer arithmetic on the YYYYMMDD digits instead of strptime
+    ymd = np.asarray(time_data, dtype=np.float64).astype(np.int64)
+    months = (ymd // 10000 - 1970) * 12 + (ymd // 100 % 100 - 1)
+    dates = months.astype('datetime64[M]')
+    if PRODUCTS[product]['time_unit'] == 'D':
+        dates = dates.astype('datetime64[D]') + (ymd % 100 - 1).astype('timedelta64[D]')
+    return dates
+
+
+def encode_time(dates):
+    # Inverse of decode_time: datetime64 values back to the PT02 YYYYMMDD.5
+    # convention. Monthly values are stamped on the last day of the month,
+    # like the PRECIP_PT_mensal files.
+    dates = np.asarray(dates)
+    if np.datetime_data(dates.dtype)[0] == 'M':
+        dates = (dates + 1).astype('datetime64[D]') - 1
+    days = dates.astype('datetime64[D]')
+    months = days.astype('datetime64[M]')
+    years = months.astype('datetime64[Y]').astype(np.int64) + 1970
+    ymd = years * 10000 + (months.astype(np.int64) % 12 + 1) * 100 + (days - months).astype(np.int64) + 1
+    return ymd + 0.5
+
+
+@profiled()
+def make_series(time_data, precip_data, product='mensal'):
+    # Sort decoded times with a stable argsort and pack them with the values
+    # into a structured array (masked values become NaN)
+    order = np.argsort(time_data, kind='stable')
+    series = np.empty(len(order), dtype=series_dtype(product))
+    series['time'] = time_data[order]
+    series['precip'] = np.ma.filled(np.ma.asarray(precip_data).astype(np.float32), np.nan)[order]
+    return series
+
+
+def list_product_files(directory, product='mensal'):
+    # Return the full paths of the NetCDF files of a product, sorted by name
+    prefix = PRODUCTS[product]['prefix']
+    return [os.path.join(directory, filename) for filename in sorted(os.listdir(directory))
+            if filename.startswith(prefix) and filename.endswith(".nc")]
+
+
+def nearest_index(coord_values, target):
+    # Index of the grid coordinate closest to the target value
+    return int(nearest_indices(coord_values, target))
+
+
+def nearest_indices(coord_values, targets):
+    # Vectorized nearest-neighbour lookup on a 1-D coordinate axis.
+    # The PT02 grid is separable, so a point's cell is found with one binary
+    # search per axis instead of scanning every grid node for every point.
+    # Ties resolve to the lower index, like np.abs(coords - target).argmin().
+    coords = np.asarray(coord_values, dtype=np.float64)
+    targets = np.asarray(targets, dtype=np.float64)
+    order = np.argsort(coords, kind='stable')
+    sorted_coords = coords[order]
+
+    pos = np.clip(np.searchsorted(sorted_coords, targets), 1, len(coords) - 1)
+    below = order[pos - 1]
+    above = order[pos]
+    dist_below = np.abs(coords[below] - targets)
+    dist_above = np.abs(coords[above] - targets)
+    take_above = (dist_above < dist_below) | ((dist_above == dist_below) & (above < below))
+    return np.where(take_above, above, below)
+
+
+def snap_points(lat_values, lon_values, target_lats, target_lons):
+    # Nearest grid cell of every point, as a GRID_POINT_DTYPE array
+    grid_points = np.empty(len(target_lats), dtype=GRID_POINT_DTYPE)
+    grid_points['lat_idx'] = nearest_indices(lat_values, target_lats)
+    grid_points['lon_idx'] = nearest_indices(lon_values, target_lons)
+    grid_points['grid_lat'] = np.asarray(lat_values)[grid_points['lat_idx']]
+    grid_points['grid_lon'] = np.asarray(lon_values)[grid_points['lon_idx']]
+    return grid_points
+
+
+def read_cells(precip_var, lat_idx, lon_idx, max_block_bytes=MAX_BLOCK_BYTES):
+    # Read the full time series of many grid cells from an open var228 variable.
+    # The bounding box of the requested cells is read in time blocks of at most
+    # max_block_bytes and the cells are gathered from each block, so the
+    # memory use does not depend on the length of the time axis.
+    lat_idx = np.asarray(lat_idx)
+    lon_idx = np.asarray(lon_idx)
+    lat0, lat1 = lat_idx.min(), lat_idx.max() + 1
+    lon0, lon1 = lon_idx.min(), lon_idx.max() + 1
+    n_time = precip_var.shape[0]
+
+    step_bytes = (lat1 - lat0) * (lon1 - lon0) * precip_var.dtype.itemsize
+    step = max(1, max_block_bytes // step_bytes)
+
+    precip_matrix = np.empty((len(lat_idx), n_time), dtype=np.float32)
+    for t0 in range(0, n_time, step):
+        block = np.ma.filled(precip_var[t0:t0 + step, lat0:lat1, lon0:lon1].astype(np.float32), np.nan)
+        precip_matrix[:, t0:t0 + step] = block[:, lat_idx - lat0, lon_idx - lon0].T
+    return precip_matrix
+
+
+def read_file_block(file_path, target_lats=None, target_lons=None):
+    # Read one NetCDF file: the raw time values, the coordinates and either
+    # the full (time, lat, lon) cube or, when target points are given, only
+    # the points x time columns of their nearest cells (see read_cells).
+    # Masked values are returned as NaN.
+    with nc.Dataset(file_path) as dataset:
+        lat_values = np.asarray(dataset.variables[LAT_VAR][:], dtype=np.float64)
+        lon_values = np.asarray(dataset.variables[LON_VAR][:], dtype=np.float64)
+        time_data = np.asarray(dataset.variables[TIME_VAR][:], dtype=np.float64)
+        precip_var = dataset.variables[PRECIP_VAR]
+
+        if target_lats is None:
+            block = np.ma.filled(precip_var[:].astype(np.float32), np.nan)
+        else:
+            grid_points = snap_points(lat_values, lon_values, target_lats, target_lons)
+            block = read_cells(precip_var, grid_points['lat_idx'], grid_points['lon_idx'])
+
+    return time_data, block, lat_values, lon_values
+
+
+def _read_file_block_shared(file_path, target_lats, target_lons):
+    # Process pool worker: decode one file and hand the time values and the
+    # data block back through one shared memory segment instead of pickling
+    time_data, block, lat_values, lon_values = read_file_block(file_path, target_lats, target_lons)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, time_data.nbytes + block.nbytes))
+    np.ndarray(time_data.shape, time_data.dtype, buffer=shm.buf)[:] = time_data
+    np.ndarray(block.shape, block.dtype, buffer=shm.buf, offset=time_data.nbytes)[:] = block
+    shm.close()
+    # The parent process owns the segment from now on and unlinks it after
+    # copying (or when the read is abandoned); stop this worker's resource
+    # tracker from removing it at exit. The tracker knows POSIX segments by
+    # their '/'-prefixed name.
+    tracked_name = shm.name if os.name != 'posix' or shm.name.startswith('/') else '/' + shm.name
+    resource_tracker.unregister(tracked_name, 'shared_memory')
+    return shm.name, time_data.shape, block.shape, lat_values, lon_values
+
+
+def _take_shared_block(name, time_shape, block_shape, lat_values, lon_values):
+    # Copy a worker's arrays out of shared memory and release the segment
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        time_data = np.ndarray(time_shape, np.float64, buffer=shm.buf).copy()
+        block = np.ndarray(block_shape, np.float32, buffer=shm.buf, offset=time_data.nbytes).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return time_data, block, lat_values, lon_values
+
+
+def _release_shared_block(name):
+    # Unlink the segment of a worker result that will never be consumed
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def read_file_blocks(file_paths, target_lats=None, target_lons=None, workers=1):
+    # Yield read_file_block results for every file, in file order. With
+    # workers > 1 the files are decoded in a process pool; the results are
+    # consumed in submission order, so the merge that follows is identical to
+    # the serial path. Files that fail are reported and skipped.
+    # Under --profile every file is a 'read_file' stage (with workers, the
+    # wait for the worker and the copy out of shared memory) and its decoded
+    # bytes are counted (see pt02_profile.py)
+    if workers <= 1:
+        for file_path in file_paths:
+            try:
+                with stage('read_file'):
+                    result = read_file_block(file_path, target_lats, target_lons)
+            except Exception as e:
+                print(f"An error occurred while processing {os.path.basename(file_path)}: {e}")
+                continue
+            count_bytes(file_path, result[0].nbytes + result[1].nbytes)
+            yield result
+        return
+
+    pool = ProcessPoolExecutor(max_workers=workers)
+    futures = []
+    # Futures before this index own no segment any more (taken or failed)
+    consumed = 0
+    try:
+        futures = [pool.submit(_read_file_block_shared, file_path, target_lats, target_lons) for file_path in file_paths]
+        for k, (file_path, future) in enumerate(zip(file_paths, futures)):
+            consumed = k
+            try:
+                with stage('read_file'):
+                    shared = future.result()
+                    consumed = k + 1
+                    result = _take_shared_block(*shared)
+            except Exception as e:
+                print(f"An error occurred while processing {os.path.basename(file_path)}: {e}")
+                continue
+            count_bytes(file_path, result[0].nbytes + result[1].nbytes)
+            yield result
+    finally:
+        # Closed early, failed or interrupted: drop the files not started yet
+        # and free the segments of the ones the workers already decoded
+        pending = futures[consumed:]
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
+        for future in pending:
+            if not future.cancelled() and future.exception() is None:
+                _release_shared_block(future.result()[0])
+
+
+@profiled()
+def read_inputs(directory, target_lat, target_lon, product='mensal', workers=1, interp='nearest'):
+    # Imported here because pt02_store itself builds on this module
+    from pt02_store import open_store
+
+    # Bilinear / inverse distance interpolation between grid cells (see pt02_interp.py)
+    if interp != 'nearest':
+        from pt02_interp import read_interpolated
+        all_time_data, precip_matrix, _ = read_interpolated(directory, [target_lat], [target_lon],
+                                                            product, workers, interp)
+        return make_series(all_time_data, precip_matrix[0], product)
+
+    # Use the consolidated store when the directory has one (see pt02_store.py)
+    store = open_store(directory, product)
+    if store is not None:
+        time_data, precip_data, _ = store.read_point_series(target_lat, target_lon)
+        return make_series(decode_time(time_data, product), precip_data, product)
+
+    # Otherwise loop through all the NetCDF files of the product in the
+    # directory, reading only the column of the nearest cell from each one
+    time_parts = []
+    precip_parts = []
+    for time_data, block, _, _ in read_file_blocks(list_product_files(directory, product),
+                                                   [target_lat], [target_lon], workers):
+        # Append the decoded time axis and the values to the lists
+        time_parts.append(decode_time(time_data, product))
+        precip_parts.append(block[0])
+
+    # Return the time-sorted series as a structured array (see series_dtype)
+    return make_series(np.concatenate(time_parts), np.concatenate(precip_parts), product)
+
+
+@profiled()
+def read_points(directory, target_lats, target_lons, product='mensal', workers=1, interp='nearest'):
+    # Batch version of read_inputs: extract the series of many (lat, lon)
+    # points opening every NetCDF file once. Returns the sorted datetime64 axis,
+    # a points x time float32 matrix (masked values as NaN) and the snapped
+    # grid cell of every point (GRID_POINT_DTYPE).
+    from pt02_store import open_store
+
+    if interp != 'nearest':
+        from pt02_interp import read_interpolated
+        return read_interpolated(directory, target_lats, target_lons, product, workers, interp)
+
+    target_lats = np.atleast_1d(np.asarray(target_lats, dtype=np.float64))
+    target_lons = np.atleast_1d(np.asarray(target_lons, dtype=np.float64))
+
+    # The consolidated store is already in time order: gather the cells directly
+    store = open_store(directory, product)
+    if store is not None:
+        grid_points = snap_points(store.lat, store.lon, target_lats, target_lons)
+        precip_matrix = store.read_cells(grid_points['lat_idx'], grid_points['lon_idx'])
+        return decode_time(store.time, product), precip_matrix, grid_points
+
+    time_parts = []
+    precip_blocks = []
+    for time_data, block, lat_values, lon_values in read_file_blocks(list_product_files(directory, product),
+                                                                     target_lats, target_lons, workers):
+        time_parts.append(decode_time(time_data, product))
+        precip_blocks.append(block)
+
+    # The grid is the same in every file, snap the points once for the result
+    grid_points = snap_points(lat_values, lon_values, target_lats, target_lons)
+
+    # Sort the time axis and reorder the matrix columns to match
+    all_time_data = np.concatenate(time_parts)
+    order = np.argsort(all_time_data, kind='stable')
+    precip_matrix = np.concatenate(precip_blocks, axis=1)[:, order]
+    return all_time_data[order], precip_matrix, grid_points
+
+
+@profiled()
+def read_cube(directory, product='mensal', workers=1):
+    # Read the whole (time, lat, lon) precipitation cube of a product in time
+    # order, with masked values as NaN. Returns the datetime64 time axis, the
+    # lat and lon coordinates and the float32 cube.
+    from pt02_store import open_store
+
+    store = open_store(directory, product)
+    if store is not None:
+        cube = np.concatenate([np.moveaxis(block, -1, 0) for block in store.blocks])
+        return decode_time(store.time, product), store.lat, store.lon, cube
+
+    time_parts = []
+    cube_parts = []
+    for time_data, block, lat_values, lon_values in read_file_blocks(list_product_files(directory, product),
+                                                                     workers=workers):
+        time_parts.append(decode_time(time_data, product))
+        cube_parts.append(block)
+
+    all_time_data = np.concatenate(time_parts)
+    order = np.argsort(all_time_data, kind='stable')
+    return all_time_data[order], lat_values, lon_values, np.concatenate(cube_parts)[order]
+
+
+def load_points_file(path, with_names=False):
+    # Read (lat, lon) pairs from a CSV file. A header row is optional; when
+    # present the 'lat'/'latitude' and 'lon'/'longitude' columns are used,
+    # otherwise the first two columns are taken as lat, lon. With with_names
+    # the site names ('name'/'site'/'id' column, else the row number) are
+    # returned as well.
+    with open(path, newline='') as f:
+        rows = [row for row in csv.reader(f) if row]
+    if not rows:
+        raise ValueError(f"{path}: no points")
+
+    lat_col, lon_col, name_col = 0, 1, None
+    try:
+        float(rows[0][0])
+    except ValueError:
+        header = [name.strip().lower() for name in rows.pop(0)]
+        lat_col = next((i for i, name in enumerate(header) if name in ('lat', 'latitude')), None)
+        lon_col = next((i for i, name in enumerate(header) if name in ('lon', 'longitude')), None)
+        if lat_col is None or lon_col is None:
+            raise ValueError(f"{path}: header needs lat/lon columns, got {header}")
+        name_col = next((i for i, name in enumerate(header) if name in ('name', 'site', 'id')), None)
+        if not rows:
+            raise ValueError(f"{path}: no points")
+
+    points = np.array([(float(row[lat_col]), float(row[lon_col])) for row in rows], dtype=np.float64)
+    if not with_names:
+        return points[:, 0], points[:, 1]
+    names = [row[name_col].strip() if name_col is not None else str(i) for i, row in enumerate(rows)]
+    return points[:, 0], points[:, 1], names
+
+
+def write_points_csv(path, target_lats, target_lons, all_time_data, precip_matrix, grid_points):
+    # One row per point: requested and snapped coordinates followed by the series
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['lat', 'lon', 'grid_lat', 'grid_lon'] + list(np.datetime_as_string(all_time_data)))
+        for i in range(len(target_lats)):
+            writer.writerow([target_lats[i], target_lons[i], grid_points['grid_lat'][i], grid_points['grid_lon'][i]]
+                            + [f"{value:.6g}" for value in precip_matrix[i]])
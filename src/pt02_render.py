@@ -0,0 +1,140 @@
+import argparse
+import os
+import matplotlib
+# Headless rendering: never open windows, draw straight to files
+matplotlib.use('Agg')
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+import ipma_pt2_plot
+import bravura_precip_damwater
+from pt02_reader import read_points, load_points_file, make_series
+from pt02_timeindex import TimeIndex
+from pt02_interp import INTERP_METHODS
+from pt02_profile import DEFAULT_REPORT, Profiler, active_profiler, profiled, profiling, profile_run
+
+
+# Batch rendering of the figure set of either script for many sites.
+# The series of all sites are extracted in one pass (read_points), the sites
+# are split across a process pool and every process keeps one figure per
+# chart type, redrawing it for each site instead of building a new one.
+
+DEFAULT_TEMPLATE = os.path.join('figures', '{site}_{figure}.png')
+
+# Figure sets of the scripts, drawn for every site: name -> function drawing
+# it into fig (or a new figure when fig is None) and returning the figure.
+# All sites share one time axis, so its TimeIndex is built once per batch.
+FIGURES = {
+    'ipma_pt2_plot': {
+        'monthly_histogram': lambda series, lat, lon, output, fig, time_index: ipma_pt2_plot.plot_monthly_precip_histogram(
+            series['time'], series['precip'], lat, lon, output=output, show=False, fig=fig, time_index=time_index),
+        'monthly_contribution': lambda series, lat, lon, output, fig, time_index: ipma_pt2_plot.plot_monthly_precip(
+            series, lat, lon, output=output, show=False, fig=fig, time_index=time_index),
+        'yearly': lambda series, lat, lon, output, fig, time_index: ipma_pt2_plot.plot_yearly_precip(
+            series['time'], series['precip'], lat, lon, output=output, show=False, fig=fig, time_index=time_index),
+    },
+    'bravura_precip_damwater': {
+        'yearly': lambda series, lat, lon, output, fig, time_index: bravura_precip_damwater.plot_yearly_precip(
+            series, lat, lon, output=output, show=False, fig=fig, time_index=time_index),
+        'water_level': lambda series, lat, lon, output, fig, time_index: bravura_precip_damwater.plot_waterlevel_yearly(
+            series['time'], series['precip'], lat, lon, output=output, show=False, fig=fig, time_index=time_index),
+        'waterlevel_precip': lambda series, lat, lon, output, fig, time_index: bravura_precip_damwater.plot_combined_waterlevel_and_precip(
+            series, lat, lon, output=output, show=False, fig=fig, time_index=time_index),
+    },
+}
+DEFAULT_SCRIPT = 'ipma_pt2_plot'
+
+# Figures of the current process by (script, figure name), reused from one
+# site to the next
+_figures = {}
+
+
+def output_path(template, site, lat, lon, figure):
+    # Fill the output template; available fields are site, lat, lon and figure
+    return template.format(site=site, lat=lat, lon=lon, figure=figure)
+
+
+@profiled()
+def render_site(series, site, lat, lon, template=DEFAULT_TEMPLATE, time_index=None, script=DEFAULT_SCRIPT):
+    # Draw the full figure set of one site and return the written paths
+    outputs = []
+    for figure_name, draw in FIGURES[script].items():
+        output = output_path(template, site, lat, lon, figure_name)
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        key = (script, figure_name)
+        _figures[key] = draw(series, lat, lon, output, _figures.get(key), time_index)
+        outputs.append(output)
+    return outputs
+
+
+def render_batch(all_time_data, sites, template=DEFAULT_TEMPLATE, script=DEFAULT_SCRIPT):
+    # Pool task: render a list of (site, lat, lon, precip) entries
+    outputs = []
+    time_index = TimeIndex(all_time_data)
+    for site, lat, lon, precip in sites:
+        # Points whose nearest cell is over the sea have no data at all
+        if np.isnan(precip).all():
+            print(f"Skipping site {site}: no data at the nearest grid cell")
+            continue
+        outputs.extend(render_site(make_series(all_time_data, precip), site, lat, lon, template, time_index, script))
+    return outputs
+
+
+def render_batch_profiled(all_time_data, sites, template=DEFAULT_TEMPLATE, script=DEFAULT_SCRIPT):
+    # Pool task under --profile: render_batch with its own profiler, returning
+    # the outputs and the worker's report for the parent to collect
+    profiler = Profiler(run={'sites': len(sites)}, keep_events=False)
+    with profiling(profiler):
+        outputs = render_batch(all_time_data, sites, template, script)
+    return outputs, profiler.report()
+
+
+def render_sites(directory, target_lats, target_lons, names, template=DEFAULT_TEMPLATE, workers=1, interp='nearest',
+                 script=DEFAULT_SCRIPT):
+    # Extract every site in one pass and render their figures, serially or
+    # over a process pool. Returns the list of written files.
+    all_time_data, precip_matrix, _ = read_points(directory, target_lats, target_lons, workers=workers, interp=interp)
+    sites = list(zip(names, target_lats.tolist(), target_lons.tolist(), precip_matrix))
+
+    if workers <= 1:
+        return render_batch(all_time_data, sites, template, script)
+
+    # A few batches per worker keeps the pool busy while each process still
+    # renders many sites with the same figures
+    batches = [sites[i::workers * 4] for i in range(min(len(sites), workers * 4))]
+    outputs = []
+    profiler = active_profiler()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        if profiler is None:
+            for batch_outputs in pool.map(render_batch, [all_time_data] * len(batches), batches, [template] * len(batches),
+                                          [script] * len(batches)):
+                outputs.extend(batch_outputs)
+        else:
+            # The workers have their own profilers; their reports are merged under 'workers'
+            for batch_outputs, report in pool.map(render_batch_profiled, [all_time_data] * len(batches), batches,
+                                                  [template] * len(batches), [script] * len(batches)):
+                outputs.extend(batch_outputs)
+                profiler.add_report(report)
+    return outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render the precipitation figures of many sites without a display.")
+    parser.add_argument("--points-file", type=str, required=True, help="CSV file with lat,lon (and optional name) columns")
+    parser.add_argument("--data-directory", type=str, required=True, help="Path to the NetCDF data directory")
+    parser.add_argument("--output-template", type=str, default=DEFAULT_TEMPLATE,
+                        help="Output path template with {site}, {lat}, {lon} and {figure} fields")
+    parser.add_argument("--script", type=str, default=DEFAULT_SCRIPT, choices=list(FIGURES),
+                        help="Script whose figure set is rendered")
+    parser.add_argument("--workers", type=int, default=1, help="Number of rendering processes")
+    parser.add_argument("--interp", type=str, default='nearest', choices=INTERP_METHODS,
+                        help="Nearest grid cell or interpolation between the surrounding cells")
+    parser.add_argument("--profile", type=str, nargs='?', const=DEFAULT_REPORT,
+                        help="Save a per-stage timing/memory report to this JSON file (default %(const)s)")
+    args = parser.parse_args()
+
+    target_lats, target_lons, names = load_points_file(args.points_file, with_names=True)
+    with profile_run(args.profile, run=dict(vars(args), script=os.path.basename(__file__))):
+        outputs = render_sites(args.data_directory, target_lats, target_lons, names, args.output_template,
+                               args.workers, args.interp, args.script)
+    print(f"Rendered {len(outputs)} figures for {len(names)} sites")
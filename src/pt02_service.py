@@ -0,0 +1,213 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+
+from pt02_reader import read_cube, nearest_index
+from pt02_timeindex import TimeIndex
+from pt02_climatology import climatology
+from pt02_interp import INTERP_METHODS, make_stencils, apply_stencils
+from pt02_basins import WEIGHTS_DIRNAME, load_basins, weight_matrix, weighted_series
+from pt02_store import STORE_DIRNAME
+
+
+# Long running local HTTP service for the PT02 grid.
+# The cube is read once at startup (from the consolidated store when there is
+# one) and every request is answered from memory, so dashboards do not pay
+# the interpreter start, the imports and the data load on every query. The
+# queries run in a thread pool so slow clients never block the event loop.
+#
+#   GET /series?lat=..&lon=..[&interp=bilinear]   point series
+#   GET /annual?lat=..&lon=..                      annual totals of a point
+#   GET /stats?lat=..&lon=..                       climatology of a point
+#   GET /basin?name=..                             basin series (--basins-file)
+#   GET /health
+#
+# Responses are JSON (missing values as null), or an Arrow IPC stream with
+# format=arrow when pyarrow is installed.
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8602
+MAX_HEADER_BYTES = 64 * 1024
+
+
+class QueryError(Exception):
+    # A bad request, answered with its HTTP status and message
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class GridData:
+    # The time axis, grid and (time, lat, lon) cube of a product, in memory
+
+    def __init__(self, directory, product='mensal', workers=1, basins_file=None):
+        self.time, self.lat, self.lon, self.cube = read_cube(directory, product, workers)
+        self.time_index = TimeIndex(self.time)
+        self.time_labels = np.datetime_as_string(self.time).tolist()
+
+        self.basin_names = []
+        self.basin_series = None
+        if basins_file:
+            basins = load_basins(basins_file)
+            weights = weight_matrix(basins, self.lat, self.lon,
+                                    cache_dir=os.path.join(directory, STORE_DIRNAME, WEIGHTS_DIRNAME))
+            self.basin_names = list(basins)
+            self.basin_series = weighted_series(weights, self.cube)
+
+    def point(self, lat, lon, interp='nearest'):
+        # Series of a point and the grid cell it snapped to
+        lat_idx = nearest_index(self.lat, lat)
+        lon_idx = nearest_index(self.lon, lon)
+        if interp == 'nearest':
+            values = self.cube[:, lat_idx, lon_idx]
+        else:
+            stencil_lat, stencil_lon, weights = make_stencils(self.lat, self.lon, [lat], [lon], interp)
+            values = apply_stencils(np.moveaxis(self.cube[:, stencil_lat, stencil_lon], 0, -1), weights)[0]
+        return values, {'lat': lat, 'lon': lon, 'grid_lat': float(self.lat[lat_idx]),
+                        'grid_lon': float(self.lon[lon_idx])}
+
+
+def _float_arg(params, name):
+    try:
+        value = float(params[name][0])
+    except (KeyError, ValueError):
+        raise QueryError(400, f"'{name}' must be given as a number")
+    # float() also parses 'nan' and 'inf', which would snap to an edge cell
+    if not math.isfinite(value):
+        raise QueryError(400, f"'{name}' must be a finite number")
+    return value
+
+
+def _values(values):
+    # JSON friendly list of floats, NaN as None
+    return [None if value != value else value for value in np.asarray(values, dtype=np.float64).tolist()]
+
+
+def query(data, path, params):
+    # Answer one request: returns the metadata and the {column: values} table
+    if path == '/health':
+        return {'status': 'ok', 'timesteps': len(data.time), 'basins': len(data.basin_names)}, {}
+
+    if path == '/basin':
+        name = params.get('name', [None])[0]
+        if name not in data.basin_names:
+            raise QueryError(404, f"Unknown basin {name}")
+        values = data.basin_series[data.basin_names.index(name)]
+        return {'basin': name}, {'time': data.time_labels, 'precip': values}
+
+    if path not in ('/series', '/annual', '/stats'):
+        raise QueryError(404, f"Unknown endpoint {path}")
+
+    interp = params.get('interp', ['nearest'])[0]
+    if interp not in INTERP_METHODS:
+        raise QueryError(400, f"'interp' must be one of {INTERP_METHODS}")
+    values, meta = data.point(_float_arg(params, 'lat'), _float_arg(params, 'lon'), interp)
+
+    if path == '/series':
+        return meta, {'time': data.time_labels, 'precip': values}
+
+    annual = data.time_index.yearly_sum(values.astype(np.float64))
+    if path == '/annual':
+        return meta, {'year': data.time_index.years.tolist(), 'precip': annual}
+
+    stats = climatology(annual)
+    return meta, {name: [float(value)] for name, value in stats.items()}
+
+
+def json_response(meta, table):
+    body = dict(meta)
+    body.update({name: _values(column) if name not in ('time', 'year') else column for name, column in table.items()})
+    return 'application/json', json.dumps(body).encode()
+
+
+def arrow_response(meta, table):
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise QueryError(406, "format=arrow needs pyarrow to be installed")
+    arrow_table = pa.table({name: pa.array(column) for name, column in table.items()})
+    arrow_table = arrow_table.replace_schema_metadata({key: str(value) for key, value in meta.items()})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, arrow_table.schema) as writer:
+        writer.write_table(arrow_table)
+    return 'application/vnd.apache.arrow.stream', sink.getvalue().to_pybytes()
+
+
+def handle_request(data, target):
+    # Status, content type and body of a request target (path and query string)
+    url = urlsplit(target)
+    params = parse_qs(url.query)
+    try:
+        meta, table = query(data, url.path, params)
+        if params.get('format', ['json'])[0] == 'arrow':
+            return (200,) + arrow_response(meta, table)
+        return (200,) + json_response(meta, table)
+    except QueryError as e:
+        return e.status, 'application/json', json.dumps({'error': str(e)}).encode()
+
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           406: 'Not Acceptable', 500: 'Internal Server Error'}
+
+
+async def serve_connection(data, reader, writer):
+    # HTTP/1.1 with keep-alive: answer requests until the client closes
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                header = await reader.readuntil(b'\r\n\r\n')
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                break
+            lines = header.decode('latin-1').split('\r\n')
+            method, target, version = (lines[0].split(' ') + ['', '', ''])[:3]
+            headers = {key.strip().lower(): value.strip() for key, _, value in
+                       (line.partition(':') for line in lines[1:] if line)}
+            keep_alive = (headers.get('connection', '').lower() != 'close'
+                          and version.upper() == 'HTTP/1.1')
+
+            if method != 'GET':
+                status, content_type, body = 405, 'application/json', b'{"error": "only GET is supported"}'
+            else:
+                try:
+                    status, content_type, body = await loop.run_in_executor(None, handle_request, data, target)
+                except Exception as e:
+                    status, content_type, body = 500, 'application/json', json.dumps({'error': str(e)}).encode()
+
+            writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}"
+                         f"\r\n\r\n".encode() + body)
+            await writer.drain()
+            if not keep_alive:
+                break
+    finally:
+        writer.close()
+
+
+async def run_server(data, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    server = await asyncio.start_server(lambda reader, writer: serve_connection(data, reader, writer),
+                                        host, port, limit=MAX_HEADER_BYTES)
+    print(f"Serving {len(data.time)} timesteps of a {len(data.lat)}x{len(data.lon)} grid on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve PT02 point and basin precipitation series over HTTP.")
+    parser.add_argument("--data-directory", type=str, required=True, help="Path to the NetCDF data directory")
+    parser.add_argument("--product", type=str, default='mensal', choices=['mensal', 'diario'], help="PT02 product")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used to read the NetCDF files")
+    parser.add_argument("--basins-file", type=str, help="Basins to serve on /basin (see pt02_basins.py)")
+    parser.add_argument("--host", type=str, default=DEFAULT_HOST, help="Address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+    args = parser.parse_args()
+
+    data = GridData(args.data_directory, args.product, args.workers, args.basins_file)
+    try:
+        asyncio.run(run_server(data, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
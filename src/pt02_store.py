@@ -0,0 +1,261 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import netCDF4 as nc
+import numpy as np
+
+from pt02_reader import TIME_VAR, LAT_VAR, LON_VAR, PRECIP_VAR, list_product_files, nearest_index
+from pt02_profile import profiled
+
+
+# Consolidated store of a PT02 product, written next to the source files.
+# The precipitation is kept in blocks of shape (lat, lon, time), so the whole
+# series of one grid cell is a single contiguous read from each block.
+STORE_DIRNAME = '.pt02_store'
+MANIFEST_NAME = 'manifest.json'
+STORE_VERSION = 2
+
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+def default_store_dir(directory, product='mensal'):
+    return os.path.join(directory, STORE_DIRNAME, product)
+
+
+def file_sha256(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def source_entry(file_path, n_time):
+    stat = os.stat(file_path)
+    return {'name': os.path.basename(file_path), 'size': stat.st_size, 'mtime': stat.st_mtime,
+            'sha256': file_sha256(file_path), 'n_time': int(n_time)}
+
+
+def read_manifest(store_dir):
+    manifest_path = os.path.join(store_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def write_manifest(store_dir, manifest):
+    # Write to a temporary file first so a crash never leaves a half manifest
+    manifest_path = os.path.join(store_dir, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def store_is_current(directory, product='mensal', store_dir=None):
+    # Compare the manifest against the source files. Size and mtime are
+    # checked first; the content hash is only computed for files whose stat
+    # changed, so an untouched archive is validated without reading it.
+    store_dir = store_dir or default_store_dir(directory, product)
+    manifest = read_manifest(store_dir)
+    if manifest is None or manifest.get('version') != STORE_VERSION:
+        return False
+
+    file_paths = list_product_files(directory, product)
+    recorded = {entry['name']: entry for entry in manifest['sources']}
+    if sorted(recorded) != [os.path.basename(path) for path in file_paths]:
+        return False
+
+    for file_path in file_paths:
+        entry = recorded[os.path.basename(file_path)]
+        stat = os.stat(file_path)
+        if stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']:
+            continue
+        if file_sha256(file_path) != entry['sha256']:
+            return False
+        # Same content with a new mtime (copy, touch): remember the new stat
+        entry['size'], entry['mtime'] = stat.st_size, stat.st_mtime
+        write_manifest(store_dir, manifest)
+    return True
+
+
+@profiled()
+def consolidate(directory, product='mensal', store_dir=None, force=False):
+    # Build the consolidated store from the product NetCDF files, unless an
+    # up to date store is already present. Returns the store directory.
+    store_dir = store_dir or default_store_dir(directory, product)
+    if not force and store_is_current(directory, product, store_dir):
+        return store_dir
+    if not force and append_timesteps(directory, product, store_dir):
+        return store_dir
+
+    file_paths = list_product_files(directory, product)
+    if not file_paths:
+        raise FileNotFoundError(f"No {product} NetCDF files found in {directory}")
+
+    # Rebuild from scratch in a sibling directory and swap it in at the end
+    build_dir = store_dir + '.building'
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+
+    # First pass: read only the coordinate variables to lay out the time axis
+    time_parts = []
+    for file_path in file_paths:
+        with nc.Dataset(file_path) as dataset:
+            time_parts.append(np.asarray(dataset.variables[TIME_VAR][:], dtype=np.float64))
+            if len(time_parts) == 1:
+                lat_values = np.asarray(dataset.variables[LAT_VAR][:], dtype=np.float64)
+                lon_values = np.asarray(dataset.variables[LON_VAR][:], dtype=np.float64)
+
+    all_time = np.concatenate(time_parts)
+    order = np.argsort(all_time, kind='stable')
+    # Position of every source timestep in the chronological axis
+    positions = np.empty_like(order)
+    positions[order] = np.arange(len(order))
+
+    np.save(os.path.join(build_dir, 'time.npy'), all_time[order])
+    np.save(os.path.join(build_dir, 'lat.npy'), lat_values)
+    np.save(os.path.join(build_dir, 'lon.npy'), lon_values)
+
+    # Second pass: scatter every file into the cell-major precipitation block
+    block_name = 'precip_000.npy'
+    precip = np.lib.format.open_memmap(os.path.join(build_dir, block_name), mode='w+', dtype=np.float32,
+                                       shape=(len(lat_values), len(lon_values), len(all_time)))
+    sources = []
+    offset = 0
+    for file_path, time_part in zip(file_paths, time_parts):
+        with nc.Dataset(file_path) as dataset:
+            cube = np.ma.filled(dataset.variables[PRECIP_VAR][:].astype(np.float32), np.nan)
+        precip[:, :, positions[offset:offset + len(time_part)]] = cube.transpose(1, 2, 0)
+        offset += len(time_part)
+        sources.append(source_entry(file_path, len(time_part)))
+    precip.flush()
+    del precip
+
+    write_manifest(build_dir, {
+        'version': STORE_VERSION,
+        'product': product,
+        # Identifies this full build; appends keep it (see pt02_aggregates.py)
+        'build_id': os.urandom(8).hex(),
+        'shape': [len(lat_values), len(lon_values)],
+        'n_time': int(len(all_time)),
+        'sources': sources,
+        'blocks': [{'file': block_name, 'n_time': int(len(all_time))}],
+    })
+
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.replace(build_dir, store_dir)
+    return store_dir
+
+
+def append_timesteps(directory, product='mensal', store_dir=None):
+    # Incremental update: when the only changes to the sources are new
+    # timesteps after the end of the store (new files, or new records at the
+    # end of existing files), read just those and add them to the store as a
+    # new block. Timesteps already in the store are assumed not to be revised;
+    # use a full rebuild (--force) after a revision. Returns False when the
+    # changes are not a pure append, leaving the store untouched.
+    store_dir = store_dir or default_store_dir(directory, product)
+    manifest = read_manifest(store_dir)
+    if manifest is None or manifest.get('version') != STORE_VERSION:
+        return False
+
+    file_paths = list_product_files(directory, product)
+    recorded = {entry['name']: entry for entry in manifest['sources']}
+    if not set(recorded) <= {os.path.basename(path) for path in file_paths}:
+        return False
+    store_time = np.load(os.path.join(store_dir, 'time.npy'))[:manifest['n_time']]
+
+    sources = []
+    time_parts = []
+    cube_parts = []
+    for file_path in file_paths:
+        entry = recorded.get(os.path.basename(file_path))
+        stat = os.stat(file_path)
+        if entry is not None and stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']:
+            sources.append(entry)
+            continue
+
+        with nc.Dataset(file_path) as dataset:
+            time_data = np.asarray(dataset.variables[TIME_VAR][:], dtype=np.float64)
+            start = entry['n_time'] if entry is not None else 0
+            # The recorded timesteps must still be there and the new ones must
+            # all come after the end of the store
+            if (len(time_data) <= start or not np.isin(time_data[:start], store_time).all()
+                    or time_data[start:].min() <= store_time[-1]):
+                return False
+            time_parts.append(time_data[start:])
+            cube_parts.append(np.ma.filled(dataset.variables[PRECIP_VAR][start:].astype(np.float32), np.nan))
+        sources.append(source_entry(file_path, len(time_data)))
+
+    if not time_parts:
+        return False
+
+    new_time = np.concatenate(time_parts)
+    order = np.argsort(new_time, kind='stable')
+    block_name = f"precip_{len(manifest['blocks']):03d}.npy"
+    np.save(os.path.join(store_dir, block_name), np.concatenate(cube_parts)[order].transpose(1, 2, 0).copy())
+
+    # The manifest is written last: until then readers keep using the old
+    # n_time and blocks, and ignore the extra entries of time.npy
+    all_time = np.concatenate([store_time, new_time[order]])
+    np.save(os.path.join(store_dir, 'time.tmp.npy'), all_time)
+    os.replace(os.path.join(store_dir, 'time.tmp.npy'), os.path.join(store_dir, 'time.npy'))
+    manifest['sources'] = sources
+    manifest['n_time'] = int(len(all_time))
+    manifest['blocks'].append({'file': block_name, 'n_time': int(len(new_time))})
+    write_manifest(store_dir, manifest)
+    return True
+
+
+class ConsolidatedStore:
+    # Read-only view of a consolidated store. All arrays are memory-mapped,
+    # so opening a store costs a few small reads whatever the archive size.
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.manifest = read_manifest(store_dir)
+        self.time = np.load(os.path.join(store_dir, 'time.npy'))[:self.manifest['n_time']]
+        self.lat = np.load(os.path.join(store_dir, 'lat.npy'))
+        self.lon = np.load(os.path.join(store_dir, 'lon.npy'))
+        self.blocks = [np.load(os.path.join(store_dir, block['file']), mmap_mode='r')
+                       for block in self.manifest['blocks']]
+
+    @profiled('store_read')
+    def read_point(self, lat_idx, lon_idx):
+        # Full series of one grid cell: one contiguous read per block
+        return np.concatenate([block[lat_idx, lon_idx, :] for block in self.blocks])
+
+    def read_point_series(self, target_lat, target_lon):
+        # Time values, series and grid index of the cell nearest to a point
+        lat_idx = nearest_index(self.lat, target_lat)
+        lon_idx = nearest_index(self.lon, target_lon)
+        return self.time, self.read_point(lat_idx, lon_idx), (lat_idx, lon_idx)
+
+    @profiled('store_read')
+    def read_cells(self, lat_idx, lon_idx):
+        # Series of many grid cells as a cells x time matrix
+        return np.concatenate([block[lat_idx, lon_idx, :] for block in self.blocks], axis=1)
+
+
+@profiled()
+def open_store(directory, product='mensal', store_dir=None):
+    # Return the consolidated store of the directory, or None when it has not
+    # been consolidated. A store whose sources changed is rebuilt first.
+    store_dir = store_dir or default_store_dir(directory, product)
+    if read_manifest(store_dir) is None:
+        return None
+    return ConsolidatedStore(consolidate(directory, product, store_dir))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Consolidate the PT02 NetCDF files into a single time-ordered store.")
+    parser.add_argument("--data-directory", type=str, required=True, help="Path to the NetCDF data directory")
+    parser.add_argument("--product", type=str, default='mensal', choices=['mensal', 'diario'], help="PT02 product")
+    parser.add_argument("--force", action='store_true', help="Rebuild even if the store is up to date")
+    args = parser.parse_args()
+
+    store_dir = consolidate(args.data_directory, args.product, force=args.force)
+    print(f"Consolidated store ready in {store_dir}")
@@ -0,0 +1,241 @@
+import argparse
+import os
+import netCDF4 as nc
+import numpy as np
+
+from pt02_reader import (TIME_VAR, LAT_VAR, LON_VAR, PRECIP_VAR, PRODUCTS,
+                         list_product_files, decode_time, encode_time)
+from pt02_rasters import FILL_VALUE
+
+
+# Out-of-core reducer for the daily PT02 product (ipma/diario).
+# The daily files are read in time chunks whose size is derived from a memory
+# ceiling and folded into running accumulators for the current month. Every
+# completed month is written out immediately and folded into the accumulator
+# of its year, so the memory use is constant whatever the archive length.
+
+DEFAULT_MAX_MEMORY_MB = 256
+DEFAULT_WET_DAY_MM = 1.0
+
+# Working bytes per daily value: float32 read buffer plus its mask, the NaN
+# filled copy, the wet-day mask and headroom for the reduceat temporaries
+BYTES_PER_VALUE = 16
+
+
+class PeriodAccumulator:
+    # Running total, wet-day count and maximum daily value of one period
+
+    def __init__(self, period, shape):
+        self.period = period
+        self.total = np.zeros(shape, dtype=np.float64)
+        self.wet_days = np.zeros(shape, dtype=np.int32)
+        self.max_daily = np.full(shape, -np.inf, dtype=np.float32)
+        self.n_days = 0
+
+    def add(self, total, wet_days, max_daily, n_days):
+        self.total += total
+        self.wet_days += wet_days
+        np.maximum(self.max_daily, max_daily, out=self.max_daily)
+        self.n_days += n_days
+
+    def add_period(self, other):
+        self.add(other.total, other.wet_days, other.max_daily, other.n_days)
+
+
+def plan_files(directory, product='diario'):
+    # Order the files by their first timestep and check the stream is sorted,
+    # reading only the time variables
+    plan = []
+    for file_path in list_product_files(directory, product):
+        with nc.Dataset(file_path) as dataset:
+            time_data = decode_time(dataset.variables[TIME_VAR][:], product)
+            grid_shape = (len(dataset.dimensions[LAT_VAR]), len(dataset.dimensions[LON_VAR]))
+        if len(time_data) == 0:
+            continue
+        if np.any(time_data[1:] < time_data[:-1]):
+            raise ValueError(f"{os.path.basename(file_path)} is not in time order")
+        plan.append((time_data[0], file_path, time_data, grid_shape))
+
+    plan.sort(key=lambda entry: entry[0])
+    for previous, current in zip(plan, plan[1:]):
+        if current[2][0] <= previous[2][-1]:
+            raise ValueError(f"{os.path.basename(current[1])} overlaps {os.path.basename(previous[1])}")
+    return [(file_path, time_data, grid_shape) for _, file_path, time_data, grid_shape in plan]
+
+
+def chunk_steps(grid_shape, max_memory_mb):
+    # Number of daily timesteps that fit under the memory ceiling next to the
+    # fixed accumulators (two periods plus the month written out)
+    n_cells = grid_shape[0] * grid_shape[1]
+    budget = max_memory_mb * 1024 * 1024 - 3 * n_cells * 16
+    steps = budget // (n_cells * BYTES_PER_VALUE)
+    if steps < 1:
+        raise MemoryError(f"--max-memory-mb {max_memory_mb} is too small for a {grid_shape[0]}x{grid_shape[1]} grid")
+    return int(steps)
+
+
+def iter_chunks(directory, product='diario', max_memory_mb=DEFAULT_MAX_MEMORY_MB):
+    # Yield (datetime64[D] times, (time, lat, lon) float32 block) chunks in time order
+    plan = plan_files(directory, product)
+    if not plan:
+        raise FileNotFoundError(f"No {product} NetCDF files found in {directory}")
+
+    steps = chunk_steps(plan[0][2], max_memory_mb)
+    for file_path, time_data, _ in plan:
+        with nc.Dataset(file_path) as dataset:
+            precip_var = dataset.variables[PRECIP_VAR]
+            for t0 in range(0, len(time_data), steps):
+                block = np.ma.filled(precip_var[t0:t0 + steps].astype(np.float32), np.nan)
+                yield time_data[t0:t0 + steps].astype('datetime64[D]'), block
+
+
+def stream_reduce(chunks, grid_shape, on_month, on_year, wet_day_mm=DEFAULT_WET_DAY_MM):
+    # Fold the daily chunks into monthly and annual accumulators. on_month and
+    # on_year are called with each completed PeriodAccumulator in time order.
+    month_acc = None
+    year_acc = None
+
+    def close_month():
+        nonlocal year_acc
+        on_month(month_acc)
+        year = month_acc.period.astype('datetime64[Y]')
+        if year_acc is not None and year_acc.period != year:
+            on_year(year_acc)
+            year_acc = None
+        if year_acc is None:
+            year_acc = PeriodAccumulator(year, grid_shape)
+        year_acc.add_period(month_acc)
+
+    for times, block in chunks:
+        # Per-month segments of the chunk, reduced with one reduceat each
+        months = times.astype('datetime64[M]')
+        starts = np.flatnonzero(np.r_[True, months[1:] != months[:-1]])
+        counts = np.diff(np.r_[starts, len(months)])
+        totals = np.add.reduceat(block, starts, axis=0, dtype=np.float64)
+        wet_days = np.add.reduceat(block >= wet_day_mm, starts, axis=0, dtype=np.int32)
+        max_daily = np.maximum.reduceat(block, starts, axis=0)
+
+        for k, start in enumerate(starts):
+            if month_acc is not None and month_acc.period != months[start]:
+                close_month()
+                month_acc = None
+            if month_acc is None:
+                month_acc = PeriodAccumulator(months[start], grid_shape)
+            month_acc.add(totals[k], wet_days[k], max_daily[k], counts[k])
+
+    # Flush the last (possibly partial) month and year
+    if month_acc is not None:
+        close_month()
+    if year_acc is not None:
+        on_year(year_acc)
+
+
+class SummaryWriter:
+    # Appends monthly and annual summaries to a NetCDF file as they complete
+
+    PREFIXES = {'month': 'monthly', 'year': 'annual'}
+
+    def __init__(self, output, lat_values, lon_values):
+        self.dataset = nc.Dataset(output, 'w')
+        self.dataset.createDimension(LAT_VAR, len(lat_values))
+        self.dataset.createDimension(LON_VAR, len(lon_values))
+        self.dataset.createVariable(LAT_VAR, 'f8', (LAT_VAR,))[:] = lat_values
+        self.dataset.createVariable(LON_VAR, 'f8', (LON_VAR,))[:] = lon_values
+        for axis_name, prefix in self.PREFIXES.items():
+            self.dataset.createDimension(axis_name, None)
+            self.dataset.createVariable(axis_name, 'f8' if axis_name == 'month' else 'i4', (axis_name,))
+            self.dataset.createVariable(f'{axis_name}_days', 'i4', (axis_name,))
+            self.dataset.createVariable(f'{prefix}_total', 'f4', (axis_name, LAT_VAR, LON_VAR), fill_value=FILL_VALUE)
+            self.dataset.createVariable(f'{prefix}_wet_days', 'i2', (axis_name, LAT_VAR, LON_VAR), fill_value=np.int16(-1))
+            self.dataset.createVariable(f'{prefix}_max_daily', 'f4', (axis_name, LAT_VAR, LON_VAR), fill_value=FILL_VALUE)
+        self.dataset.variables['month'].units = 'day as %Y%m%d.%f'
+
+    def _append(self, axis_name, axis_value, acc):
+        prefix = self.PREFIXES[axis_name]
+        i = len(self.dataset.dimensions[axis_name])
+        self.dataset.variables[axis_name][i] = axis_value
+        self.dataset.variables[f'{axis_name}_days'][i] = acc.n_days
+        self.dataset.variables[f'{prefix}_total'][i] = np.ma.masked_invalid(acc.total)
+        self.dataset.variables[f'{prefix}_wet_days'][i] = np.ma.masked_where(np.isnan(acc.total), acc.wet_days)
+        self.dataset.variables[f'{prefix}_max_daily'][i] = np.ma.masked_invalid(acc.max_daily)
+
+    def add_month(self, acc):
+        self._append('month', encode_time(acc.period), acc)
+
+    def add_year(self, acc):
+        self._append('year', acc.period.astype(int) + 1970, acc)
+
+    def close(self):
+        self.dataset.close()
+
+
+class MonthlyProductWriter:
+    # Regenerates the PRECIP_PT_mensalMM.nc files (one per calendar month,
+    # same variables and time convention as ipma/mensal) from the daily stream
+
+    def __init__(self, output_directory, lat_values, lon_values):
+        os.makedirs(output_directory, exist_ok=True)
+        self.datasets = {}
+        for month in range(1, 13):
+            file_path = os.path.join(output_directory, f"{PRODUCTS['mensal']['prefix']}{month:02d}.nc")
+            dataset = nc.Dataset(file_path, 'w', format='NETCDF3_CLASSIC')
+            dataset.createDimension(LON_VAR, len(lon_values))
+            dataset.createDimension(LAT_VAR, len(lat_values))
+            dataset.createDimension(TIME_VAR, None)
+            dataset.createVariable(LON_VAR, 'f8', (LON_VAR,))[:] = lon_values
+            dataset.createVariable(LAT_VAR, 'f8', (LAT_VAR,))[:] = lat_values
+            dataset.createVariable(TIME_VAR, 'f8', (TIME_VAR,)).units = 'day as %Y%m%d.%f'
+            dataset.createVariable(PRECIP_VAR, 'f4', (TIME_VAR, LAT_VAR, LON_VAR), fill_value=FILL_VALUE)
+            self.datasets[month] = dataset
+
+    def add_month(self, acc):
+        dataset = self.datasets[acc.period.astype(int) % 12 + 1]
+        i = len(dataset.dimensions[TIME_VAR])
+        dataset.variables[TIME_VAR][i] = encode_time(acc.period)
+        dataset.variables[PRECIP_VAR][i] = np.ma.masked_invalid(acc.total)
+
+    def close(self):
+        for dataset in self.datasets.values():
+            dataset.close()
+
+
+def summarize_daily(directory, output, monthly_directory=None, product='diario',
+                    max_memory_mb=DEFAULT_MAX_MEMORY_MB, wet_day_mm=DEFAULT_WET_DAY_MM):
+    # Stream the daily archive once, writing the summary NetCDF and optionally
+    # the regenerated monthly product
+    plan = plan_files(directory, product)
+    if not plan:
+        raise FileNotFoundError(f"No {product} NetCDF files found in {directory}")
+    with nc.Dataset(plan[0][0]) as dataset:
+        lat_values = dataset.variables[LAT_VAR][:]
+        lon_values = dataset.variables[LON_VAR][:]
+    grid_shape = (len(lat_values), len(lon_values))
+
+    writers = [SummaryWriter(output, lat_values, lon_values)]
+    if monthly_directory:
+        writers.append(MonthlyProductWriter(monthly_directory, lat_values, lon_values))
+
+    def on_month(acc):
+        for writer in writers:
+            writer.add_month(acc)
+
+    try:
+        stream_reduce(iter_chunks(directory, product, max_memory_mb), grid_shape,
+                      on_month, writers[0].add_year, wet_day_mm)
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream the daily PT02 files into monthly and annual summaries.")
+    parser.add_argument("--data-directory", type=str, required=True, help="Path to the daily NetCDF data directory")
+    parser.add_argument("--output", type=str, default='daily_summary.nc', help="Output NetCDF file")
+    parser.add_argument("--monthly-directory", type=str, help="Also regenerate the PRECIP_PT_mensal*.nc files here")
+    parser.add_argument("--max-memory-mb", type=int, default=DEFAULT_MAX_MEMORY_MB, help="Memory ceiling for the data chunks")
+    parser.add_argument("--wet-day-mm", type=float, default=DEFAULT_WET_DAY_MM, help="Minimum daily precipitation of a wet day")
+    args = parser.parse_args()
+
+    summarize_daily(args.data_directory, args.output, args.monthly_directory,
+                    max_memory_mb=args.max_memory_mb, wet_day_mm=args.wet_day_mm)
+    print(f"Saved daily summaries to {args.output}")
@@ -0,0 +1,157 @@
+import numpy as np
+
+from pt02_profile import profiled
+
+
+# Aggregation periods: the first calendar month (1-12) and the number of
+# months. A period is labelled with the year of its last month, so the
+# hydrological year 1950/1951 (October 1950 - September 1951) is 1951, like
+# the DJF season that ends in February 1951.
+PERIODS = {
+    'calendar_year': (1, 12),
+    'hydrological_year': (10, 12),
+    'DJF': (12, 3),
+    'MAM': (3, 3),
+    'JJA': (6, 3),
+    'SON': (9, 3),
+    'wet_season': (10, 7),
+    'dry_season': (5, 5),
+}
+
+
+def parse_period(period):
+    # (first month, number of months) of a PERIODS name, of a custom 'MM-MM'
+    # window of calendar months ('11-03' is November to March) or of a tuple
+    if isinstance(period, tuple):
+        first, n_months = period
+    elif period in PERIODS:
+        first, n_months = PERIODS[period]
+    else:
+        try:
+            first, last = (int(month) for month in period.split('-'))
+        except ValueError:
+            raise ValueError(f"Unknown period {period!r}: use one of {list(PERIODS)} or a 'MM-MM' month window")
+        n_months = (last - first) % 12 + 1
+    if not (1 <= first <= 12 and 1 <= n_months <= 12):
+        raise ValueError(f"Invalid period {period!r}")
+    return first, n_months
+
+
+class Segments:
+    # A period compiled against a time axis: the [start, end) timestep range
+    # of every occurrence of the period, its year label and whether all of
+    # its months are present. Timesteps outside the period (the dry months
+    # for the wet season) belong to no segment.
+
+    def __init__(self, time_index, first, n_months):
+        self.first = first
+        self.n_months = n_months
+
+        # Months since the start of the period (0..11) and the year it ends in
+        offset = (time_index.month_of_step - (first - 1)) % 12
+        inside = offset < n_months
+        end_year = time_index.year_of_step + ((time_index.month_of_step + n_months - 1 - offset) // 12)
+        key = np.where(inside, end_year, -1)
+
+        # Runs of timesteps of the same period occurrence
+        change = np.r_[True, key[1:] != key[:-1]]
+        run_starts = np.flatnonzero(change)
+        run_keys = key[run_starts]
+        self.starts = run_starts[run_keys >= 0]
+        self.ends = np.r_[run_starts[1:], len(key)][run_keys >= 0]
+        self.years = run_keys[run_keys >= 0]
+
+        # Segment of every timestep (-1 outside the period)
+        self.segment_of_step = np.full(len(key), -1)
+        self.segment_of_step[inside] = np.cumsum(change[inside]) - 1
+
+        # Complete when every month of the period has at least one timestep
+        month_id = time_index.year_of_step * 12 + time_index.month_of_step
+        new_month = np.r_[True, month_id[1:] != month_id[:-1]] & inside
+        months = np.bincount(self.segment_of_step[new_month], minlength=len(self.starts))
+        self.complete = months == n_months
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def labels(self):
+        # 'YYYY' labels, or 'YYYY/YYYY' for periods spanning two calendar years
+        if self.first + self.n_months - 1 > 12:
+            return [f"{year - 1}/{year}" for year in self.years]
+        return [str(year) for year in self.years]
+
+    def reduce(self, values, ufunc=np.add, axis=0):
+        # Reduce every segment of values along axis with one reduceat. The
+        # boundaries are interleaved (start, end, start, ...) and every second
+        # result kept, which skips the timesteps between segments.
+        if len(self.starts) == 0:
+            shape = list(np.shape(values))
+            shape[axis] = 0
+            return np.empty(shape, dtype=np.result_type(values))
+        bounds = np.column_stack([self.starts, self.ends]).ravel()
+        if bounds[-1] == np.shape(values)[axis]:
+            bounds = bounds[:-1]
+        return np.take(ufunc.reduceat(values, bounds, axis=axis), np.arange(0, len(bounds), 2), axis=axis)
+
+
+class TimeIndex:
+    # Year and month offsets of a time-sorted datetime64 axis, computed once
+    # and shared by every aggregation and plot of a series. Works for monthly
+    # and daily axes and for partial years (their segments are just shorter).
+
+    @profiled('time_index')
+    def __init__(self, all_time_data):
+        self.time = np.asarray(all_time_data)
+        if np.any(self.time[1:] < self.time[:-1]):
+            raise ValueError("The time axis must be sorted")
+
+        # Calendar year and month (0-11) of every timestep
+        self.year_of_step = self.time.astype('datetime64[Y]').astype(np.int64) + 1970
+        self.month_of_step = self.time.astype('datetime64[M]').astype(np.int64) % 12
+
+        # Years present and the offset of the first timestep of each one
+        self.year_starts = np.flatnonzero(np.r_[True, self.year_of_step[1:] != self.year_of_step[:-1]])
+        self.years = self.year_of_step[self.year_starts]
+
+        # Compiled periods, see segments()
+        self._segments = {}
+
+    def __len__(self):
+        return len(self.time)
+
+    @profiled()
+    def yearly_sum(self, values, axis=0):
+        # Total of every year present, in one reduceat over the time axis
+        return np.add.reduceat(values, self.year_starts, axis=axis)
+
+    @profiled()
+    def year_month_matrix(self, values):
+        # (year, month) totals over the full range of years. Years and months
+        # with no data are zero. Returns the years and the matrix.
+        years = np.arange(self.years[0], self.years[-1] + 1)
+        cells = (self.year_of_step - years[0]) * 12 + self.month_of_step
+        matrix = np.bincount(cells, weights=np.nan_to_num(values), minlength=len(years) * 12)
+        return years, matrix.reshape(len(years), 12)
+
+    def segments(self, period):
+        # Segments of a period (see parse_period), compiled on first use and
+        # shared by every later aggregation over this time axis
+        key = parse_period(period)
+        if key not in self._segments:
+            self._segments[key] = Segments(self, *key)
+        return self._segments[key]
+
+    @profiled()
+    def period_sum(self, values, period, axis=0, complete_only=False):
+        # Totals of every occurrence of a period present in the axis, e.g.
+        # hydrological years or DJF seasons. Returns the segments (years,
+        # labels, complete) and the totals; with complete_only the totals of
+        # occurrences missing a month are NaN.
+        segments = self.segments(period)
+        totals = segments.reduce(values, np.add, axis)
+        if complete_only and not segments.complete.all():
+            totals = np.moveaxis(np.array(totals, dtype=np.float64), axis, 0)
+            totals[~segments.complete] = np.nan
+            totals = np.moveaxis(totals, 0, axis)
+        return segments, totals
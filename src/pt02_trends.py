@@ -0,0 +1,196 @@
+import argparse
+import csv
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy import special
+
+from pt02_reader import read_cube, load_points_file, snap_points
+from pt02_timeindex import TimeIndex
+from pt02_rasters import save_rasters
+
+
+# Long-term trends of the annual and seasonal precipitation totals of every
+# PT02 cell: the Mann-Kendall test (S statistic, variance with the tie
+# correction, Z score and two sided p-value, Kendall's tau-b) and the Sen
+# slope with its intercept.
+# Both kernels work on (year, cells) arrays for a block of cells at a time:
+# S is summed over the year offsets k (n - 1 array operations instead of a
+# loop over pairs per cell), the ties are counted from the run lengths of
+# the sorted columns, and the Sen slope is the median of the (pair, cells)
+# slope matrix. Blocks are sized to bound the slope matrix and can be spread
+# over a process pool.
+
+SERIES = ['annual', 'DJF', 'MAM', 'JJA', 'SON']
+SEASONS = ['DJF', 'MAM', 'JJA', 'SON']
+DEFAULT_ALPHA = 0.05
+# Fewer valid years than this leaves the trend undefined
+MIN_YEARS = 10
+# Upper bound for the (pair, cells) slope matrix of one block
+MAX_BLOCK_BYTES = 64 * 1024 * 1024
+
+
+def seasonal_totals(time_index, values):
+    # Totals of every meteorological season (DJF, MAM, JJA, SON) of monthly
+    # values (time, ...), labelled with the year of the season's last month
+    # (December counts towards the DJF of the next year). Seasons missing a
+    # month are NaN. Returns {season: (years, totals)}.
+    results = {}
+    for name in SEASONS:
+        segments, totals = time_index.period_sum(values, name, complete_only=True)
+        results[name] = (segments.years, totals)
+    return results
+
+
+def mann_kendall(values):
+    # Mann-Kendall test of the columns of a (year, cells) array, ignoring NaN.
+    # Returns S, its variance, Z, the two sided p-value, Kendall's tau-b and
+    # the number of valid years of every column.
+    n_years = len(values)
+    valid = ~np.isnan(values)
+    n = valid.sum(axis=0)
+
+    s = np.zeros(values.shape[1])
+    for k in range(1, n_years):
+        with np.errstate(invalid='ignore'):
+            s += np.nansum(np.sign(values[k:] - values[:-k]), axis=0)
+
+    # Tie groups: runs of equal values in the sorted columns (NaN never ties)
+    ordered = np.sort(values.T, axis=1)
+    new_run = np.ones(ordered.shape, dtype=bool)
+    new_run[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    starts = np.flatnonzero(new_run.ravel())
+    lengths = np.diff(np.r_[starts, new_run.size])
+    ties = np.bincount(starts // n_years, weights=lengths * (lengths - 1) * (2 * lengths + 5),
+                       minlength=values.shape[1])
+    tied_pairs = np.bincount(starts // n_years, weights=lengths * (lengths - 1) / 2, minlength=values.shape[1])
+
+    variance = (n * (n - 1) * (2 * n + 5) - ties) / 18
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = np.where(variance > 0, (s - np.sign(s)) / np.sqrt(variance), 0.0)
+        # Tau-b, like scipy.stats.kendalltau: the years never tie, so only the
+        # tied pairs of values leave the denominator
+        pairs = n * (n - 1) / 2
+        tau = s / np.sqrt(pairs * (pairs - tied_pairs))
+    p = 2 * special.ndtr(-np.abs(z))
+    return s, variance, z, p, tau, n
+
+
+def sen_slope(years, values):
+    # Sen slope (median of the pairwise slopes) and intercept of the columns
+    # of a (year, cells) array
+    i, j = np.triu_indices(len(years), 1)
+    with np.errstate(invalid='ignore'):
+        slopes = (values[j] - values[i]) / (years[j] - years[i]).astype(np.float64)[:, np.newaxis]
+    valid = ~np.all(np.isnan(slopes), axis=0)
+    slope = np.full(values.shape[1], np.nan)
+    intercept = np.full(values.shape[1], np.nan)
+    if valid.any():
+        slope[valid] = np.nanmedian(slopes[:, valid], axis=0)
+        # Same convention as scipy.stats.theilslopes: median(values) - slope * median(years)
+        valid_years = np.where(np.isnan(values[:, valid]), np.nan, years[:, np.newaxis].astype(np.float64))
+        intercept[valid] = np.nanmedian(values[:, valid], axis=0) - slope[valid] * np.nanmedian(valid_years, axis=0)
+    return slope, intercept
+
+
+def trend_block(years, values, min_years=MIN_YEARS):
+    # Trend statistics of a (year, cells) block as a {name: (cells,)} dict
+    s, variance, z, p, tau, n = mann_kendall(values)
+    slope, intercept = sen_slope(years, values)
+    results = {'sen_slope': slope, 'intercept': intercept, 'mk_s': s, 'mk_z': z, 'mk_p': p,
+               'kendall_tau': tau, 'n_years': n.astype(np.float64)}
+    undefined = n < min_years
+    for name, result in results.items():
+        if name != 'n_years':
+            result[undefined] = np.nan
+    return results
+
+
+def trends(years, values, min_years=MIN_YEARS, workers=1, max_block_bytes=MAX_BLOCK_BYTES):
+    # trend_block over all the columns of a (year, cells) array, in blocks of
+    # cells small enough for the slope matrix, serially or over a process pool
+    n_pairs = max(1, len(years) * (len(years) - 1) // 2)
+    block = max(1, max_block_bytes // (n_pairs * 8))
+    # Sea cells have no data at all and are skipped
+    cells = np.flatnonzero(~np.all(np.isnan(values), axis=0))
+    blocks = [cells[k:k + block] for k in range(0, len(cells), block)]
+
+    results = {}
+    if workers <= 1:
+        parts = [trend_block(years, values[:, columns], min_years) for columns in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(trend_block, [years] * len(blocks), [values[:, columns] for columns in blocks],
+                                  [min_years] * len(blocks)))
+    for columns, part in zip(blocks, parts):
+        for name, result in part.items():
+            results.setdefault(name, np.full(values.shape[1], np.nan))[columns] = result
+    if not results:
+        results = {name: np.full(values.shape[1], np.nan) for name in trend_block(years, values[:, :0])}
+    return results
+
+
+def grid_trends(directory, series=SERIES, alpha=DEFAULT_ALPHA, min_years=MIN_YEARS, workers=1):
+    # Read the monthly cube once and compute the trends of every requested
+    # series (annual and/or seasonal totals). Returns the grid and a
+    # {series: {statistic: (lat, lon) raster}} dict; 'trend' is +1/-1 for
+    # significant increasing/decreasing trends at alpha and 0 otherwise.
+    all_time_data, lat_values, lon_values, cube = read_cube(directory, 'mensal', workers)
+    time_index = TimeIndex(all_time_data)
+    grid_shape = cube.shape[1:]
+    values = cube.reshape(len(cube), -1).astype(np.float64)
+
+    totals = {'annual': (time_index.years, time_index.yearly_sum(values))}
+    if any(name in SEASONS for name in series):
+        totals.update(seasonal_totals(time_index, values))
+
+    results = {}
+    for name in series:
+        years, series_values = totals[name]
+        statistics = trends(years, series_values, min_years, workers)
+        significant = statistics['mk_p'] < alpha
+        statistics['trend'] = np.where(np.isnan(statistics['mk_p']), np.nan,
+                                       np.where(significant, np.sign(statistics['mk_s']), 0.0))
+        results[name] = {key: value.reshape(grid_shape) for key, value in statistics.items()}
+    return lat_values, lon_values, results
+
+
+def write_site_summary(path, lat_values, lon_values, results, target_lats, target_lons, names):
+    # One row per site and series with the statistics of its nearest cell
+    grid_points = snap_points(lat_values, lon_values, target_lats, target_lons)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        statistics = list(next(iter(results.values())))
+        writer.writerow(['site', 'lat', 'lon', 'grid_lat', 'grid_lon', 'series'] + statistics)
+        for k, name in enumerate(names):
+            cell = grid_points['lat_idx'][k], grid_points['lon_idx'][k]
+            for series, rasters in results.items():
+                writer.writerow([name, target_lats[k], target_lons[k], grid_points['grid_lat'][k],
+                                 grid_points['grid_lon'][k], series]
+                                + [f"{rasters[statistic][cell]:.6g}" for statistic in statistics])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute Mann-Kendall trends and Sen slopes of the annual and seasonal totals of every grid cell.")
+    parser.add_argument("--data-directory", type=str, required=True, help="Path to the monthly NetCDF data directory")
+    parser.add_argument("--series", type=str, nargs='+', default=SERIES, choices=SERIES, help="Totals to test")
+    parser.add_argument("--alpha", type=float, default=DEFAULT_ALPHA, help="Significance level of the 'trend' rasters")
+    parser.add_argument("--min-years", type=int, default=MIN_YEARS, help="Minimum number of valid years per cell")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes for reading and for the cell blocks")
+    parser.add_argument("--output", type=str, default='trends.nc', help="Output NetCDF file (.nc) or NPY directory")
+    parser.add_argument("--points-file", type=str, help="CSV file of sites to summarize (lat, lon and optional name)")
+    parser.add_argument("--summary-output", type=str, default='trends_sites.csv', help="Output CSV of the site summary")
+    args = parser.parse_args()
+
+    lat_values, lon_values, results = grid_trends(args.data_directory, args.series, args.alpha, args.min_years,
+                                                  args.workers)
+    rasters = {f'{series}_{statistic}': raster for series, statistics in results.items()
+               for statistic, raster in statistics.items()}
+    save_rasters(args.output, lat_values, lon_values, rasters,
+                 attributes={'source': args.data_directory, 'alpha': args.alpha, 'min_years': args.min_years,
+                             'slope_units': 'mm/year'})
+    print(f"Saved trends of {', '.join(args.series)} totals to {args.output}")
+
+    if args.points_file:
+        target_lats, target_lons, names = load_points_file(args.points_file, with_names=True)
+        write_site_summary(args.summary_output, lat_values, lon_values, results, target_lats, target_lons, names)
+        print(f"Saved the trends of {len(names)} sites to {args.summary_output}")
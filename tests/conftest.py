@@ -0,0 +1,19 @@
+import glob
+import os
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The modules import each other as siblings, like the scripts run from src/
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+
+@pytest.fixture(scope='session')
+def monthly_directory(tmp_path_factory):
+    # The monthly NetCDF files alone, so that no consolidated store is used
+    directory = tmp_path_factory.mktemp('mensal')
+    for path in glob.glob(os.path.join(ROOT, 'ipma', 'mensal', '*.nc')):
+        shutil.copy(path, directory)
+    return str(directory)
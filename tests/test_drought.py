@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+
+from pt02_drought import MIN_SAMPLES, drought_runs, fit_gamma, gumbel_return_levels, rolling_sums, spi
+from pt02_timeindex import TimeIndex
+
+
+def monthly_values():
+    # 30 years of monthly totals of a few cells, with dry (zero) months, NaN
+    # gaps and a cell too dry to fit
+    rng = np.random.default_rng(11)
+    time = np.arange(np.datetime64('1970-01'), np.datetime64('2000-01'))
+    values = rng.gamma(1.5, 40.0, (len(time), 4))
+    values[rng.random(values.shape) < 0.15] = 0.0
+    values[[5, 6, 200], 1] = np.nan
+    values[100:112, 2] = np.nan
+    values[:, 3] = 0.0
+    values[::60, 3] = 5.0
+    return time, values
+
+
+@pytest.mark.parametrize('scale', [1, 3, 12])
+def test_rolling_sums_match_pandas(scale):
+    _, values = monthly_values()
+    expected = pd.DataFrame(values).rolling(scale).sum().to_numpy()
+    assert np.allclose(rolling_sums(values, scale), expected, equal_nan=True)
+
+
+def test_rolling_sums_longer_than_series():
+    _, values = monthly_values()
+    sums = rolling_sums(values[:5], 6)
+    assert sums.shape == (5, values.shape[1]) and np.all(np.isnan(sums))
+
+
+def test_fit_gamma_matches_scipy():
+    _, values = monthly_values()
+    alpha, beta, zero_probability = fit_gamma(values)
+    for cell in range(3):
+        column = values[:, cell][~np.isnan(values[:, cell])]
+        shape, _, scale = stats.gamma.fit(column[column > 0], floc=0)
+        # Thom's approximation of the maximum likelihood estimate
+        assert alpha[cell] == pytest.approx(shape, rel=5e-3)
+        assert beta[cell] == pytest.approx(scale, rel=5e-3)
+        assert zero_probability[cell] == pytest.approx(np.mean(column == 0))
+    # Too few non-zero totals to fit
+    assert (values[:, 3] > 0).sum() < MIN_SAMPLES
+    assert np.isnan(alpha[3]) and np.isnan(beta[3])
+
+
+def test_spi_matches_scipy_gamma_cdf():
+    time, values = monthly_values()
+    scale = 3
+    index = spi(TimeIndex(time), values, scale)
+    sums = pd.DataFrame(values).rolling(scale).sum().to_numpy()
+    months = time.astype(np.int64) % 12
+    for cell in range(3):
+        for month in range(12):
+            samples = sums[months == month, cell]
+            valid = samples[~np.isnan(samples)]
+            positive = valid[valid > 0]
+            shape, _, gamma_scale = stats.gamma.fit(positive, floc=0)
+            zero = np.mean(valid == 0)
+            probability = zero + (1 - zero) * stats.gamma.cdf(np.maximum(samples, 0), shape, scale=gamma_scale)
+            expected = stats.norm.ppf(np.clip(probability, 1e-6, 1 - 1e-6))
+            expected[np.isnan(samples)] = np.nan
+            assert np.allclose(index[months == month, cell], expected, atol=2e-2, equal_nan=True)
+
+
+def loop_runs(column, threshold, min_duration):
+    # Drought events of one series with an explicit loop
+    runs = []
+    length, severity = 0, 0.0
+    for value in list(column) + [np.inf]:
+        if value <= threshold:
+            length += 1
+            severity += threshold - value
+        else:
+            if length >= min_duration:
+                runs.append((length, severity))
+            length, severity = 0, 0.0
+    return runs
+
+
+@pytest.mark.parametrize('min_duration', [1, 3])
+def test_drought_runs_match_loop(min_duration):
+    rng = np.random.default_rng(2)
+    index = rng.normal(size=(120, 6))
+    index[:10, 0] = -2.0
+    index[-7:, 1] = -1.5
+    index[50:60, 2] = np.nan
+    result = drought_runs(index, -0.5, min_duration)
+    for cell in range(index.shape[1]):
+        runs = loop_runs(index[:, cell], -0.5, min_duration)
+        assert result['events'][cell] == len(runs)
+        assert result['months'][cell] == sum(length for length, _ in runs)
+        assert result['max_duration'][cell] == max([length for length, _ in runs], default=0)
+        assert result['max_severity'][cell] == pytest.approx(max([severity for _, severity in runs], default=0.0))
+
+
+def test_gumbel_return_levels_match_scipy():
+    rng = np.random.default_rng(4)
+    maxima = stats.gumbel_r.rvs(loc=80, scale=25, size=(40, 3), random_state=rng)
+    maxima[3, 2] = np.nan
+    periods = [2, 10, 100]
+    levels = gumbel_return_levels(maxima, periods)
+    for cell in range(2):
+        scale = np.sqrt(6) * maxima[:, cell].std(ddof=1) / np.pi
+        location = maxima[:, cell].mean() - np.euler_gamma * scale
+        expected = stats.gumbel_r.ppf(1 - 1 / np.array(periods), loc=location, scale=scale)
+        assert np.allclose(levels[:, cell], expected)
+    assert np.all(np.isnan(levels[:, 2]))
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from scipy import stats
+
+from pt02_lagcorr import batch_correlation, window_predictors
+
+WINDOWS = [1, 3, 12]
+LAGS = [0, 2, 5]
+
+
+def synthetic_record():
+    # 20 years of monthly totals of a few cells, and April/October levels
+    # from the first month of the record (the long windows do not fit there)
+    rng = np.random.default_rng(21)
+    all_time_data = np.arange(np.datetime64('1980-01'), np.datetime64('2000-01'))
+    values = rng.gamma(2.0, 30.0, (len(all_time_data), 5))
+    observation_dates = np.array([f'{year}-{month:02d}' for year in range(1980, 2001) for month in (4, 10)],
+                                 dtype='datetime64[M]')
+    return all_time_data, values, observation_dates
+
+
+def test_window_predictors_match_explicit_sums():
+    all_time_data, values, observation_dates = synthetic_record()
+    predictors = window_predictors(all_time_data, values, observation_dates, WINDOWS, LAGS)
+    for i, window in enumerate(WINDOWS):
+        for j, lag in enumerate(LAGS):
+            for k, date in enumerate(observation_dates):
+                end = int((date - all_time_data[0]).astype(np.int64)) - lag
+                if end - window + 1 < 0 or end >= len(values):
+                    assert np.all(np.isnan(predictors[i, j, k]))
+                else:
+                    assert np.allclose(predictors[i, j, k], values[end - window + 1:end + 1].sum(axis=0))
+
+
+@pytest.mark.parametrize('method, reference', [('spearman', stats.spearmanr), ('pearson', stats.pearsonr)])
+def test_batch_correlation_matches_scipy(method, reference):
+    all_time_data, values, observation_dates = synthetic_record()
+    predictors = window_predictors(all_time_data, values, observation_dates, WINDOWS, LAGS)
+    # A qualitative level with ties and missing observations
+    rng = np.random.default_rng(3)
+    target = rng.integers(1, 5, len(observation_dates)).astype(np.float64)
+    target[[2, 7, 30]] = np.nan
+    # A partial gap in one cell: that cell is left undefined for the pairs
+    # where the gap falls on a usable observation
+    predictors[:, :, 15, 4] = np.nan
+
+    r, n = batch_correlation(predictors, target, method, min_observations=8)
+    for i in range(len(WINDOWS)):
+        for j in range(len(LAGS)):
+            usable = ~np.isnan(target) & ~np.all(np.isnan(predictors[i, j]), axis=-1)
+            for cell in range(values.shape[1]):
+                x = predictors[i, j, usable, cell]
+                assert n[i, j, cell] == np.sum(~np.isnan(x))
+                if np.isnan(x).any():
+                    assert np.isnan(r[i, j, cell])
+                else:
+                    expected = reference(x, target[usable]).statistic
+                    assert r[i, j, cell] == pytest.approx(expected, abs=1e-12)
+
+
+def test_batch_correlation_needs_min_observations():
+    all_time_data, values, observation_dates = synthetic_record()
+    predictors = window_predictors(all_time_data, values, observation_dates, [1], [0])
+    target = np.full(len(observation_dates), np.nan)
+    target[:6] = np.arange(6.0)
+    r, n = batch_correlation(predictors, target, min_observations=8)
+    assert np.all(n == 6) and np.all(np.isnan(r))
@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+import pytest
+
+from pt02_reader import list_product_files, load_points_file, read_cube, read_file_blocks
+
+SHM_DIR = '/dev/shm'
+
+
+def shared_segments():
+    return {name for name in os.listdir(SHM_DIR) if name.startswith('psm_')}
+
+
+def test_parallel_read_matches_serial(monthly_directory):
+    serial = read_cube(monthly_directory, 'mensal', 1)
+    parallel = read_cube(monthly_directory, 'mensal', 4)
+    for expected, actual in zip(serial, parallel):
+        assert np.array_equal(expected, actual, equal_nan=True)
+
+
+@pytest.mark.skipif(not os.path.isdir(SHM_DIR), reason="needs POSIX shared memory in /dev/shm")
+def test_early_close_frees_shared_memory(monthly_directory):
+    before = shared_segments()
+    blocks = read_file_blocks(list_product_files(monthly_directory, 'mensal'), workers=4)
+    next(blocks)
+    blocks.close()
+    assert shared_segments() - before == set()
+
+
+@pytest.mark.parametrize('content, message', [
+    ('', 'no points'),
+    ('lat,lon\n', 'no points'),
+    ('x,y\n38.7,-9.1\n', 'header needs lat/lon columns'),
+])
+def test_load_points_file_errors(tmp_path, content, message):
+    path = tmp_path / 'points.csv'
+    path.write_text(content)
+    with pytest.raises(ValueError, match=message):
+        load_points_file(str(path))
+
+
+def test_load_points_file_header_and_names(tmp_path):
+    path = tmp_path / 'points.csv'
+    path.write_text('site,latitude,longitude\nLisboa,38.7,-9.1\nPorto,41.15,-8.61\n')
+    lats, lons, names = load_points_file(str(path), with_names=True)
+    assert np.array_equal(lats, [38.7, 41.15]) and np.array_equal(lons, [-9.1, -8.61])
+    assert names == ['Lisboa', 'Porto']
@@ -0,0 +1,26 @@
+import json
+
+import pytest
+
+from pt02_service import GridData, handle_request
+
+
+@pytest.fixture(scope='module')
+def grid_data(monthly_directory):
+    return GridData(monthly_directory)
+
+
+@pytest.mark.parametrize('value', ['nan', 'NaN', 'inf', '-inf', 'infinity', 'abc', ''])
+def test_non_finite_coordinates_are_rejected(grid_data, value):
+    for target in (f'/series?lat={value}&lon=-8', f'/annual?lat=39&lon={value}', f'/stats?lat={value}&lon={value}'):
+        status, content_type, body = handle_request(grid_data, target)
+        assert status == 400
+        assert 'error' in json.loads(body)
+
+
+def test_series_is_strict_json(grid_data):
+    status, content_type, body = handle_request(grid_data, '/series?lat=39.0&lon=-8.0')
+    assert status == 200
+    # Missing values are null; no bare NaN literal reaches the client
+    series = json.loads(body, parse_constant=lambda constant: pytest.fail(f"non-JSON constant {constant}"))
+    assert len(series['precip']) == len(grid_data.time)
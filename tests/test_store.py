@@ -0,0 +1,111 @@
+import os
+import shutil
+import sys
+
+import netCDF4 as nc
+import numpy as np
+import pytest
+
+from pt02_aggregates import RunningAggregates, update_aggregates
+from pt02_reader import PRECIP_VAR, TIME_VAR, encode_time, list_product_files, read_cube
+from pt02_store import consolidate, open_store, read_manifest, default_store_dir
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from synthetic import generate
+
+START_YEAR = 1990
+YEARS = 6
+APPENDED_YEARS = 2
+
+
+def append_records(directory, years, seed=1):
+    # Add the months of the given years at the end of every monthly file
+    rng = np.random.default_rng(seed)
+    for file_path in list_product_files(directory, 'mensal'):
+        month = int(os.path.basename(file_path)[-5:-3])
+        with nc.Dataset(file_path, 'a') as dataset:
+            n_time = len(dataset.dimensions[TIME_VAR])
+            dates = np.array([f'{year}-{month:02d}' for year in years], dtype='datetime64[M]')
+            precip = dataset.variables[PRECIP_VAR]
+            sea = np.ma.getmaskarray(precip[0])
+            dataset.variables[TIME_VAR][n_time:] = encode_time(dates)
+            values = rng.gamma(2.0, 60.0, (len(dates),) + sea.shape).astype(np.float32)
+            precip[n_time:] = np.ma.masked_array(values, np.broadcast_to(sea, values.shape))
+
+
+def fresh_copy(directory, tmp_path, name):
+    # The NetCDF files of directory alone, in a new directory
+    copy = tmp_path / name
+    copy.mkdir()
+    for file_path in list_product_files(directory, 'mensal'):
+        shutil.copy2(file_path, copy)
+    return str(copy)
+
+
+def assert_same_aggregates(actual, expected):
+    assert actual.n_time == expected.n_time
+    for name in RunningAggregates.FIELDS:
+        a, b = getattr(actual, name), getattr(expected, name)
+        if np.issubdtype(np.asarray(b).dtype, np.integer):
+            assert np.array_equal(a, b), name
+        else:
+            assert np.allclose(a, b, equal_nan=True, rtol=1e-10, atol=1e-9), name
+
+
+def assert_same_cube(actual, expected):
+    for a, b in zip(actual, expected):
+        assert np.array_equal(a, b, equal_nan=True)
+
+
+@pytest.fixture
+def archive(tmp_path):
+    directory = str(tmp_path / 'mensal')
+    generate(directory, 'mensal', n_lat=6, n_lon=5, years=YEARS, start_year=START_YEAR)
+    consolidate(directory)
+    update_aggregates(directory)
+    return directory
+
+
+def test_append_matches_full_rebuild(archive, tmp_path):
+    build_id = read_manifest(default_store_dir(archive))['build_id']
+    append_records(archive, range(START_YEAR + YEARS, START_YEAR + YEARS + APPENDED_YEARS))
+
+    # The store is extended with a new block, not rebuilt
+    store = open_store(archive)
+    assert len(store.manifest['blocks']) == 2
+    assert store.manifest['build_id'] == build_id
+    assert len(store.time) == (YEARS + APPENDED_YEARS) * 12
+
+    reference = fresh_copy(archive, tmp_path, 'reference')
+    consolidate(reference)
+    assert_same_cube(read_cube(archive), read_cube(reference))
+
+    _, incremental = update_aggregates(archive)
+    _, rebuilt = update_aggregates(reference, rebuild=True)
+    assert_same_aggregates(incremental, rebuilt)
+    assert incremental.years.tolist() == list(range(START_YEAR, START_YEAR + YEARS + APPENDED_YEARS))
+
+
+def test_revised_value_rebuilds_store_and_aggregates(archive, tmp_path):
+    build_id = read_manifest(default_store_dir(archive))['build_id']
+    file_path = list_product_files(archive, 'mensal')[0]
+    with nc.Dataset(file_path, 'a') as dataset:
+        precip = dataset.variables[PRECIP_VAR]
+        revised = precip[0]
+        revised[~np.ma.getmaskarray(revised)] += 100.0
+        precip[0] = revised
+
+    # Not a pure append: full rebuild with a new build_id, which resets the
+    # running aggregates instead of folding anything into the old state
+    store = open_store(archive)
+    assert len(store.manifest['blocks']) == 1
+    assert store.manifest['build_id'] != build_id
+
+    reference = fresh_copy(archive, tmp_path, 'reference')
+    consolidate(reference)
+    assert_same_cube(read_cube(archive), read_cube(reference))
+
+    _, updated = update_aggregates(archive)
+    assert updated.build_id == store.manifest['build_id']
+    _, rebuilt = update_aggregates(reference, rebuild=True)
+    assert_same_aggregates(updated, rebuilt)
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pt02_timeindex import TimeIndex
+
+# Periods as the calendar months they cover, in order
+PERIOD_MONTHS = {
+    'hydrological_year': [10, 11, 12, 1, 2, 3, 4, 5, 6, 7, 8, 9],
+    'DJF': [12, 1, 2],
+    'wet_season': [10, 11, 12, 1, 2, 3, 4],
+    '11-03': [11, 12, 1, 2, 3],
+}
+
+
+def groupby_reference(time, values, months):
+    # Totals per period occurrence with pandas, labelled with the year of the
+    # period's last month, and whether all of its months are present
+    dates = pd.DatetimeIndex(time)
+    inside = dates.month.isin(months)
+    # Months after the last month of the period belong to the next year's one
+    label = dates.year + (dates.month > months[-1]).astype(int)
+    frame = pd.DataFrame(values[inside], index=label[inside])
+    totals = frame.groupby(level=0).sum()
+    n_months = pd.Series(dates.to_period('M')[inside], index=label[inside]).groupby(level=0).nunique()
+    return totals.index.to_numpy(), totals.to_numpy(), (n_months == len(months)).to_numpy()
+
+
+@pytest.mark.parametrize('period', list(PERIOD_MONTHS))
+@pytest.mark.parametrize('unit', ['M', 'D'])
+def test_period_sum_matches_groupby(period, unit):
+    # Partial first and last years on purpose
+    time = np.arange(np.datetime64('1950-03-01'), np.datetime64('1961-08-01')).astype(f'datetime64[{unit}]')
+    time = np.unique(time)
+    values = np.random.default_rng(3).gamma(2.0, 30.0, (len(time), 4))
+
+    years, totals, complete = groupby_reference(time, values, PERIOD_MONTHS[period])
+    segments, result = TimeIndex(time).period_sum(values, period)
+    assert np.array_equal(segments.years, years)
+    assert np.array_equal(segments.complete, complete)
+    assert np.allclose(result, totals)
+
+    _, masked = TimeIndex(time).period_sum(values, period, complete_only=True)
+    assert np.allclose(masked[complete], totals[complete])
+    assert np.all(np.isnan(masked[~complete]))
+
+
+def test_period_sum_along_time_axis_of_cube():
+    time = np.arange(np.datetime64('1950-01'), np.datetime64('1960-01'))
+    cube = np.random.default_rng(5).gamma(2.0, 30.0, (3, len(time), 2))
+    segments, totals = TimeIndex(time).period_sum(cube, 'DJF', axis=1)
+    _, reference = TimeIndex(time).period_sum(np.moveaxis(cube, 1, 0), 'DJF')
+    assert totals.shape == (3, len(segments), 2)
+    assert np.allclose(np.moveaxis(totals, 1, 0), reference)
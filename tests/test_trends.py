@@ -0,0 +1,59 @@
+import numpy as np
+from scipy import special, stats
+
+from pt02_trends import mann_kendall, sen_slope
+
+
+def trend_columns():
+    # Annual totals of a few cells: a plain series, one with many ties, one
+    # with NaN gaps and ties, and a constant one
+    rng = np.random.default_rng(7)
+    years = np.arange(1950, 1980)
+    plain = rng.gamma(4.0, 150.0, len(years)) + 3.0 * (years - years[0])
+    tied = np.round(plain / 200.0) * 200.0
+    gaps = tied.copy()
+    gaps[[0, 4, 5, 17, 29]] = np.nan
+    constant = np.full(len(years), 500.0)
+    return years, np.column_stack([plain, tied, gaps, constant])
+
+
+def brute_force_s(column):
+    column = column[~np.isnan(column)]
+    return sum(np.sign(column[j] - column[i]) for i in range(len(column)) for j in range(i + 1, len(column)))
+
+
+def test_mann_kendall_matches_brute_force():
+    years, values = trend_columns()
+    s, variance, z, p, tau, n = mann_kendall(values)
+    for cell in range(values.shape[1]):
+        column = values[:, cell]
+        valid = ~np.isnan(column)
+        assert s[cell] == brute_force_s(column)
+        assert n[cell] == valid.sum()
+
+        # Variance with the tie correction, from the tie group sizes
+        _, counts = np.unique(column[valid], return_counts=True)
+        m = valid.sum()
+        expected = (m * (m - 1) * (2 * m + 5) - np.sum(counts * (counts - 1) * (2 * counts + 5))) / 18
+        assert np.isclose(variance[cell], expected)
+        if expected > 0:
+            expected_z = (s[cell] - np.sign(s[cell])) / np.sqrt(expected)
+            assert np.isclose(z[cell], expected_z)
+            assert np.isclose(p[cell], 2 * special.ndtr(-abs(expected_z)))
+            assert np.isclose(tau[cell], stats.kendalltau(years[valid], column[valid]).statistic)
+
+
+def test_sen_slope_matches_theilslopes():
+    years, values = trend_columns()
+    slope, intercept = sen_slope(years, values)
+    for cell in range(values.shape[1]):
+        valid = ~np.isnan(values[:, cell])
+        expected = stats.theilslopes(values[valid, cell], years[valid])
+        assert np.isclose(slope[cell], expected.slope)
+        assert np.isclose(intercept[cell], expected.intercept)
+
+
+def test_all_nan_column_is_undefined():
+    years = np.arange(2000, 2012)
+    slope, intercept = sen_slope(years, np.full((len(years), 1), np.nan))
+    assert np.isnan(slope[0]) and np.isnan(intercept[0])